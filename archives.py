@@ -0,0 +1,313 @@
+"""
+-------------------------------------------------------------
+                        ARCHIVES
+  Background indexing of the members of uploaded archives,
+ and streaming of a single member out of a zip, tar or rar
+        file without extracting the archive to disk.
+-------------------------------------------------------------
+
+usage: python models.py archive_indexer [--once]
+       python models.py queue_archives [--all]
+
+Archives are indexed per blob: files with the same data share a listing.
+Uploads of files with one of EXTENSIONS queue their blob (archive_status
+"pending"); the indexer claims queued blobs, reads each archive once and
+stores its members as ArchiveMember rows, in archive order.
+
+    zip  the central directory at the end of the file
+    tar  one sequential pass, whatever the compression (gz, bz2)
+    rar  with the rarfile package, if installed
+
+Other formats (7z, rar without rarfile) are marked "unsupported". Only the
+first MAX_MEMBERS members are indexed.
+
+A member is streamed through a fixed size buffer: zip members are
+decompressed on the fly, members of a plain tar are read at the offset
+recorded by the indexer, members of a compressed tar by decompressing
+the archive up to them, and rar members by rarfile (which needs an unrar
+tool for compressed members).
+"""
+
+import time
+import tarfile
+import zipfile
+import models
+
+
+PENDING = "pending"
+WORKING = "working"
+READY = "ready"
+FAILED = "failed"
+UNSUPPORTED = "unsupported"
+
+EXTENSIONS = ("zip", "tar", "rar", "7z")
+
+MAX_MEMBERS = 50000
+# members inserted per statement
+BATCH_SIZE = 1000
+
+CHUNK_SIZE = 64 * 1024
+
+# leading bytes of the compressed tar formats
+COMPRESSED = (b"\x1f\x8b", b"BZh", b"\xfd7zXZ")
+
+
+class UnsupportedArchive(Exception):
+    pass
+
+
+class MemberFile(object):
+
+    """Readable data of an archive member: reads stop at the member's
+       size, and closing it closes the files it was read from.
+    """
+
+    def __init__(self, source, size, files=()):
+        self.source = source
+        self.remaining = size
+        self.files = files
+
+    def read(self, size=CHUNK_SIZE):
+        data = self.source.read(min(size, self.remaining)) if self.remaining > 0 else b""
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.source.close()
+        for file in self.files:
+            file.close()
+
+
+def is_archive(filename):
+    # return: bool
+    return filename.split('.')[-1].lower() in EXTENSIONS
+
+
+def read_members(path):
+
+    # path: str
+    # yields: (name: unicode, size: int, is_dir: bool, offset: int or None)
+
+    """Reads the member list of the archive at path. offset is where the
+       data of a member of an uncompressed tar starts. Raises
+       UnsupportedArchive for formats that can't be read.
+    """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        try:
+            for info in archive.infolist():
+                yield _name(info.filename), info.file_size, info.filename.endswith('/'), None
+        finally:
+            archive.close()
+
+    elif tarfile.is_tarfile(path):
+        with open(path, 'rb') as file:
+            plain = not file.read(6).startswith(COMPRESSED)
+            file.seek(0)
+            archive = tarfile.open(fileobj=file, mode='r|*')
+            for info in archive:
+                # stream mode keeps every member read, which we don't need
+                archive.members = []
+                # links and devices have no data of their own
+                if info.isfile() or info.isdir():
+                    yield (_name(info.name), info.size if info.isfile() else 0, info.isdir(),
+                           info.offset_data if plain and info.isfile() else None)
+
+    else:
+        try:
+            import rarfile
+        except ImportError:
+            raise UnsupportedArchive(path)
+        if not rarfile.is_rarfile(path):
+            raise UnsupportedArchive(path)
+        for info in rarfile.RarFile(path).infolist():
+            yield _name(info.filename), info.file_size, info.isdir(), None
+
+
+def _name(name):
+    # member names are bytes in some archives (and Python 2 tarfile)
+    if isinstance(name, bytes):
+        name = name.decode('utf-8', 'replace')
+    return name[:1024]
+
+
+def index(blob):
+
+    # blob: Blob
+    # return: int (number of members indexed)
+
+    """Replaces the member listing of an archive (does not commit)."""
+    ArchiveMember, db = models.ArchiveMember, models.db
+    ArchiveMember.query.filter_by(md5=blob.md5).delete(synchronize_session=False)
+    rows = []
+    count = 0
+    for position, (name, size, is_dir, offset) in enumerate(read_members(blob.get_disk_path())):
+        if position == MAX_MEMBERS:
+            break
+        rows.append({"md5": blob.md5, "position": position, "name": name, "size": size,
+                     "is_dir": is_dir, "offset": offset})
+        if len(rows) == BATCH_SIZE:
+            db.session.execute(ArchiveMember.__table__.insert(), rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        db.session.execute(ArchiveMember.__table__.insert(), rows)
+        count += len(rows)
+    return count
+
+
+def claim_jobs(limit):
+
+    # limit: int
+    # return: List of Blob
+
+    """Marks up to `limit` queued blobs as being indexed and returns them
+       (a conditional update, so concurrent indexers never claim the same
+       blob).
+    """
+    Blob = models.Blob
+    claimed = []
+    for blob in Blob.query.filter_by(archive_status=PENDING).limit(limit):
+        if Blob.query.filter_by(md5=blob.md5, archive_status=PENDING)\
+                     .update({Blob.archive_status: WORKING}, synchronize_session=False):
+            claimed.append(blob)
+    models.db.session.commit()
+    return claimed
+
+
+def run_indexer(batch_size=10, poll_interval=2.0, once=False):
+
+    """Indexes queued archives until interrupted (or, if once is True,
+       until the queue is empty).
+    """
+    Blob, db = models.Blob, models.db
+
+    # blobs claimed by an indexer that died are queued again
+    Blob.query.filter_by(archive_status=WORKING).update({Blob.archive_status: PENDING},
+                                                        synchronize_session=False)
+    db.session.commit()
+
+    while True:
+        jobs = claim_jobs(batch_size)
+        if not jobs:
+            if once:
+                break
+            time.sleep(poll_interval)
+            continue
+        for blob in jobs:
+            try:
+                index(blob)
+                blob.archive_status = READY
+            except UnsupportedArchive:
+                db.session.rollback()
+                blob.archive_status = UNSUPPORTED
+            except Exception:
+                # damaged or truncated archive
+                db.session.rollback()
+                blob.archive_status = FAILED
+            db.session.commit()
+
+
+def queue(all=False):
+
+    # all: bool
+    # return: int
+
+    """Queues the blobs of archive files for the indexer: those never
+       indexed or, if all is True, every one. Returns the number queued.
+    """
+    File, Blob = models.File, models.Blob
+    archives = models.db.session.query(File.md5).filter(File.extension.in_(EXTENSIONS))
+    blobs = Blob.query.filter(Blob.md5.in_(archives.subquery()))
+    if all:
+        blobs = blobs.filter(models.or_(Blob.archive_status == None, Blob.archive_status != WORKING))
+    else:
+        blobs = blobs.filter(Blob.archive_status == None)
+    queued = blobs.update({Blob.archive_status: PENDING}, synchronize_session=False)
+    models.db.session.commit()
+    return queued
+
+
+def members(blob, search=None, page=1, results_per_page=100):
+
+    # blob: Blob
+    # search: str - part of the member names to look for
+    # page: int
+    # return: List of ArchiveMember
+
+    """Returns a page of the listing of an archive, in archive order."""
+    ArchiveMember = models.ArchiveMember
+    query = ArchiveMember.query.filter_by(md5=blob.md5)
+    if search:
+        # LIKE wildcards in the search term match themselves
+        term = search.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(models.func.lower(ArchiveMember.name).like('%' + term + '%', escape='\\'))
+    return query.order_by(ArchiveMember.position)\
+                .offset((page - 1) * results_per_page).limit(results_per_page).all()
+
+
+def open_member(blob, member):
+
+    # blob: Blob
+    # member: ArchiveMember
+    # return: MemberFile
+
+    """Opens the data of a member of an archive for reading. Raises
+       UnsupportedArchive if it can't be read (rar without rarfile).
+    """
+    path = blob.get_disk_path()
+    if member.offset is not None:
+        # uncompressed tar: the data is stored as is
+        file = open(path, 'rb')
+        file.seek(member.offset)
+        return MemberFile(file, member.size)
+
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        try:
+            # the member reads from a file handle of its own
+            return MemberFile(archive.open(archive.infolist()[member.position]), member.size)
+        finally:
+            archive.close()
+
+    if not tarfile.is_tarfile(path):
+        return _open_rar_member(path, member)
+
+    # compressed tar: decompressed up to the member
+    file = open(path, 'rb')
+    try:
+        archive = tarfile.open(fileobj=file, mode='r|*')
+        position = 0
+        for info in archive:
+            archive.members = []
+            if not (info.isfile() or info.isdir()):
+                continue
+            if position == member.position:
+                return MemberFile(archive.extractfile(info), member.size, files=[file])
+            position += 1
+    except Exception:
+        file.close()
+        raise
+    file.close()
+    raise UnsupportedArchive(path)
+
+
+def _open_rar_member(path, member):
+
+    # path: str
+    # member: ArchiveMember
+    # return: MemberFile
+
+    try:
+        import rarfile
+    except ImportError:
+        raise UnsupportedArchive(path)
+    if not rarfile.is_rarfile(path):
+        raise UnsupportedArchive(path)
+    archive = rarfile.RarFile(path)
+    try:
+        # positions are those of infolist(), see read_members
+        return MemberFile(archive.open(archive.infolist()[member.position]), member.size)
+    except rarfile.Error:
+        # a compressed member and no unrar tool
+        raise UnsupportedArchive(path)
@@ -0,0 +1,204 @@
+"""
+-------------------------------------------------------------
+                    QUOTA STRESS TEST
+ Runs concurrent uploads and deletions from several worker
+  processes against one user with a small quota (temporary
+  SQLite database and upload directory), then checks that
+ the storage accounting is exact and the quota was never
+  exceeded. Also shows the updates lost by read-modify-write
+           of the counter under the same contention.
+
+usage: python benchmarks/quota_stress.py [--workers N] [--uploads N]
+                                         [--files N] [--quota BYTES]
+-------------------------------------------------------------
+"""
+
+import os
+import io
+import sys
+import shutil
+import argparse
+import tempfile
+from random import Random
+from multiprocessing import Process, Queue
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import models
+from models import app, db, User, Folder, File, Blob, StorageReservation
+import quota
+
+
+def counter_worker(worker, increments, atomic, errors):
+
+    """Adds 1 to the used storage of the user `increments` times, either
+       with quota.charge or by loading, modifying and saving the user.
+    """
+    with app.app_context():
+        db.engine.dispose()     # connections are not shared with the parent
+        try:
+            for i in range(increments):
+                if atomic:
+                    quota.charge(1, 1)
+                else:
+                    user = User.query.get(1)
+                    user.used_storage += 1
+                db.session.commit()
+        except Exception as e:
+            errors.put("counter worker %d: %r" % (worker, e))
+
+
+def upload_worker(worker, folder_id, uploads, files, max_size, seed, errors):
+
+    """Uploads `uploads` requests of `files` files of random sizes (unique
+       contents) and deletes one of its own files after every other one.
+    """
+    random = Random(seed + worker)
+    with app.app_context():
+        db.engine.dispose()     # connections are not shared with the parent
+    # requests outside of an app context, so that each one gets its own
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['username'] = "owner"
+        session['auth_token'] = "stress"
+    try:
+        for i in range(uploads):
+            data = [(io.BytesIO(("%d-%d-%d " % (worker, i, j)).encode() * random.randint(1, max_size // 10)),
+                     "w%d-%d-%d.txt" % (worker, i, j)) for j in range(files)]
+            response = client.post("/f/%s" % folder_id, data={"auth-token": "stress", "file[]": data},
+                                   content_type="multipart/form-data")
+            if response.status_code != 302:
+                errors.put("worker %d: upload status %d" % (worker, response.status_code))
+            if i % 2:
+                with app.app_context():
+                    file = File.query.filter(File.name.like("w%d-%%" % worker)).first()
+                    if file:
+                        file.delete()
+    except Exception as e:
+        errors.put("upload worker %d: %r" % (worker, e))
+
+
+def run(target, args, workers):
+
+    # return: (seconds, List of str)
+
+    errors = Queue()
+    processes = [Process(target=target, args=(worker,) + args + (errors,)) for worker in range(workers)]
+    start = timer()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = timer() - start
+    messages = []
+    while not errors.empty():
+        messages.append(errors.get())
+    return elapsed, messages
+
+
+def check_storage(directory, limit):
+
+    # return: List of str (violated invariants)
+
+    user = User.query.get(1)
+    stored = db.session.query(db.func.coalesce(db.func.sum(File.size), 0)).scalar()
+    problems = []
+    if user.used_storage != stored:
+        problems.append("used storage %d != %d bytes of files" % (user.used_storage, stored))
+    if user.used_storage > limit:
+        problems.append("used storage %d over the quota of %d" % (user.used_storage, limit))
+    if user.reserved_storage or StorageReservation.query.count():
+        problems.append("%d bytes still reserved by %d reservation(s)" % (user.reserved_storage,
+                                                                        StorageReservation.query.count()))
+    if quota.reconcile(verify=True):
+        problems.append("reconcile_quota reports drift")
+    missing = [blob.md5 for blob in Blob.query if blob.refcount and not os.path.exists(blob.get_disk_path())]
+    if missing:
+        problems.append("%d blob(s) missing on disk" % len(missing))
+    spooled = [name for name in os.listdir(os.path.join(directory, "files")) if name.startswith(".upload-")]
+    if spooled:
+        problems.append("%d temporary upload file(s) left" % len(spooled))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--uploads", type=int, default=20, help="upload requests per worker")
+    parser.add_argument("--files", type=int, default=3, help="files per upload request")
+    parser.add_argument("--max-size", type=int, default=64 * 1024, help="largest file, in bytes")
+    parser.add_argument("--quota", type=int, default=2 * 1024 * 1024, help="the user's quota, in bytes")
+    parser.add_argument("--increments", type=int, default=200, help="counter updates per worker")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    for folder in ("files", "thumbs"):
+        os.mkdir(os.path.join(directory, folder))
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'stress.db')
+    app.config['EVENT_SINK'] = None
+    app.config['MAX_FREE_STORAGE'] = args.quota
+    # small steps, so that requests without a length contend for the quota
+    app.config['QUOTA_RESERVATION_STEP'] = 16 * 1024
+    models.site_path = directory + os.sep
+    app.root_path = directory
+    cwd = os.getcwd()
+    os.chdir(directory)
+
+    import main as routes   # declares the routes
+
+    try:
+        with app.app_context():
+            db.create_all()
+            owner = User("owner", "password")
+            db.session.add(owner)
+            db.session.commit()
+            folder = Folder("stress", owner.id)
+            db.session.add(folder)
+            db.session.commit()
+            folder_id = folder.id
+            db.session.remove()
+            db.engine.dispose()
+
+        failed = False
+        print("%d workers x %d counter updates" % (args.workers, args.increments))
+        for name, atomic in [("read-modify-write", False), ("quota.charge", True)]:
+            with app.app_context():
+                User.query.get(1).used_storage = 0
+                db.session.commit()
+                db.engine.dispose()
+            elapsed, errors = run(counter_worker, (args.increments, atomic), args.workers)
+            with app.app_context():
+                total = User.query.get(1).used_storage
+                db.engine.dispose()
+            lost = args.workers * args.increments - total
+            print("%-20s %8.2fs %6d lost update(s) %s" % (name, elapsed, lost, "; ".join(errors)))
+            failed |= atomic and (lost != 0 or bool(errors))
+
+        with app.app_context():
+            User.query.get(1).used_storage = 0
+            db.session.commit()
+            db.engine.dispose()
+        print("%d workers x %d uploads x %d files, quota %d bytes" % (args.workers, args.uploads, args.files,
+                                                                     args.quota))
+        elapsed, errors = run(upload_worker, (folder_id, args.uploads, args.files, args.max_size, args.seed),
+                              args.workers)
+        with app.app_context():
+            problems = errors + check_storage(directory, args.quota)
+            user = User.query.get(1)
+            print("%-20s %8.2fs %6d file(s) stored, %d bytes used" % ("uploads", elapsed, File.query.count(),
+                                                                       user.used_storage))
+        for problem in problems:
+            print("FAILED: " + problem)
+        failed |= bool(problems)
+        print("FAILED" if failed else "ok")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+-------------------------------------------------------------
+                    SEARCH BENCHMARK
+Compares the recursive-CTE Folder.search against the original 
+  depth-first traversal on a synthetic 10k-folder tree.
+  
+usage: python benchmarks/search_benchmark.py [folders] [files]
+-------------------------------------------------------------
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+from random import Random
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import event
+from models import app, db, User, Folder, File
+
+
+def legacy_search(folder, term, user=None):
+
+    """The depth-first traversal Folder.search used before the CTE version.
+    """
+    results = []
+    
+    def traverse(folder):
+        matched_files = File.query.filter_by(folder_id=folder.id).filter(File.name.like('%'+term+'%')).all()
+        matched_folders = Folder.query.filter_by(parent_id=folder.id).filter(Folder.name.like('%'+term+'%')).all()
+        for file in matched_files:
+            results.append(file)
+        for matched_folder in matched_folders:
+            if matched_folder.visible_to(user):
+                results.append(matched_folder)
+        for child in folder.children:
+            if child.visible_to(user):
+                traverse(child)
+                
+    traverse(folder)
+    return results
+    
+
+def build_tree(user, number_of_folders, number_of_files, seed=0):
+
+    # user: User
+    # return: Folder (the root of the generated tree)
+    
+    """Inserts a random tree of folders (up to 10 children each) with 
+       files spread across them.
+    """
+    random = Random(seed)
+    words = ["photos", "music", "docs", "backup", "misc", "stuff", "old", "new"]
+    
+    root_id = "root00000"
+    folders = [{"id": root_id, "name": "root", "user_id": user.id, "parent_id": None, 
+                "private": False, "password_protected": False}]
+    for i in range(1, number_of_folders):
+        folders.append({"id": "d%08d" % i, 
+                        "name": "%s %d" % (random.choice(words), i),
+                        "user_id": user.id,
+                        "parent_id": folders[(i - 1) // 10]["id"],
+                        "private": random.random() < 0.1,
+                        "password_protected": False})
+    db.session.bulk_insert_mappings(Folder, folders)
+    
+    files = []
+    for i in range(number_of_files):
+        name = "%s_%d.jpg" % (random.choice(words), i)
+        files.append({"id": "f%08d" % i, "name": name, "extension": "jpg",
+                      "folder_id": random.choice(folders)["id"], "size": 0,
+                      "full_name": "f%08d_%s" % (i, name)})
+    db.session.bulk_insert_mappings(File, files)
+    db.session.commit()
+    
+    return Folder.query.filter_by(id=root_id).first()
+    
+
+def measure(function, *args, **kwargs):
+
+    # return: (seconds: float, queries: int, results: int)
+    
+    queries = [0]
+    
+    def count(*args):
+        queries[0] += 1
+        
+    event.listen(db.engine, "before_cursor_execute", count)
+    try:
+        db.session.expire_all()
+        start = timer()
+        results = function(*args, **kwargs)
+        elapsed = timer() - start
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+    return elapsed, queries[0], len(results)
+    
+
+def main(number_of_folders=10000, number_of_files=20000):
+    directory = tempfile.mkdtemp()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    # the legacy traversal is uncapped, so compare against uncapped results
+    app.config['MAX_SEARCH_RESULTS'] = number_of_folders + number_of_files
+    
+    try:
+        with app.app_context():
+            db.create_all()
+            owner = User("owner", "password")
+            visitor = User("visitor", "password")
+            db.session.add_all([owner, visitor])
+            db.session.commit()
+            root = build_tree(owner, number_of_folders, number_of_files)
+            
+            print("%d folders, %d files" % (number_of_folders, number_of_files))
+            print("%-10s %-10s %10s %10s %10s" % ("method", "viewer", "seconds", "queries", "results"))
+            for viewer_name, viewer in [("owner", owner), ("visitor", visitor), ("anonymous", None)]:
+                for term in ["photos", "1"]:
+                    for name, function in [("legacy", legacy_search), ("cte", Folder.search)]:
+                        elapsed, queries, results = measure(function, root, term, user=viewer)
+                        print("%-10s %-10s %10.3f %10d %10d" % (name, viewer_name, elapsed, queries, results))
+            db.session.remove()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,322 @@
+"""
+-------------------------------------------------------------
+                    BENCHMARK SUITE
+ Times the core routes (through the Flask test client) and
+  model methods on synthetic users, folder trees and files
+  in a temporary SQLite database and upload directory, and
+  writes latency percentiles, query counts and peak memory
+          as JSON for comparison between commits.
+
+usage: python benchmarks/suite.py [--scale N] [--repeat N] [--output FILE]
+                                  [--compare BASELINE.json] [--only NAME]
+-------------------------------------------------------------
+"""
+
+import os
+import io
+import sys
+import json
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+from random import Random
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from jinja2 import ChoiceLoader, DictLoader
+from PIL import Image
+import models
+from models import app, db, User, Folder, File
+from query_counter import QueryCounter
+import thumbnails
+
+
+WORDS = ["photos", "music", "docs", "backup", "misc", "stuff", "old", "new", "drafts", "scans"]
+EXTENSIONS = ["jpg", "png", "txt", "mp3", "zip", "mov", "psd"]
+
+# the repository ships without its templates; these stand-ins touch the
+# same relationships, so query counts stay representative
+TEMPLATES = {
+    "folder.html": "{% for f in folder.get_path() %}{{ f.name }}{% endfor %}{{ folder.user.username }}"
+                   "{% for item in results.content %}{{ item.name }}{% if item.get_type() == 'Folder' %}"
+                   "{{ item.children|length }}{% else %}{{ item.folder.name }}{{ item.get_size_str() }}"
+                   "{% endif %}{% endfor %}{% if file %}{{ file.folder.user.username }}{% endif %}",
+    "user.html": "{% for f in user.get_root_folders() %}{{ f.name }}{{ f.children|length }}{% endfor %}",
+}
+
+
+def build_tree(owner_id, prefix, shape, size, random):
+
+    # shape: "wide" or "deep"
+    # return: (List of folder mappings, List of file mappings)
+
+    """A wide tree is a root with `size` subfolders and 2 * size files in
+       the root; a deep tree is a chain of `size` folders with a few files
+       at every level.
+    """
+    root = {"id": prefix + "r", "name": prefix + " root", "user_id": owner_id, "parent_id": None,
+            "tree_path": "/%sr/" % prefix}
+    folders = [root]
+    if shape == "wide":
+        for i in range(size):
+            folders.append({"id": "%sw%d" % (prefix, i), "parent": root,
+                            "name": "%s %d" % (random.choice(WORDS), i)})
+        homes = [root] * (2 * size)
+    else:
+        parent = root
+        for i in range(size):
+            parent = {"id": "%sd%d" % (prefix, i), "parent": parent,
+                      "name": "%s %d" % (random.choice(WORDS), i)}
+            folders.append(parent)
+        homes = folders * 3
+
+    for folder in folders[1:]:
+        parent = folder.pop("parent")
+        folder.update(user_id=owner_id, parent_id=parent["id"], tree_path=parent["tree_path"] + folder["id"] + "/")
+    for folder in folders:
+        folder.update(private=random.random() < 0.1, password_protected=False, date=models.datetime.utcnow(),
+                      subtree_folders=0, subtree_files=0, subtree_bytes=0)
+
+    files = []
+    for i, home in enumerate(homes):
+        extension = random.choice(EXTENSIONS)
+        name = "%s_%d.%s" % (random.choice(WORDS), i, extension)
+        files.append({"id": "%sf%d" % (prefix, i), "name": name, "extension": extension,
+                      "folder_id": home["id"], "size": random.randint(1000, 10 ** 7),
+                      "date": models.datetime.utcnow(), "type": "Other", "full_name": name,
+                      "path": os.path.join(app.config['UPLOAD_FOLDER'], name),
+                      "thumb_path": os.path.join(app.config['THUMBNAIL_FOLDER'], "other.png"),
+                      "thumb_status": thumbnails.READY})
+    return folders, files
+
+
+def populate(scale, seed):
+
+    # return: dict of the objects the cases work on
+
+    random = Random(seed)
+    owner = User("owner", "password")
+    visitor = User("visitor", "password")
+    others = [User("user%d" % i, "password") for i in range(10 * scale)]
+    db.session.add_all([owner, visitor] + others)
+    db.session.commit()
+
+    folders, files = [], []
+    for prefix, shape, size in [("a", "wide", 1000 * scale), ("b", "deep", 100 * scale)]:
+        tree = build_tree(owner.id, prefix, shape, size, random)
+        folders += tree[0]
+        files += tree[1]
+    # noise: small trees of other users
+    for i, user in enumerate(others):
+        tree = build_tree(user.id, "u%d" % i, "wide", 20, random)
+        folders += tree[0]
+        files += tree[1]
+    db.session.bulk_insert_mappings(Folder, folders)
+    db.session.bulk_insert_mappings(File, files)
+    db.session.commit()
+    Folder.rebuild_counters()
+
+    return {"owner": owner, "visitor": visitor,
+            "wide": Folder.query.get("ar"), "deep": Folder.query.get("br"),
+            "deepest": Folder.query.get("bd%d" % (100 * scale - 1))}
+
+
+def sample_image(directory, width=3000, height=2000):
+    path = os.path.join(directory, "sample.jpg")
+    noise = Image.effect_noise((width, height), 40)
+    Image.merge("RGB", (noise, noise.transpose(Image.FLIP_LEFT_RIGHT), noise)).save(path, quality=90)
+    return path
+
+
+def cases(data, client, directory):
+
+    # return: List of (name, function)
+
+    owner, visitor = data["owner"], data["visitor"]
+    wide_id, deep_id, deepest_id = data["wide"].id, data["deep"].id, data["deepest"].id
+    folder = lambda id: Folder.query.get(id)
+    upload_counter = [0]
+    image = sample_image(directory)
+
+    def upload():
+        # five unique small files and one image per request
+        upload_counter[0] += 1
+        files = [(io.BytesIO(("%d-%d" % (upload_counter[0], i)).encode()), "upload%d.txt" % i) for i in range(5)]
+        with open(image, "rb") as f:
+            files.append((io.BytesIO(f.read() + str(upload_counter[0]).encode()), "image.jpg"))
+        client.post("/f/%s" % deep_id, data={"auth-token": "benchmark", "file[]": files},
+                    content_type="multipart/form-data")
+
+    def set_thumbnail():
+        file = File("photo.jpg", deep_id)
+        file.set_thumbnail()
+
+    def make_thumbnail():
+        destinations = dict((size, os.path.join(directory, "thumb_%d.%s" % (size, thumbnails.EXTENSION)))
+                            for size in thumbnails.SIZES)
+        thumbnails.make_thumbnail(image, destinations)
+
+    return [
+        ("get_contents wide page 1", lambda: folder(wide_id).get_contents(0, 25, user=owner)),
+        ("get_contents wide page 40", lambda: folder(wide_id).get_contents(975, 25, user=owner)),
+        ("get_contents wide by name", lambda: folder(wide_id).get_contents(0, 25, sort="name", user=visitor)),
+        ("search wide owner", lambda: folder(wide_id).search("photos", user=owner)),
+        ("search deep visitor", lambda: folder(deep_id).search("music", user=visitor)),
+        ("search deep short term", lambda: folder(deep_id).search("1", user=owner)),
+        ("number_of_files_folders owner", lambda: folder(deep_id).number_of_files_folders(user=owner)),
+        ("number_of_files_folders visitor", lambda: folder(deep_id).number_of_files_folders(user=visitor)),
+        ("get_path deepest", lambda: folder(deepest_id).get_path()),
+        ("File.set_thumbnail", set_thumbnail),
+        ("thumbnails.make_thumbnail", make_thumbnail),
+        ("GET /f/<wide>", lambda: client.get("/f/%s" % wide_id)),
+        ("GET /f/<wide>?page=20", lambda: client.get("/f/%s?page=20" % wide_id)),
+        ("GET /f/<deep>?search", lambda: client.get("/f/%s?search=photos" % deep_id)),
+        ("GET /f/<deepest>", lambda: client.get("/f/%s" % deepest_id)),
+        ("GET /user", lambda: client.get("/user")),
+        ("POST /f/<deep> upload", upload),
+    ]
+
+
+def percentile(values, p):
+    # nearest-rank percentile of a sorted list
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+def peak_memory_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def measure(function, repeat):
+
+    # return: dict
+
+    latencies, queries = [], []
+    if tracemalloc:
+        tracemalloc.start()
+    for i in range(repeat):
+        db.session.expire_all()
+        with QueryCounter() as counter:
+            start = timer()
+            function()
+            latencies.append(timer() - start)
+        queries.append(counter.count)
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    else:
+        peak = peak_memory_kb()
+    latencies.sort()
+    return {
+        "repeat": repeat,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "queries": max(queries),
+        # python allocations (tracemalloc) or the process' peak RSS
+        "peak_memory_kb": peak,
+    }
+
+
+def metadata(args):
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": db.session.execute("SELECT sqlite_version()").scalar(),
+        "memory": "tracemalloc" if tracemalloc else "ru_maxrss",
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "seed": args.seed,
+    }
+
+
+def compare(baseline, results):
+
+    """Prints the p50 latency and query count of each case against a
+       previous run.
+    """
+    old = dict((case["name"], case) for case in baseline["cases"])
+    print("%-35s %12s %12s %8s %10s" % ("case", "p50 ms (old)", "p50 ms (new)", "ratio", "queries"))
+    for case in results["cases"]:
+        before = old.get(case["name"])
+        if not before:
+            continue
+        ratio = case["p50_ms"] / before["p50_ms"] if before["p50_ms"] else float("nan")
+        print("%-35s %12.2f %12.2f %8.2f %4d -> %-4d" % (case["name"], before["p50_ms"], case["p50_ms"],
+                                                         ratio, before["queries"], case["queries"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=1, help="multiplies the size of the generated data")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to write (default: stdout)")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare against")
+    parser.add_argument("--only", help="only run the cases whose name contains this")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    for folder in ("files", "thumbs"):
+        os.mkdir(os.path.join(directory, folder))
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    app.config['EVENT_SINK'] = None
+    models.site_path = directory + os.sep
+    app.root_path = directory
+    # uploads are spooled relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(directory)
+
+    import main as routes   # declares the routes
+    app.jinja_loader = ChoiceLoader([app.jinja_loader, DictLoader(TEMPLATES)])
+
+    try:
+        with app.app_context():
+            db.create_all()
+            data = populate(args.scale, args.seed)
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session['username'] = data["owner"].username
+                session['auth_token'] = "benchmark"
+
+            results = {"metadata": metadata(args), "cases": []}
+            for name, function in cases(data, client, directory):
+                if args.only and args.only not in name:
+                    continue
+                result = measure(function, args.repeat)
+                result["name"] = name
+                results["cases"].append(result)
+                sys.stderr.write("%-35s p50 %8.2f ms  p99 %8.2f ms  %3d queries\n"
+                                 % (name, result["p50_ms"], result["p99_ms"], result["queries"]))
+            db.session.remove()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(json.load(baseline), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+-------------------------------------------------------------
+                   THUMBNAIL BENCHMARK
+ Compares the original full-resolution thumbnailer against
+  thumbnails.make_thumbnail (draft decoding, all sizes from
+ one decode) on a corpus of large JPEGs. Each method runs in
+    its own process so that peak RSS can be compared.
+
+usage: python benchmarks/thumbnail_benchmark.py [images] [width] [height]
+-------------------------------------------------------------
+"""
+
+import os
+import sys
+import shutil
+import resource
+import tempfile
+from multiprocessing import Process, Queue
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PIL import Image, ImageOps
+import thumbnails
+
+
+def legacy_thumbnail(source, destinations):
+
+    """The synchronous thumbnailer File.set_thumbnail used before the
+       worker pool: full decode, 250x250 only.
+    """
+    img = Image.open(source).convert('RGB')
+    thumb = ImageOps.fit(img, (250, 250), Image.BICUBIC)
+    thumb.save(destinations[250], "JPEG", quality=100)
+
+
+def build_corpus(directory, number_of_images, width, height):
+
+    # return: List of str
+
+    """Writes synthetic photos (noise over a gradient, so they don't
+       compress to nothing) of the given size.
+    """
+    paths = []
+    for i in range(number_of_images):
+        noise = Image.effect_noise((width, height), 40 + i)
+        gradient = Image.linear_gradient("L").resize((width, height))
+        img = Image.merge("RGB", (noise, gradient, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+        path = os.path.join(directory, "image%d.jpg" % i)
+        img.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def peak_rss():
+    # return: int (kilobytes; ru_maxrss is in bytes on macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def run(function, paths, directory, queue):
+    baseline = peak_rss()
+    elapsed = 0.0
+    for i, path in enumerate(paths):
+        destinations = dict((size, os.path.join(directory, "%d_%d.%s" % (i, size, thumbnails.EXTENSION)))
+                            for size in thumbnails.SIZES)
+        start = timer()
+        function(path, destinations)
+        elapsed += timer() - start
+    output = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    queue.put((elapsed, baseline, peak_rss(), output))
+
+
+def measure(function, paths):
+
+    # return: (seconds: float, baseline RSS: int, peak RSS: int, output bytes: int)
+
+    directory = tempfile.mkdtemp()
+    try:
+        queue = Queue()
+        process = Process(target=run, args=(function, paths, directory, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(number_of_images=10, width=6000, height=4000):
+    directory = tempfile.mkdtemp()
+    try:
+        paths = build_corpus(directory, number_of_images, width, height)
+
+        print("%d images, %dx%d, output %s %s" % (number_of_images, width, height, thumbnails.FORMAT,
+                                                  "/".join(str(size) for size in thumbnails.SIZES)))
+        print("%-10s %10s %12s %12s %12s" % ("method", "seconds", "base RSS KB", "peak RSS KB", "output KB"))
+        for name, function in [("legacy", legacy_thumbnail), ("draft", thumbnails.make_thumbnail)]:
+            elapsed, baseline, peak, output = measure(function, paths)
+            print("%-10s %10.3f %12d %12d %12d" % (name, elapsed, baseline, peak, output // 1024))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,304 @@
+"""
+-------------------------------------------------------------
+                    CHUNKED UPLOADS
+  Large files sent in a series of requests, resumable after
+ a dropped connection: start, put chunks at the acknowledged
+   offset, then finalize into a normal File of the folder.
+-------------------------------------------------------------
+
+protocol (see controllers/upload_controller.py):
+
+    POST   /f/<folder id>/uploads    filename, size  -> id, offset, chunk_size
+    PUT    /uploads/<id>?offset=N    the chunk bytes -> offset
+    GET    /uploads/<id>                             -> offset, size
+    POST   /uploads/<id>/finalize                    -> file_id, url
+    DELETE /uploads/<id>
+
+The whole size is reserved against the quota when the upload starts (see
+quota.py), so it can't run out of space halfway. Chunks are appended to a
+part file under UPLOAD_FOLDER/chunks through a fixed size buffer: memory
+doesn't depend on the size of the file or of the chunks. A chunk is
+acknowledged (the offset moves past it) once it is on disk. Chunks sent at
+another offset than the acknowledged one are refused with the current
+offset, so a client that lost a response asks for it and carries on.
+
+The MD5 is computed as the chunks arrive, by the process receiving them.
+Hash state can't be handed over between processes: if consecutive chunks
+reach different workers, the part file is hashed again, in one pass, when
+the upload is finalized.
+
+An upload without a new chunk for QUOTA_RESERVATION_TIMEOUT seconds loses
+its reservation (`python models.py reconcile_quota`) and is removed by
+`python models.py expire_uploads`.
+"""
+
+import os
+import fcntl
+import threading
+from hashlib import md5
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import current_app
+import models
+import quota
+from uploads import CHUNK_SIZE
+
+
+# hash states kept by each process
+HASHES = 1000
+
+_hashes = OrderedDict()
+_lock = threading.Lock()
+
+
+class UploadError(Exception):
+
+    """A request the upload can't accept. `status` is the HTTP status to
+       answer it with.
+    """
+
+    def __init__(self, message, status):
+        super(UploadError, self).__init__(message)
+        self.status = status
+
+
+class PartFile(object):
+
+    """The received data of a finished upload, as Blob.store takes it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.moved = False
+
+    def move_to(self, path):
+        # does nothing if it was moved already (a retried transaction)
+        if not self.moved:
+            os.rename(self.path, path)
+            self.moved = True
+
+    def discard(self):
+        if not self.moved:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+def start(user, folder, filename, size):
+
+    # user: User
+    # folder: Folder
+    # filename: str
+    # size: int
+    # return: ChunkedUpload, or None if the user's quota can't hold size bytes
+
+    reservation = quota.Reservation(user)
+    if not reservation.reserve(size):
+        reservation.release()
+        return None
+
+    def create():
+        upload = models.ChunkedUpload(user.id, folder.id, filename, size, reservation.id)
+        models.db.session.add(upload)
+        models.db.session.commit()
+        return upload
+
+    upload = models.retry_on_duplicate_id(create)
+    directory = os.path.dirname(upload.get_part_path())
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created concurrently
+            pass
+    open(upload.get_part_path(), 'wb').close()
+    return upload
+
+
+def receive(upload, offset, stream, length):
+
+    # upload: ChunkedUpload
+    # offset: int - where the chunk starts
+    # stream: file-like object (the request body)
+    # length: int - bytes in the chunk
+    # return: int (the new acknowledged offset)
+
+    """Writes a chunk to the part file and acknowledges it. Raises
+       UploadError if the chunk isn't the expected one or doesn't fit.
+    """
+    if offset != upload.offset:
+        raise UploadError("expected the chunk at offset %d" % upload.offset, 409)
+    if offset + length > upload.size:
+        raise UploadError("the chunk goes past the declared size", 413)
+
+    with _locked(upload) as part:
+        # acknowledged meanwhile by the request that held the lock
+        models.db.session.refresh(upload)
+        if offset != upload.offset:
+            raise UploadError("expected the chunk at offset %d" % upload.offset, 409)
+
+        hash = _take_hash(upload.id, offset)
+        # drops what an interrupted request wrote past the acknowledged offset
+        part.seek(offset)
+        part.truncate()
+        received = 0
+        for data in iter(lambda: stream.read(min(CHUNK_SIZE, length - received)), b""):
+            part.write(data)
+            if hash:
+                hash.update(data)
+            received += len(data)
+            if received == length:
+                break
+        if received != length:
+            raise UploadError("the chunk was cut short, expected %d bytes" % length, 400)
+        part.flush()
+        os.fsync(part.fileno())
+
+        now = datetime.utcnow()
+        if upload.reservation_id is not None and not models.StorageReservation.query\
+                .filter_by(id=upload.reservation_id, user_id=upload.user_id)\
+                .update({models.StorageReservation.date: now}, synchronize_session=False):
+            models.db.session.rollback()
+            cancel(upload)
+            raise UploadError("the upload has expired", 410)
+        upload.offset = offset + length
+        upload.updated_at = now
+        models.db.session.commit()
+        _keep_hash(upload.id, upload.offset, hash)
+    return offset + length
+
+
+def finalize(upload):
+
+    # upload: ChunkedUpload
+    # return: File, or None if the folder already has a file with the same data
+
+    """Stores the received data as a new file of the upload's folder (in
+       one transaction, which also charges the user's storage).
+    """
+    Folder, File = models.Folder, models.File
+    with _locked(upload):
+        models.db.session.refresh(upload)
+        if upload.offset != upload.size:
+            raise UploadError("%d of %d bytes received" % (upload.offset, upload.size), 409)
+        folder = Folder.query.get(upload.folder_id)
+        if folder is None:
+            cancel(upload)
+            raise UploadError("the folder was deleted", 410)
+        digest = _digest(upload)
+        if File.query.filter_by(folder_id=folder.id).filter_by(md5=digest).count() > 0:
+            cancel(upload)
+            return None
+        part = PartFile(upload.get_part_path())
+        return models.retry_on_duplicate_id(lambda: _store(upload, folder, digest, part))
+
+
+def _store(upload, folder, digest, part):
+
+    # upload: ChunkedUpload
+    # folder: Folder
+    # digest: str
+    # part: PartFile
+    # return: File
+
+    File, Blob, db = models.File, models.Blob, models.db
+    new_file = File(upload.filename, folder.id)
+    # data already on the server is shared instead of stored twice
+    new_file.set_blob(Blob.store(digest, upload.size, part))
+    folder.add_file(new_file, commit=False)
+    new_file.set_size(upload.size, commit=False)
+    # the reservation becomes used storage
+    if upload.reservation_id is not None:
+        quota.release(db.session, upload.reservation_id, upload.user_id)
+    db.session.delete(upload)
+    folder.update()
+    return new_file
+
+
+def cancel(upload):
+
+    # upload: ChunkedUpload
+
+    """Deletes an unfinished upload, its data and its reservation."""
+    db = models.db
+    if upload.reservation_id is not None:
+        quota.release(db.session, upload.reservation_id, upload.user_id)
+    db.session.delete(upload)
+    db.session.commit()
+    _take_hash(upload.id, None)
+    PartFile(upload.get_part_path()).discard()
+
+
+def expire(timeout=None):
+
+    # timeout: int - seconds (defaults to QUOTA_RESERVATION_TIMEOUT)
+    # return: int
+
+    """Cancels the uploads that received no chunk for timeout seconds.
+       Returns their number.
+    """
+    if timeout is None:
+        timeout = current_app.config['QUOTA_RESERVATION_TIMEOUT']
+    ChunkedUpload = models.ChunkedUpload
+    before = datetime.utcnow() - timedelta(seconds=timeout)
+    expired = ChunkedUpload.query.filter(ChunkedUpload.updated_at < before).all()
+    for upload in expired:
+        cancel(upload)
+    return len(expired)
+
+
+@contextmanager
+def _locked(upload):
+
+    # upload: ChunkedUpload
+    # yields: file (the part file, open for writing)
+
+    # one request at a time per upload (on this host)
+    try:
+        part = open(upload.get_part_path(), 'r+b')
+    except IOError:
+        raise UploadError("the upload has expired", 410)
+    with part:
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise UploadError("another request is writing to the upload", 409)
+        yield part
+
+
+def _take_hash(id, offset):
+
+    # id: str
+    # offset: int
+    # return: md5 object or None
+
+    # the hash of the first offset bytes, if this process has it
+    with _lock:
+        hashed, hash = _hashes.pop(id, (None, None))
+    if offset == 0:
+        return md5()
+    return hash if hashed == offset else None
+
+
+def _keep_hash(id, offset, hash):
+    if hash is None:
+        return
+    with _lock:
+        _hashes[id] = (offset, hash)
+        while len(_hashes) > HASHES:
+            _hashes.popitem(last=False)
+
+
+def _digest(upload):
+
+    # upload: ChunkedUpload
+    # return: str
+
+    hash = _take_hash(upload.id, upload.size)
+    if hash is None:
+        hash = md5()
+        with open(upload.get_part_path(), 'rb') as part:
+            for data in iter(lambda: part.read(CHUNK_SIZE), b""):
+                hash.update(data)
+    return hash.hexdigest()
@@ -16,30 +16,76 @@ def actions():
     return_folder = Folder.query.filter_by(id=return_id).first()
     selected_folders = request.form.getlist('folder')
     selected_files = request.form.getlist('file')
-    failed_files = []
-    
+
+    # validation check - want to make sure that supplied folders and files actually exist and belong to the user
+    folders = Folder.query.filter(Folder.id.in_(selected_folders)).all() if selected_folders else []
+    folders = [folder for folder in folders if folder.user == get_user()]
+    failed_folders = set(selected_folders) - set(folder.id for folder in folders)
+    for folder_id in failed_folders:
+        flash("Cannot modify folder " + folder_id + ": invalid folder ID", "error")
+
+    files = File.with_profile("view").filter(File.id.in_(selected_files)).all() if selected_files else []
+    files = [file for file in files if file.folder.user == get_user()]
+    failed_files = set(selected_files) - set(file.id for file in files)
+    if failed_files:
+        flash("Cannot modify files " + " ".join(sorted(failed_files)) + ": invalid file ID", "error")
+
     # handle deletions
-    if request.form['delete']:
-        for folder_id in selected_folders:
-            folder = Folder.query.filter_by(id=folder_id).first()
-            # validation check - want to make sure that supplied folder actually exists and belongs to the user
-            if not folder or not folder.user == get_user():
-                flash("Cannot delete folder " + folder_id + ": invalid folder ID", "error")
-            else:
-                folder.delete()
-
-        for file_id in selected_files:
-            file = File.query.filter_by(id=file_id).first()
-            if not file or not file.folder.user == get_user():
-                failed_files.append(file)
-            else:
-                file.delete()
-        
-        if failed_files:
-            flash("Cannot delete files " + " ".join([ f.id for f in failed_files ]) + ": invalid file ID", "error")
+    if request.form.get('delete'):
+        delete(folders, files)
+
+    # handle moves
+    elif request.form.get('move'):
+        destination = Folder.query.filter_by(id=request.form.get('destination')).first()
+        if not destination or not destination.user == get_user():
+            flash("Cannot move to folder: invalid folder ID", "error")
+        else:
+            move(folders, files, destination)
+
     if return_id:
         return redirect(url_for('folder', id=return_id))
     else:
         return redirect(url_for('user'))
-        
-    
\ No newline at end of file
+
+
+def delete(folders, files):
+
+    # folders: List of Folder
+    # files: List of File
+
+    """Deletes the selected folders and files in one transaction. Selections
+       inside a selected folder are deleted along with it.
+    """
+
+    deleted_paths = []
+    for folder in sorted(folders, key=lambda folder: len(folder.tree_path)):
+        if not any(folder.tree_path.startswith(path) for path in deleted_paths):
+            deleted_paths.append(folder.tree_path)
+            folder.delete(commit=False)
+
+    file_ids = [file.id for file in files
+                if not any(file.folder.tree_path.startswith(path) for path in deleted_paths)]
+    if file_ids:
+        File.delete_many(File.id.in_(file_ids))
+    db.session.commit()
+
+
+def move(folders, files, destination):
+
+    # folders: List of Folder
+    # files: List of File
+    # destination: Folder
+
+    """Moves the selected folders and files into destination in one
+       transaction.
+    """
+
+    for folder in folders:
+        if folder.id == destination.id:
+            flash("Cannot move folder " + folder.name + " into itself", "error")
+        elif folder.parent_id != destination.id and not folder.set_parent(destination, commit=False):
+            flash("Cannot move folder " + folder.name + " into one of its own subfolders", "error")
+    if files:
+        File.move_many(File.id.in_([file.id for file in files]), destination)
+    destination.update(commit=False)
+    db.session.commit()
@@ -11,6 +11,7 @@ from models import *
 from flask import redirect, url_for, flash, request, abort, render_template
 from helper_functions import get_user, valid_username, generate_random_string
 from sqlalchemy import desc, func
+from sqlalchemy.exc import IntegrityError
 
 
 def register():
@@ -42,11 +43,19 @@ def register():
             
         
         else:
-            new_user = User(username, password)
-            new_folder = Folder("Default", new_user.id)
-            new_user.folders.append(new_folder)
-            db.session.add(new_user, new_folder)
-            db.session.commit()
+            def create_user():
+                new_user = User(username, password)
+                new_folder = Folder("Default", new_user.id)
+                new_user.folders.append(new_folder)
+                db.session.add(new_user, new_folder)
+                db.session.commit()
+                
+            try:
+                retry_on_duplicate_id(create_user)
+            except IntegrityError:
+                # registered by someone else since the check above
+                flash("Username is already taken", 'error')
+                return redirect('register')
 
             session['username'] = request.form['username']
             session['auth_token'] = helper_functions.generate_random_string(30)
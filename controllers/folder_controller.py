@@ -7,8 +7,13 @@ For general routines such as displaying folders, searching them,
 """
 from flask_sqlalchemy import SQLAlchemy
 from models import *
-from flask import redirect, url_for, flash, request, abort, render_template
-from helper_functions import get_user, valid_file
+from flask import redirect, url_for, flash, request, abort, render_template, make_response
+from helper_functions import get_user, valid_file, log_data
+import uploads
+import events
+import folder_zip
+import page_cache
+import quota
 
 site_path = ''
 def folder_add(id=None):
@@ -46,13 +51,17 @@ def folder_add(id=None):
         if request.form.get('extends-permissions'):
             extends_permissions = True
 
-        new_folder = Folder(name, user.id, private=private, password=password, 
-                            password_protected=password_protected, 
-                            extends_permissions=extends_permissions)
-        db.session.add(new_folder)
-        if folder:
-            new_folder.set_parent(folder)
-        db.session.commit()
+        def create_folder():
+            new_folder = Folder(name, user.id, private=private, password=password, 
+                                password_protected=password_protected, 
+                                extends_permissions=extends_permissions)
+            db.session.add(new_folder)
+            if folder:
+                new_folder.set_parent(folder)
+            db.session.commit()
+            return new_folder
+            
+        new_folder = retry_on_duplicate_id(create_folder)
         
         return redirect(url_for('folder', id=new_folder.id))
     return render_template('folder_add.html', user=user, folder=folder)
@@ -60,7 +69,7 @@ def folder_add(id=None):
 def show_folder(id):
 
     user = get_user()
-    folder = Folder.query.filter_by(id=id).first()
+    folder = Folder.with_profile("page").filter_by(id=id).first()
     file_id = request.args.get("file_id")
     
     # redirect user if supplied id is invalid
@@ -82,8 +91,6 @@ def show_folder(id):
         if not auth_token == user.get_auth_token():
             abort(401)
             
-        new_files = []
-
         files = request.files.getlist('file[]')
         
         if len(files) > 60:
@@ -94,36 +101,50 @@ def show_folder(id):
             flash("No files selected.", "error")
             return redirect(url_for('folder', id=folder.id))
         
-        failed_files = {
-                        "invalid": [],
-                        "duplicate": [],
-                        "insufficient_space": [],
-                       }
+        # the files were hashed and sized while they were being received
+        received = [(file, uploads.ingest(file) if file and valid_file(file.filename) else None) 
+                    for file in files]
+        
+        def store_files():
+        
+            # return: (new files: List of File, failed files: Dict of str -> List of str)
+            
+            # runs again with new ids if one of them is taken (moving or 
+            # discarding an upload twice does nothing)
+            new_files = []
+            failed_files = {
+                            "invalid": [],
+                            "duplicate": [],
+                            "insufficient_space": [],
+                           }
+            ids = File.allocate_ids(len(received))
                        
-        for file in files:
-            if file and valid_file(file.filename):
-                # add new submission to the database
-                new_file = File(file.filename, folder.id)
-                file.save(site_path+new_file.path)
-                new_file.set_thumbnail()
-                db.session.add(new_file)
-                db.session.commit()
-                new_file.set_size()
-                new_file.set_md5()
-                new_file.check_duplicates()
-                
-                if File.query.filter_by(folder_id=folder.id).filter_by(md5=new_file.md5).count() > 1:
-                    failed_files["duplicate"].append(file.filename)
-                    new_file.delete()
-                elif not user.space_available(new_file.size):
+            for (file, upload), id in zip(received, ids):
+                if upload is None:
+                    failed_files["invalid"].append(file.filename)
+                elif upload.over_quota:
                     failed_files["insufficient_space"].append(file.filename)
-                    new_file.delete()
+                    upload.discard()
+                elif File.query.filter_by(folder_id=folder.id).filter_by(md5=upload.md5).count() > 0:
+                    failed_files["duplicate"].append(file.filename)
+                    upload.discard()
                 else:
+                    # add new submission to the database
+                    new_file = File(file.filename, folder.id, id=id)
+                    # data already on the server is shared instead of stored twice
+                    new_file.set_blob(Blob.store(upload.md5, upload.size, upload))
+                    folder.add_file(new_file, commit=False)
+                    new_file.set_size(upload.size, commit=False)
                     new_files.append(new_file)
-                    folder.update()
                     
-            else:
-                failed_files["invalid"].append(file.filename)
+            # one commit for the whole batch, which also turns the space 
+            # reserved while receiving the files into used storage
+            if new_files:
+                quota.reservation().settle()
+                folder.update()
+            return new_files, failed_files
+            
+        new_files, failed_files = retry_on_duplicate_id(store_files)
             
         if failed_files["invalid"]:
             flash("Could not upload the following files (invalid type): " + \
@@ -145,7 +166,7 @@ def show_folder(id):
     else:
         search = None
         recursive = False
-    
+        
     # get/sanitize the page number
     page = request.args.get("page")
     
@@ -153,26 +174,51 @@ def show_folder(id):
         page = max(1, int(page))
     except:
         page = 1
+        
+    sort = (request.args.get("sort") or "").lower()
+    if not sort in ["date", "name", "type", "relevance"]:
+        sort = "relevance" if search else "date"
+    after_id = request.args.get("after")
+    
+    # anonymous visitors share the rendered page (see page_cache.py)
+    cache_key = None
+    if not search:
+        cache_key = page_cache.key(folder, user, sort, str(page), after_id, file_id)
+    if cache_key:
+        html = page_cache.lookup(cache_key)
+        if html is not None:
+            return html
     
     if file_id:
-        file = File.query.filter_by(id=file_id).first()
+        file = File.with_profile("view").filter_by(id=file_id).first()
     else:
         file = None
+        
+    # keyset pagination: id of the last item of the previous page
+    if after_id:
+        after = File.query.filter_by(id=after_id, folder_id=folder.id).first() or \
+                Folder.query.filter_by(id=after_id, parent_id=folder.id).first()
+    else:
+        after = None
     
     if file_id and (not file or not file.folder.visible_to(user)):
         flash("Invalid file ID", 'error')
-    sort = request.args.get("sort")
-    if not sort or not sort.lower() in ["date", "name", "type"]:
-        sort = "date"
     num_files_folders = folder.number_of_files_folders(user=user)
     per_page = 25
     results = folder.get_contents((page - 1) * per_page, per_page, sort=sort, search=search, 
-                                    selected_file=file, recursive=recursive, user=user)
+                                    selected_file=file, recursive=recursive, user=user, after=after)
+    # pages past the last, or after an unknown item, show another page:
+    # they're not cached, so only pages that exist are
+    if page > max(1, results["total_pages"]) or (after_id and not after):
+        cache_key = None
     page = min(results["total_pages"], page)
    
-    return render_template("folder.html", folder=folder, user=user, file=file, 
+    html = render_template("folder.html", folder=folder, user=user, file=file, 
                             num_files_folders=num_files_folders, page=page, sort=sort, 
                             per_page=per_page, search=search, results=results)
+    if cache_key:
+        page_cache.store(cache_key, html)
+    return html
     
     
 def folder_settings(id):
@@ -217,7 +263,8 @@ def folder_settings(id):
         folder.extends_permissions = extends_permissions
         folder.private = private
         folder.name = name
-        
+        # names and visibility show on the pages of the whole subtree
+        folder.invalidate_pages(subtree=True)
                 
         db.session.commit()
         flash('Successfully updated folder.', 'success')
@@ -228,3 +275,27 @@ def show_all_folders():
     user = get_user()
     return render_template("user.html", user=user)
     
+
+
+def download_folder(id):
+
+    """Sends the folder, with the subfolders the user can see, as a zip
+       archive (see folder_zip.py).
+    """
+    user = get_user()
+    folder = Folder.query.filter_by(id=id).first()
+    if not folder:
+        abort(404)
+    if folder.password_protected and not folder.visible_to(user):
+        return redirect(url_for('folder_authenticate', id=folder.id))
+    if not folder.visible_to(user):
+        abort(404)
+
+    response = folder_zip.send(folder, user)
+    if response is None:
+        response = make_response("Too many folder downloads in progress, try again later.", 503)
+        response.headers['Retry-After'] = "30"
+        return response
+    log_data(user_id=user.id if user else None, ip=request.remote_addr,
+             type=events.FOLDER_DOWNLOAD, folder_id=folder.id, file_id=None)
+    return response
@@ -0,0 +1,103 @@
+"""
+-------------------------------------------------------------
+                    UPLOAD CONTROLLER
+   JSON endpoints of the chunked, resumable upload protocol
+                 (see chunked_uploads.py).
+-------------------------------------------------------------
+"""
+from models import *
+from flask import url_for, request, abort, jsonify, current_app
+from helper_functions import get_user, valid_file
+import chunked_uploads
+
+
+def check_auth_token(user):
+    # the chunks are raw request bodies: the token comes in a header
+    token = request.headers.get('X-Auth-Token')
+    if not token and request.method == "POST":
+        token = request.form.get('auth-token')
+    if not token or token != user.get_auth_token():
+        abort(401)
+
+
+def get_upload(id):
+
+    # return: ChunkedUpload of the current user
+
+    user = get_user()
+    upload = ChunkedUpload.query.filter_by(id=id).first()
+    if not upload or upload.user_id != user.id:
+        abort(404)
+    check_auth_token(user)
+    return upload
+
+
+def error(message, status, **fields):
+    response = jsonify(error=message, **fields)
+    response.status_code = status
+    return response
+
+
+def start_upload(folder_id):
+    user = get_user()
+    folder = Folder.query.filter_by(id=folder_id).first()
+    if not folder:
+        abort(404)
+    if not folder.user == user:
+        abort(401)
+    check_auth_token(user)
+
+    filename = request.form.get('filename', '')
+    size = request.form.get('size', type=int)
+    if not valid_file(filename):
+        return error("invalid file type", 400)
+    if size is None or size < 0:
+        return error("the size of the file is required", 400)
+
+    upload = chunked_uploads.start(user, folder, filename, size)
+    if upload is None:
+        return error("insufficient storage space", 413)
+    response = jsonify(id=upload.id, offset=upload.offset, size=upload.size,
+                       chunk_size=current_app.config['CHUNKED_UPLOAD_CHUNK_SIZE'])
+    response.status_code = 201
+    return response
+
+
+def upload_status(id):
+    upload = get_upload(id)
+    return jsonify(id=upload.id, offset=upload.offset, size=upload.size)
+
+
+def put_chunk(id):
+    upload = get_upload(id)
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return error("the offset of the chunk is required", 400, offset=upload.offset)
+    if request.content_length is None:
+        return error("the length of the chunk is required", 411, offset=upload.offset)
+    try:
+        offset = chunked_uploads.receive(upload, offset, request.stream, request.content_length)
+    except chunked_uploads.UploadError as e:
+        if e.status == 410:
+            return error(str(e), e.status)
+        return error(str(e), e.status, offset=upload.offset)
+    return jsonify(id=id, offset=offset, size=upload.size)
+
+
+def finalize_upload(id):
+    upload = get_upload(id)
+    folder_id = upload.folder_id
+    try:
+        file = chunked_uploads.finalize(upload)
+    except chunked_uploads.UploadError as e:
+        return error(str(e), e.status)
+    if file is None:
+        return error("file already exists in folder", 409)
+    response = jsonify(file_id=file.id, url=url_for('folder', id=folder_id, file_id=file.id))
+    response.status_code = 201
+    return response
+
+
+def cancel_upload(id):
+    chunked_uploads.cancel(get_upload(id))
+    return jsonify(id=id)
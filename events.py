@@ -0,0 +1,244 @@
+"""
+-------------------------------------------------------------
+                        EVENTS
+  Download/event logging off the request path. Events are put
+ on a bounded in-memory queue and written in batches by a
+  background thread, either to the event table or to an
+            append-only local file.
+-------------------------------------------------------------
+
+EVENT_SINK selects where batches go:
+
+    'database'  bulk INSERT into the event table
+    'file'      one JSON line per event appended to EVENT_LOG_PATH, loaded
+                into the event table by the aggregation job
+    None        events are discarded
+
+When the queue is full, log() waits at most EVENT_QUEUE_TIMEOUT seconds
+for room (backpressure) and then drops the event; stats() reports how many
+events were logged, dropped, written, and lost to failed writes.
+
+usage: python models.py aggregate_events
+
+rolls the raw download events of past days into per-file daily counts
+(DownloadCount, also indexed by folder), and the zip downloads of folders
+into per-folder daily counts (FolderDownloadCount).
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+from datetime import datetime
+try:
+    from queue import Queue, Full, Empty
+except ImportError:
+    from Queue import Queue, Full, Empty
+import models
+
+
+# event types
+DOWNLOAD = 3
+# a folder downloaded as a zip archive (file_id is None)
+FOLDER_DOWNLOAD = 4
+
+FIELDS = ("type", "user_id", "ip", "folder_id", "file_id", "date")
+
+_queue = None
+_pid = None
+_lock = threading.Lock()
+_stats = {"logged": 0, "dropped": 0, "written": 0, "failed": 0}
+
+
+def log(**event):
+
+    """
+        event: type, user_id, ip, folder_id, file_id
+
+        Queues an event for the background writer. Never blocks for more
+        than EVENT_QUEUE_TIMEOUT seconds.
+    """
+
+    config = models.app.config
+    if not config['EVENT_SINK']:
+        return
+    event.setdefault("date", datetime.utcnow())
+    try:
+        _get_queue().put(event, timeout=config['EVENT_QUEUE_TIMEOUT'])
+    except Full:
+        _count("dropped")
+        return
+    _count("logged")
+
+
+def stats():
+
+    # return: Dict of str -> int
+
+    with _lock:
+        stats = dict(_stats)
+    stats["queued"] = _queue.qsize() if _queue else 0
+    return stats
+
+
+def flush(timeout=None):
+
+    # timeout: float (None to wait until done)
+
+    """Blocks until every queued event has been written."""
+    if _queue is None:
+        return
+    if timeout is None:
+        _queue.join()
+        return
+    deadline = time.time() + timeout
+    while _queue.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def _count(name, n=1):
+    with _lock:
+        _stats[name] += n
+
+
+def _get_queue():
+
+    # return: Queue
+
+    """Returns the queue of this process, starting its writer thread on
+       first use (and again in a forked worker, where the thread of the
+       parent doesn't exist).
+    """
+    global _queue, _pid
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                _queue = Queue(models.app.config['EVENT_QUEUE_SIZE'])
+                writer = threading.Thread(target=_write_batches, args=(_queue,), name="event-writer")
+                writer.daemon = True
+                writer.start()
+                _pid = os.getpid()
+    return _queue
+
+
+def _write_batches(queue):
+    config = models.app.config
+    while True:
+        batch = [queue.get()]
+        deadline = time.time() + config['EVENT_FLUSH_INTERVAL']
+        while len(batch) < config['EVENT_BATCH_SIZE']:
+            try:
+                batch.append(queue.get(timeout=max(deadline - time.time(), 0)))
+            except Empty:
+                break
+        try:
+            write(batch)
+            _count("written", len(batch))
+        except Exception:
+            _count("failed", len(batch))
+            models.app.logger.exception("could not write %d event(s)", len(batch))
+        finally:
+            for event in batch:
+                queue.task_done()
+
+
+def write(batch):
+
+    # batch: List of Dict
+
+    sink = models.app.config['EVENT_SINK']
+    rows = [dict((field, event.get(field)) for field in FIELDS) for event in batch]
+    if sink == 'database':
+        models.db.engine.execute(models.Event.__table__.insert(), rows)
+    elif sink == 'file':
+        lines = []
+        for row in rows:
+            row["date"] = row["date"].isoformat()
+            lines.append(json.dumps(row) + "\n")
+        with open(models.app.config['EVENT_LOG_PATH'], "a") as log_file:
+            log_file.write("".join(lines))
+
+
+def import_log_file():
+
+    # return: int
+
+    """Moves the events of the append-only log file into the event table.
+       The file is renamed first, so writers start a new one meanwhile.
+       Returns the number of events imported.
+    """
+    path = models.app.config['EVENT_LOG_PATH']
+    processing = path + ".processing"
+    if not os.path.exists(processing):
+        if not os.path.exists(path):
+            return 0
+        os.rename(path, processing)
+
+    rows = []
+    with open(processing) as log_file:
+        for line in log_file:
+            if not line.endswith("\n"):
+                # partial line of an interrupted write
+                continue
+            row = json.loads(line)
+            row["date"] = datetime.strptime(row["date"].split(".")[0], "%Y-%m-%dT%H:%M:%S")
+            rows.append(row)
+    if rows:
+        models.db.session.execute(models.Event.__table__.insert(), rows)
+    models.db.session.commit()
+    os.remove(processing)
+    return len(rows)
+
+
+def aggregate(today=None):
+
+    # today: date
+    # return: int
+
+    """Adds the download events of the days before `today` to the daily
+       counts and deletes them. Returns the number of events rolled up.
+    """
+    Event, DownloadCount = models.Event, models.DownloadCount
+    FolderDownloadCount = models.FolderDownloadCount
+    today = today or datetime.utcnow().date()
+    if models.app.config['EVENT_SINK'] == 'file':
+        import_log_file()
+
+    # events written while this runs are left for the next run
+    last_id = models.db.session.query(models.func.max(Event.id)).scalar() or 0
+    midnight = datetime(today.year, today.month, today.day)
+    past = Event.query.filter(Event.date < midnight).filter(Event.id <= last_id)
+
+    counts = {}
+    for file_id, folder_id, event_date in past.filter(Event.type == DOWNLOAD).with_entities(Event.file_id, Event.folder_id,
+                                                                  Event.date).yield_per(1000):
+        key = (event_date.date(), file_id)
+        counts[key] = (folder_id, counts.get(key, (None, 0))[1] + 1)
+
+    for (day, file_id), (folder_id, n) in counts.items():
+        updated = DownloadCount.query.filter_by(day=day, file_id=file_id)\
+                                     .update({DownloadCount.downloads: DownloadCount.downloads + n},
+                                             synchronize_session=False)
+        if not updated:
+            models.db.session.add(DownloadCount(day, file_id, folder_id, n))
+
+    counts = {}
+    for folder_id, event_date in past.filter(Event.type == FOLDER_DOWNLOAD)\
+                                     .with_entities(Event.folder_id, Event.date).yield_per(1000):
+        key = (event_date.date(), folder_id)
+        counts[key] = counts.get(key, 0) + 1
+
+    for (day, folder_id), n in counts.items():
+        updated = FolderDownloadCount.query.filter_by(day=day, folder_id=folder_id)\
+            .update({FolderDownloadCount.downloads: FolderDownloadCount.downloads + n}, synchronize_session=False)
+        if not updated:
+            models.db.session.add(FolderDownloadCount(day, folder_id, n))
+
+    rolled_up = past.filter(Event.type.in_((DOWNLOAD, FOLDER_DOWNLOAD))).delete(synchronize_session=False)
+    models.db.session.commit()
+    return rolled_up
+
+
+# write what's left when the process exits
+atexit.register(flush, 5)
@@ -0,0 +1,269 @@
+"""
+-------------------------------------------------------------
+                       FOLDER ZIP
+  Download of a folder and its visible subfolders as a zip
+  archive, generated while it is sent with constant memory.
+-------------------------------------------------------------
+
+The subtree is walked with the permissions of the folder listings and
+search (Folder.subtree): branches the visitor can't see are left out.
+The names and paths of the entries are loaded up front, in two queries,
+then the database is let go of and the data is streamed file by file
+through a fixed size buffer.
+
+ZipStream writes the archive sequentially, without seeking: every entry
+is followed by a data descriptor with its CRC and sizes, and entries past
+the 32-bit limits of the format get ZIP64 records. Files that are
+compressed already (STORED_EXTENSIONS) are stored as they are, the others
+are deflated.
+
+A download holds a worker for as long as it runs, so each process runs at
+most ZIP_MAX_JOBS of them at a time; other requests get a 503 with a
+Retry-After header.
+"""
+
+import os
+import zlib
+import struct
+import threading
+from datetime import datetime
+from werkzeug.utils import secure_filename
+import models
+
+
+CHUNK_SIZE = 64 * 1024
+
+COMPRESSION_LEVEL = 6
+
+# formats that don't gain from deflating
+STORED_EXTENSIONS = set(["jpg", "jpeg", "png", "gif", "webm", "wmv", "avi", "mov", "mp3", "ogg",
+                         "mpg", "mpeg", "zip", "rar", "7z"])
+
+STORED, DEFLATED = 0, 8
+# data descriptor follows the data, names are UTF-8
+FLAGS = 0x08 | 0x800
+# made by: unix, spec version 2.0 (4.5 with ZIP64 records)
+VERSION_MADE_BY = 3 << 8 | 20
+
+# sizes, offsets and entry counts from which ZIP64 records are written; the
+# 32 and 16-bit fields are then set to all ones
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+_slots = None
+_lock = threading.Lock()
+
+
+class ZipStream(object):
+
+    """
+        Sequential zip writer. file() and directory() return the bytes of
+        one entry as an iterator, finish() those of the central directory.
+
+        example usage:
+
+            zip = ZipStream()
+            for chunk in zip.file(u"docs/a.txt", datetime.utcnow(), open(path, 'rb'), size):
+                output.write(chunk)
+            for chunk in zip.finish():
+                output.write(chunk)
+    """
+
+    def __init__(self):
+        self.offset = 0
+        # (name, time, date, method, crc, compressed size, size, offset, external attributes, zip64)
+        self.entries = []
+
+    def _written(self, data):
+        self.offset += len(data)
+        return data
+
+    def directory(self, name, date):
+        # name: unicode (without a trailing slash)
+        # date: datetime
+        return self._entry(name + u"/", date, None, 0, False, 0o40755 << 16 | 0x10)
+
+    def file(self, name, date, source, size, compress=True):
+        # name: unicode
+        # date: datetime
+        # source: file-like object (read until empty)
+        # size: int - bytes that will be read from source
+        # compress: bool
+        return self._entry(name, date, source, size, compress, 0o100644 << 16)
+
+    def _entry(self, name, date, source, size, compress, attributes):
+        name = name.encode('utf-8')
+        time, date = dos_date_time(date)
+        method = DEFLATED if compress else STORED
+        offset = self.offset
+        # deflate can grow incompressible data by a little
+        zip64 = size + size // 1000 + 64 >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b""
+        unknown = 0xFFFFFFFF if zip64 else 0
+        yield self._written(struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, FLAGS, method,
+                                        time, date, 0, unknown, unknown, len(name), len(extra)) + name + extra)
+
+        crc, compressed, written = 0, 0, 0
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15) if compress else None
+        if source is not None:
+            for data in iter(lambda: source.read(CHUNK_SIZE), b""):
+                crc = zlib.crc32(data, crc)
+                written += len(data)
+                if compressor:
+                    data = compressor.compress(data)
+                if data:
+                    compressed += len(data)
+                    yield self._written(data)
+        if compressor:
+            data = compressor.flush()
+            compressed += len(data)
+            yield self._written(data)
+        crc &= 0xFFFFFFFF
+
+        yield self._written(struct.pack('<IIQQ' if zip64 else '<IIII', 0x08074b50, crc, compressed, written))
+        self.entries.append((name, time, date, method, crc, compressed, written, offset, attributes, zip64))
+
+    def finish(self):
+        start = self.offset
+        for name, time, date, method, crc, compressed, size, offset, attributes, zip64 in self.entries:
+            # values too large for their field are in the ZIP64 extra field, in this order
+            large = [value for value in (size, compressed, offset) if value >= ZIP64_LIMIT]
+            extra = struct.pack('<HH' + 'Q' * len(large), 1, 8 * len(large), *large) if large else b""
+            size, compressed, offset = [0xFFFFFFFF if value >= ZIP64_LIMIT else value
+                                        for value in (size, compressed, offset)]
+            yield self._written(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, VERSION_MADE_BY,
+                                            45 if zip64 or large else 20, FLAGS, method, time, date, crc,
+                                            compressed, size, len(name), len(extra), 0, 0, 0, attributes,
+                                            offset) + name + extra)
+
+        count, size = len(self.entries), self.offset - start
+        zip64 = count >= ZIP64_COUNT_LIMIT or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT
+        if zip64:
+            end = self.offset
+            yield self._written(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, VERSION_MADE_BY, 45, 0, 0,
+                                            count, count, size, start))
+            yield self._written(struct.pack('<IIQI', 0x07064b50, 0, end, 1))
+            count, size, start = 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF
+        yield self._written(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, size, start, 0))
+
+
+def dos_date_time(date):
+
+    # date: datetime
+    # return: (int, int) - MS-DOS time and date
+
+    date = max(date or datetime.utcnow(), datetime(1980, 1, 1))
+    return (date.hour << 11 | date.minute << 5 | date.second // 2,
+            (date.year - 1980) << 9 | date.month << 5 | date.day)
+
+
+def entry_name(name):
+    # a name can't reach outside of its folder in the archive
+    name = name.replace(u"/", u"_").replace(u"\\", u"_").strip()
+    return u"_" if name in (u"", u".", u"..") else name
+
+
+def entries(folder, user):
+
+    # folder: Folder
+    # user: User
+    # return: List of (path: unicode, date: datetime, file path: str or None - None for folders)
+
+    """Returns the folders and files of the archive of folder, as the user
+       sees them, folders before their contents.
+    """
+    db, Folder, File = models.db, models.Folder, models.File
+    ids = db.session.query(folder.subtree(user).c.id)
+    folders = db.session.query(Folder.id, Folder.parent_id, Folder.name, Folder.date)\
+                        .filter(Folder.id.in_(ids)).order_by(Folder.tree_path).all()
+    files = db.session.query(File.folder_id, File.name, File.date, File.path)\
+                      .filter(File.folder_id.in_(ids)).order_by(File.folder_id, File.name).all()
+
+    paths = {}
+    taken = set()
+    result = []
+
+    def add(directory, name, date, path):
+        # same names in a folder get a number: "name (2).ext"
+        stem, extension = os.path.splitext(name)
+        candidate, number = name, 1
+        while (directory + candidate).lower() in taken:
+            number += 1
+            candidate = u"%s (%d)%s" % (stem, number, extension)
+        taken.add((directory + candidate).lower())
+        result.append((directory + candidate, date, path))
+        return directory + candidate
+
+    # tree_path order: parents come first
+    for id, parent_id, name, date in folders:
+        directory = paths[parent_id] + u"/" if id != folder.id else u""
+        paths[id] = add(directory, entry_name(name), date, None)
+    for folder_id, name, date, path in files:
+        add(paths[folder_id] + u"/", entry_name(name), date, path)
+    return result
+
+
+def stream(entries):
+
+    # entries: List of (path, date, file path) (see entries())
+    # yields: str
+
+    zip = ZipStream()
+    for name, date, path in entries:
+        if path is None:
+            for data in zip.directory(name, date):
+                yield data
+            continue
+        try:
+            source = open(models.site_path + path, 'rb')
+        except IOError:
+            # removed since the listing was read
+            continue
+        with source:
+            size = os.fstat(source.fileno()).st_size
+            compress = name.split(u".")[-1].lower() not in STORED_EXTENSIONS
+            for data in zip.file(name, date, source, size, compress=compress):
+                yield data
+    for data in zip.finish():
+        yield data
+
+
+def acquire():
+
+    # return: bool
+
+    """Takes one of the ZIP_MAX_JOBS download slots of this process.
+       Returns False if they're all taken.
+    """
+    global _slots
+    if _slots is None:
+        with _lock:
+            if _slots is None:
+                _slots = threading.BoundedSemaphore(models.app.config['ZIP_MAX_JOBS'])
+    return _slots.acquire(False)
+
+
+def release():
+    _slots.release()
+
+
+def send(folder, user):
+
+    # folder: Folder
+    # user: User
+    # return: Response, or None if too many downloads are running
+
+    if not acquire():
+        return None
+    try:
+        contents = entries(folder, user)
+    except Exception:
+        release()
+        raise
+    response = models.app.response_class(stream(contents), mimetype='application/zip')
+    response.headers['Cache-Control'] = "private, max-age=0"
+    response.headers.add('Content-Disposition', 'attachment',
+                         filename=secure_filename(folder.name + u".zip") or "folder.zip")
+    # when the download ends, or the client goes away
+    response.call_on_close(release)
+    return response
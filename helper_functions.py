@@ -6,11 +6,13 @@ Some useful tools to be re-used throughout the program.
 
 """
 
-from flask import session
+from flask import session, g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import func
 import models
-from random import SystemRandom
+import events
+import os
+from base64 import urlsafe_b64encode
 
 
 
@@ -18,11 +20,40 @@ def get_user():
 
     """Returns the User record associated with the active session. 
        Retuns None if no active session is found.
+       
+       The user is looked up once per request and memoized on flask.g.
     """
     if not 'username' in session:
         return None
     username = session['username'].lower()
-    return models.User.query.filter(func.lower(models.User.username) == username).first()
+    if g.get('username') != username:
+        g.user = models.User.query.filter(func.lower(models.User.username) == username).first()
+        g.username = username
+    return g.user
+    
+
+def log_data(**event):
+
+    """Records an event (type, user_id, ip, folder_id, file_id). The event
+       is queued and written in the background, see events.py.
+    """
+    events.log(**event)
+    
+    
+def request_cache(name):
+
+    # name: str
+    # return: dict
+    
+    """Returns a dictionary that lives for the duration of the current 
+       request (stored on flask.g), for memoizing per-request results.
+       Outside of an application context a fresh dictionary is returned.
+    """
+    if not has_app_context():
+        return {}
+    if not name in g:
+        setattr(g, name, {})
+    return getattr(g, name)
     
 
 def valid_username(username):
@@ -58,15 +89,24 @@ def generate_random_string(length):
     
     """Generates cryptographically random base-64 string.
     """
-    number_generator = SystemRandom()
-    chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-"
-    id = ""
-    for i in range(length):
-        id += chars[ number_generator.randrange(len(chars)) ]
-    return id
+    return generate_random_strings(1, length)[0]
+    
+    
+def generate_random_strings(count, length):
+
+    # count: int
+    # length: int
+    # return: List of str
+    
+    """Generates `count` cryptographically random URL-safe base-64 strings
+       from a single read of the system's random source, encoded at once.
+    """
+    chars = count * length
+    # 6 random bits per character
+    encoded = urlsafe_b64encode(os.urandom((chars * 3 + 3) // 4)).decode('ascii')
+    return [encoded[i:i + length] for i in range(0, chars, length)]
     
 
-            
 def format_bytes(num):
     """Returns the filesize as a string.
        e.g. '400 MB', '250 KB', etc.
@@ -0,0 +1,174 @@
+"""
+-------------------------------------------------------------
+                    INSTRUMENTATION
+  Per-request SQL statistics (statement count, database time,
+ slowest statements) from SQLAlchemy engine events, and per-
+  route latency histograms, kept in memory by every process.
+-------------------------------------------------------------
+
+The data is served to admins at /admin/metrics, as JSON or (with
+?format=prometheus) in the Prometheus text exposition format. Each worker
+process keeps its own figures.
+
+The hooks only take timestamps and update a few counters under a lock,
+so they can stay on in production (INSTRUMENTATION = False turns them off).
+"""
+
+import time
+import heapq
+import threading
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# number of slowest statements kept
+SLOWEST = 20
+
+_lock = threading.Lock()
+_routes = {}
+_slowest = []
+
+
+def init_app(app):
+
+    # app: Flask
+
+    """Installs the request and engine hooks (unless INSTRUMENTATION is
+       False).
+    """
+    app.config.setdefault('INSTRUMENTATION', True)
+    app.config.setdefault('SLOW_QUERY_THRESHOLD', 0.1)
+    if not app.config['INSTRUMENTATION']:
+        return
+    app.before_request(_start_request)
+    app.teardown_request(_end_request)
+    # every engine, including the ones created later by Flask-SQLAlchemy
+    event.listen(Engine, "before_cursor_execute", _before_execute)
+    event.listen(Engine, "after_cursor_execute", _after_execute)
+
+
+def _start_request():
+    g.request_start = time.time()
+    g.sql = {"count": 0, "time": 0.0}
+
+
+def _before_execute(connection, cursor, statement, parameters, context, executemany):
+    # kept on the statement's execution context: a statement that raises
+    # never reaches _after_execute, and its start time goes away with it
+    if context is not None:
+        context._query_start = time.time()
+
+
+def _after_execute(connection, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_query_start", None)
+    if start is None or not has_request_context() or "sql" not in g:
+        return
+    elapsed = time.time() - start
+    g.sql["count"] += 1
+    g.sql["time"] += elapsed
+    if elapsed >= current_app.config['SLOW_QUERY_THRESHOLD']:
+        with _lock:
+            entry = (elapsed, statement, request.url_rule.rule if request.url_rule else request.path)
+            if len(_slowest) < SLOWEST:
+                heapq.heappush(_slowest, entry)
+            else:
+                heapq.heappushpop(_slowest, entry)
+
+
+def _end_request(exception=None):
+    if "request_start" not in g:
+        return
+    elapsed = time.time() - g.request_start
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+    key = (request.method, route)
+    with _lock:
+        stats = _routes.get(key)
+        if stats is None:
+            stats = _routes[key] = {"count": 0, "sum": 0.0, "buckets": [0] * len(BUCKETS),
+                                    "queries": 0, "db_time": 0.0, "max_queries": 0}
+        stats["count"] += 1
+        stats["sum"] += elapsed
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                stats["buckets"][i] += 1
+                break
+        stats["queries"] += g.sql["count"]
+        stats["db_time"] += g.sql["time"]
+        stats["max_queries"] = max(stats["max_queries"], g.sql["count"])
+
+
+def snapshot():
+
+    # return: dict
+
+    """Returns a copy of the collected data:
+       {"routes": [...], "slowest_statements": [...], "events": {...}}
+    """
+    import events
+    with _lock:
+        routes = []
+        for (method, route), stats in sorted(_routes.items()):
+            cumulative, total = [], 0
+            for n in stats["buckets"]:
+                total += n
+                cumulative.append(total)
+            routes.append({
+                "method": method,
+                "route": route,
+                "requests": stats["count"],
+                "seconds": stats["sum"],
+                "mean_seconds": stats["sum"] / stats["count"],
+                "histogram": dict(("%g" % bound, n) for bound, n in zip(BUCKETS, cumulative)),
+                "queries": stats["queries"],
+                "mean_queries": stats["queries"] / float(stats["count"]),
+                "max_queries": stats["max_queries"],
+                "db_seconds": stats["db_time"],
+            })
+        slowest = [{"seconds": elapsed, "statement": statement, "route": route}
+                   for elapsed, statement, route in sorted(_slowest, reverse=True)]
+    return {"routes": routes, "slowest_statements": slowest, "events": events.stats()}
+
+
+def prometheus():
+
+    # return: str
+
+    """Returns the collected data in the Prometheus text format."""
+    data = snapshot()
+    lines = [
+        "# HELP gofr_request_duration_seconds Request latency by route.",
+        "# TYPE gofr_request_duration_seconds histogram",
+    ]
+    for route in data["routes"]:
+        labels = 'method="%s",route="%s"' % (route["method"], _escape(route["route"]))
+        for bound in BUCKETS:
+            lines.append('gofr_request_duration_seconds_bucket{%s,le="%g"} %d'
+                         % (labels, bound, route["histogram"]["%g" % bound]))
+        lines.append('gofr_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, route["requests"]))
+        lines.append('gofr_request_duration_seconds_sum{%s} %f' % (labels, route["seconds"]))
+        lines.append('gofr_request_duration_seconds_count{%s} %d' % (labels, route["requests"]))
+
+    for name, key, help in [("gofr_request_queries_total", "queries", "SQL statements issued by route."),
+                            ("gofr_request_db_seconds_total", "db_seconds", "Time spent in SQL by route.")]:
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s counter" % name)
+        for route in data["routes"]:
+            lines.append('%s{method="%s",route="%s"} %s'
+                         % (name, route["method"], _escape(route["route"]), route[key]))
+
+    lines.append("# HELP gofr_events_total Logged events by outcome (see events.py).")
+    lines.append("# TYPE gofr_events_total counter")
+    for state in ("logged", "dropped", "written", "failed"):
+        lines.append('gofr_events_total{state="%s"} %d' % (state, data["events"][state]))
+    lines.append("# HELP gofr_events_queued Events waiting to be written.")
+    lines.append("# TYPE gofr_events_queued gauge")
+    lines.append("gofr_events_queued %d" % data["events"]["queued"])
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
@@ -9,18 +9,26 @@ If you run this file directly, it will start up a Flask server
 
 from flask import Flask
 from flask import render_template
-from flask import url_for, redirect, flash, send_from_directory, abort, request
+from flask import url_for, redirect, flash, send_from_directory, abort, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from models import db
 from models import *
 from functools import wraps
-from controllers import action_controller, auth_controller, folder_controller, user_controller
+from controllers import action_controller, auth_controller, folder_controller, user_controller, upload_controller
 from helper_functions import get_user
+from uploads import UploadRequest
+import serving
+import archives
+import events
+import instrumentation
 
 db.init_app(app)
 
 app.secret_key = "[YOUR SECRET KEY HERE]"
 
+# uploads are hashed and sized while they are received
+app.request_class = UploadRequest
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -64,10 +72,35 @@ def folder_add(id=None):
 def folder(id):
     return folder_controller.show_folder(id)
 
+# chunked, resumable uploads (see chunked_uploads.py)
+@app.route('/f/<id>/uploads', methods=['POST'])
+@login_required
+def start_upload(id):
+    return upload_controller.start_upload(id)
+    
+@app.route('/uploads/<id>', methods=['GET', 'PUT', 'DELETE'])
+@login_required
+def chunked_upload(id):
+    if request.method == 'PUT':
+        return upload_controller.put_chunk(id)
+    if request.method == 'DELETE':
+        return upload_controller.cancel_upload(id)
+    return upload_controller.upload_status(id)
+    
+@app.route('/uploads/<id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(id):
+    return upload_controller.finalize_upload(id)
+
 @app.route('/f/<id>/auth', methods=['GET','POST'])
 def folder_authenticate(id):
     return auth_controller.folder_authenticate(id)
 
+# the folder and its visible subfolders as a zip archive
+@app.route('/f/<id>/zip')
+def folder_zip(id):
+    return folder_controller.download_folder(id)
+
 # user is redirected to this page if file is password-protected
 @app.route('/i/<id>/auth', methods=['GET','POST'])
 def file_authenticate(id):
@@ -76,9 +109,9 @@ def file_authenticate(id):
 # serve files from /files and /thumbs directories
 @app.route('/files/<filename>')
 def uploaded_file(filename):
-    file = File.query.filter_by(path=filename).first_or_404()
+    file = File.with_profile("listing").filter_by(path=filename).first_or_404()
     if file.visible_to(get_user()):
-        return send_from_directory(app.config['UPLOAD_FOLDER'], file.full_name)
+        return serving.send_file_data(file)
     abort(404)
     
 # alternate route for short URLs
@@ -86,16 +119,16 @@ def uploaded_file(filename):
 def uploaded_file_short(id):
     
     id = id.split('.')[0]
-    file = File.query.filter_by(id=id).first_or_404()
+    file = File.with_profile("listing").filter_by(id=id).first_or_404()
     
     if file.visible_to(get_user()):
         
         # log file download
         helper_functions.log_data(user_id=get_user().id if get_user() else None, 
-                                  ip=request.remote_addr, type=3,
+                                  ip=request.remote_addr, type=events.DOWNLOAD,
                                   folder_id=file.folder.id, file_id=file.id)
 
-        return send_from_directory(app.config['UPLOAD_FOLDER'], file.full_name)
+        return serving.send_file_data(file)
         
         
     elif file.folder.password_protected:
@@ -105,6 +138,37 @@ def uploaded_file_short(id):
         
     
 
+# member listing of an archive (?search=...&page=N), see archives.py
+@app.route('/i/<id>/members')
+def archive_members(id):
+    file = File.with_profile("listing").filter_by(id=id).first_or_404()
+    if not file.visible_to(get_user()) or not file.md5:
+        abort(404)
+    blob = Blob.query.get(file.md5)
+    if blob is None:
+        abort(404)
+    page = max(1, request.args.get('page', 1, type=int))
+    members = archives.members(blob, search=request.args.get('search'), page=page)
+    return jsonify(status=blob.archive_status, page=page, 
+                   members=[{"position": member.position, "name": member.name, "size": member.size, 
+                             "is_dir": member.is_dir} for member in members])
+    
+# a single file out of a zip or tar archive
+@app.route('/i/<id>/members/<int:position>')
+def archive_member(id, position):
+    file = File.with_profile("listing").filter_by(id=id).first_or_404()
+    if not file.visible_to(get_user()) or not file.md5:
+        abort(404)
+    blob = Blob.query.get(file.md5)
+    member = ArchiveMember.query.filter_by(md5=file.md5, position=position).first()
+    if blob is None or not member or member.is_dir:
+        abort(404)
+    try:
+        return serving.send_archive_member(file, blob, member)
+    except archives.UnsupportedArchive:
+        # a rar archive, without rarfile to read it
+        abort(404)
+
 @app.route('/thumbs/<filename>')
 def thumbnail_static(filename):
     return send_from_directory(app.config['THUMBNAIL_FOLDER'], filename)
@@ -113,13 +177,21 @@ def thumbnail_static(filename):
 def thumbnail(id):
 
     id = id.split('.')[0]
-    file = File.query.filter_by(id=id).first_or_404()
+    file = File.with_profile("listing").filter_by(id=id).first_or_404()
     
     if file.visible_to(get_user()):
-        return send_from_directory(app.config['THUMBNAIL_FOLDER'], ''.join(file.thumb_path.split("/")[1::]))
+        return serving.send_thumbnail(file, request.args.get('size', type=int))
 
     abort(404)
     
+# request latency and SQL statistics (?format=prometheus for the text format)
+@app.route('/admin/metrics')
+@admin_required
+def metrics():
+    if request.args.get('format') == 'prometheus':
+        return app.response_class(instrumentation.prometheus(), mimetype='text/plain; version=0.0.4')
+    return jsonify(instrumentation.snapshot())
+    
 # user profile page
 @app.route('/user', methods=['GET', 'POST'])
 @login_required
@@ -0,0 +1,93 @@
+"""string folder references
+
+folder.parent_id and file.folder_id were integer columns referencing the
+string folder.id. SQLite stored the ids in them as text, except the ones
+that look like numbers, which INTEGER affinity converted; and it can't use
+the folder primary key to join on them (the comparison affinities differ).
+Other databases were created with string columns by the baseline.
+
+The columns are rebuilt as VARCHAR(32) with a table copy (batch mode), and
+the converted values are mapped back to the folder ids they came from.
+
+Revision ID: 0abd411b176e
+Revises: 8bf792301901
+Create Date: 2026-10-17 20:03:53.829608
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+import search_index
+
+
+# revision identifiers, used by Alembic.
+revision = '0abd411b176e'
+down_revision = '8bf792301901'
+branch_labels = None
+depends_on = None
+
+# (table, column) of the references to folder.id
+REFERENCES = [('folder', 'parent_id'), ('file', 'folder_id')]
+
+# ids that INTEGER affinity stores as numbers (ids are alphanumeric)
+NUMERIC = re.compile(r'^[0-9]+([eE][0-9]+)?$')
+
+
+def upgrade():
+    if op.get_context().dialect.name != 'sqlite':
+        return
+    connection = op.get_bind()
+    for table, column in REFERENCES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, existing_type=sa.Integer(), type_=sa.String(length=32),
+                                  existing_nullable=True)
+    restore_numeric_ids(connection)
+    recreate_lost_indexes(connection)
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'sqlite':
+        return
+    connection = op.get_bind()
+    for name, column in REFERENCES:
+        # a type change would CAST the ids to integers (0 for most of them):
+        # copy the values as they are into the integer column instead
+        table = sa.Table(name, sa.MetaData(), autoload_with=connection)
+        table.c[column].type = sa.Integer()
+        with op.batch_alter_table(name, copy_from=table, recreate='always'):
+            pass
+    recreate_lost_indexes(connection)
+
+
+def restore_numeric_ids(connection):
+    # the converted values were copied as text ("1234567" for "001234567",
+    # "1.2e+46" for "12e45"): map them back by numeric value
+    ids = {}
+    for (id,) in connection.execute(sa.text('SELECT id FROM folder')):
+        if NUMERIC.match(id):
+            # several ids with the same value can't be told apart
+            number = float(id)
+            ids[number] = None if number in ids else id
+
+    for table, column in REFERENCES:
+        rows = connection.execute(sa.text('SELECT rowid, {column} FROM {table} WHERE {column} IS NOT NULL '
+                                          'AND {column} NOT IN (SELECT id FROM folder)'
+                                          .format(table=table, column=column))).fetchall()
+        update = sa.text('UPDATE {table} SET {column} = :id WHERE rowid = :rowid'
+                         .format(table=table, column=column))
+        for rowid, value in rows:
+            try:
+                id = ids.get(float(value))
+            except ValueError:
+                continue
+            if id:
+                connection.execute(update, id=id, rowid=rowid)
+
+
+def recreate_lost_indexes(connection):
+    # the table copy drops the expression index (not reflected by SQLite)
+    # and renumbers the rowids the full-text index refers to
+    op.create_index('ix_file_folder_name', 'file', ['folder_id', sa.text(u'lower(name)')], unique=False)
+    search_index.rebuild(connection)
@@ -0,0 +1,45 @@
+"""folder tree path
+
+Revision ID: 1ee5901c2a5f
+Revises: 6c6446c726c7
+Create Date: 2026-10-17 19:40:39.319363
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1ee5901c2a5f'
+down_revision = '6c6446c726c7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('folder', sa.Column('tree_path', sa.String(), nullable=True))
+    op.create_index(op.f('ix_folder_tree_path'), 'folder', ['tree_path'], unique=False)
+
+    # backfill: "/<root id>/.../<parent id>/<id>/" for every existing folder
+    connection = op.get_bind()
+    parents = dict(connection.execute(sa.text('SELECT id, parent_id FROM folder')).fetchall())
+    paths = {}
+
+    def tree_path(id):
+        chain = []
+        while id in parents and id not in paths:
+            chain.append(id)
+            id = parents[id]
+        path = paths.get(id, '/')
+        for id in reversed(chain):
+            path = paths[id] = path + id + '/'
+        return path
+
+    update = sa.text('UPDATE folder SET tree_path = :tree_path WHERE id = :id')
+    for id in parents:
+        connection.execute(update, id=id, tree_path=tree_path(id))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_folder_tree_path'), table_name='folder')
+    op.drop_column('folder', 'tree_path')
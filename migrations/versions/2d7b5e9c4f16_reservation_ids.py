@@ -0,0 +1,33 @@
+"""reservation ids
+
+Storage reservation ids that are never reused, so that the id held by a
+request or an upload can't point at another reservation once its own was
+expired. PostgreSQL sequences don't reuse ids already; SQLite tables need
+AUTOINCREMENT.
+
+Revision ID: 2d7b5e9c4f16
+Revises: 9c3e5a7f1d24
+Create Date: 2026-10-18 10:26:51.730214
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '2d7b5e9c4f16'
+down_revision = '9c3e5a7f1d24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_context().dialect.name == 'sqlite':
+        with op.batch_alter_table('storage_reservation', recreate='always',
+                                  table_kwargs={'sqlite_autoincrement': True}):
+            pass
+
+
+def downgrade():
+    if op.get_context().dialect.name == 'sqlite':
+        with op.batch_alter_table('storage_reservation', recreate='always'):
+            pass
@@ -0,0 +1,32 @@
+"""search index
+
+Full-text index of file and folder names (see search_index.py), filled
+from the existing rows.
+
+Revision ID: 3f1b7d9a2c60
+Revises: d427b02e5a0a
+Create Date: 2026-10-17 19:40:35.614027
+
+"""
+from alembic import op
+import search_index
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1b7d9a2c60'
+down_revision = 'd427b02e5a0a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    search_index.rebuild(op.get_bind())
+
+
+def downgrade():
+    connection = op.get_bind()
+    if connection.dialect.name == 'sqlite':
+        for table_name, index in search_index.INDEXES.items():
+            for trigger in ('insert', 'delete', 'rename'):
+                op.execute('DROP TRIGGER IF EXISTS %s_%s' % (index, trigger))
+            op.execute('DROP TABLE IF EXISTS %s' % index)
@@ -0,0 +1,28 @@
+"""listing indexes
+
+Revision ID: 4e8a2c5d7b13
+Revises: 3f1b7d9a2c60
+Create Date: 2026-10-17 19:40:36.208153
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e8a2c5d7b13'
+down_revision = '3f1b7d9a2c60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_file_folder_date', 'file', ['folder_id', 'date'], unique=False)
+    op.create_index('ix_file_folder_extension', 'file', ['folder_id', 'extension'], unique=False)
+    op.create_index('ix_file_folder_name', 'file', ['folder_id', sa.text(u'lower(name)')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_file_folder_name', table_name='file')
+    op.drop_index('ix_file_folder_extension', table_name='file')
+    op.drop_index('ix_file_folder_date', table_name='file')
@@ -0,0 +1,31 @@
+"""thumbnail queue
+
+Revision ID: 5b1f0c9e7d42
+Revises: e29f63a747ac
+Create Date: 2026-10-17 20:58:12.604318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1f0c9e7d42'
+down_revision = 'e29f63a747ac'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('file', sa.Column('thumb_status', sa.String(length=10), nullable=True))
+    op.add_column('file', sa.Column('thumb_attempts', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_file_thumb_status'), 'file', ['thumb_status'], unique=False)
+
+    # thumbnails of existing files were generated at upload time
+    op.execute("UPDATE file SET thumb_status = 'ready', thumb_attempts = 0")
+
+
+def downgrade():
+    op.drop_index(op.f('ix_file_thumb_status'), table_name='file')
+    op.drop_column('file', 'thumb_attempts')
+    op.drop_column('file', 'thumb_status')
@@ -0,0 +1,53 @@
+"""subtree counters
+
+Revision ID: 6c6446c726c7
+Revises: 4e8a2c5d7b13
+Create Date: 2026-10-17 19:40:37.815716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6c6446c726c7'
+down_revision = '4e8a2c5d7b13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('folder', sa.Column('subtree_bytes', sa.BigInteger(), server_default='0', nullable=True))
+    op.add_column('folder', sa.Column('subtree_files', sa.Integer(), server_default='0', nullable=True))
+    op.add_column('folder', sa.Column('subtree_folders', sa.Integer(), server_default='0', nullable=True))
+
+    backfill_counters(op.get_bind())
+
+
+def downgrade():
+    op.drop_column('folder', 'subtree_folders')
+    op.drop_column('folder', 'subtree_files')
+    op.drop_column('folder', 'subtree_bytes')
+
+
+def backfill_counters(connection):
+    parents = dict(connection.execute(sa.text('SELECT id, parent_id FROM folder')).fetchall())
+    totals = dict((id, [0, 0, 0]) for id in parents)
+    file_totals = connection.execute(sa.text('SELECT folder_id, COUNT(id), COALESCE(SUM(size), 0) '
+                                             'FROM file GROUP BY folder_id'))
+    for folder_id, files, size in file_totals:
+        id = folder_id
+        while id in totals:
+            totals[id][1] += files
+            totals[id][2] += size
+            id = parents[id]
+    for folder_id in parents:
+        id = parents[folder_id]
+        while id in totals:
+            totals[id][0] += 1
+            id = parents[id]
+
+    update = sa.text('UPDATE folder SET subtree_folders = :folders, subtree_files = :files, '
+                     'subtree_bytes = :bytes WHERE id = :id')
+    for id, (folders, files, size) in totals.items():
+        connection.execute(update, id=id, folders=folders, files=files, bytes=size)
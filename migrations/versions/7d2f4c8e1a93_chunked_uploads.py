@@ -0,0 +1,39 @@
+"""chunked uploads
+
+Revision ID: 7d2f4c8e1a93
+Revises: c41e7a9b2d58
+Create Date: 2026-10-17 21:52:08.117342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2f4c8e1a93'
+down_revision = 'c41e7a9b2d58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('chunked_upload',
+    sa.Column('id', sa.String(length=24), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('folder_id', sa.String(length=32), nullable=True),
+    sa.Column('filename', sa.String(length=128), nullable=True),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('offset', sa.BigInteger(), nullable=True),
+    sa.Column('reservation_id', sa.Integer(), nullable=True),
+    sa.Column('date', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['folder_id'], ['folder.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_chunked_upload_updated_at'), 'chunked_upload', ['updated_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_chunked_upload_updated_at'), table_name='chunked_upload')
+    op.drop_table('chunked_upload')
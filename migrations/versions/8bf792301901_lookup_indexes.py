@@ -0,0 +1,37 @@
+"""lookup indexes
+
+Indexes for the remaining hot lookups (see query_plans.py):
+
+    ix_file_folder_md5    duplicate check on upload; its folder_id prefix
+                          also serves plain lookups by folder
+    ix_file_md5           blob reference counts
+    ix_file_path          /files/<filename>
+    ix_folder_user_parent root folders of a user (parent_id IS NULL)
+
+Revision ID: 8bf792301901
+Revises: a3d9e61f0b87
+Create Date: 2026-10-17 20:02:04.218573
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8bf792301901'
+down_revision = 'a3d9e61f0b87'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_file_folder_md5', 'file', ['folder_id', 'md5'], unique=False)
+    op.create_index(op.f('ix_file_md5'), 'file', ['md5'], unique=False)
+    op.create_index(op.f('ix_file_path'), 'file', ['path'], unique=False)
+    op.create_index('ix_folder_user_parent', 'folder', ['user_id', 'parent_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_folder_user_parent', table_name='folder')
+    op.drop_index(op.f('ix_file_path'), table_name='file')
+    op.drop_index(op.f('ix_file_md5'), table_name='file')
+    op.drop_index('ix_file_folder_md5', table_name='file')
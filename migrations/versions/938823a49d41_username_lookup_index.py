@@ -0,0 +1,24 @@
+"""username lookup index
+
+Revision ID: 938823a49d41
+Revises: 1ee5901c2a5f
+Create Date: 2026-10-17 19:58:12.440918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '938823a49d41'
+down_revision = '1ee5901c2a5f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_user_username_lower', 'user', [sa.text(u'lower(username)')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_user_username_lower', table_name='user')
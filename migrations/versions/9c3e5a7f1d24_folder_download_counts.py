@@ -0,0 +1,31 @@
+"""daily folder download counts
+
+Zip downloads of folders, rolled up by `python models.py aggregate_events`.
+
+Revision ID: 9c3e5a7f1d24
+Revises: f5a81c3e6b27
+Create Date: 2026-10-17 23:12:08.406517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c3e5a7f1d24'
+down_revision = 'f5a81c3e6b27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('folder_download_count',
+    sa.Column('folder_id', sa.String(length=32), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('downloads', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('folder_id', 'day')
+    )
+
+
+def downgrade():
+    op.drop_table('folder_download_count')
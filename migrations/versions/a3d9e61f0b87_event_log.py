@@ -0,0 +1,45 @@
+"""event log and daily download counts
+
+Revision ID: a3d9e61f0b87
+Revises: 5b1f0c9e7d42
+Create Date: 2026-10-17 21:34:05.118942
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d9e61f0b87'
+down_revision = '5b1f0c9e7d42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('event',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('type', sa.Integer(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('ip', sa.String(length=45), nullable=True),
+    sa.Column('folder_id', sa.String(length=32), nullable=True),
+    sa.Column('file_id', sa.String(length=20), nullable=True),
+    sa.Column('date', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_event_date'), 'event', ['date'], unique=False)
+    op.create_table('download_count',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('file_id', sa.String(length=20), nullable=False),
+    sa.Column('folder_id', sa.String(length=32), nullable=True),
+    sa.Column('downloads', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('day', 'file_id')
+    )
+    op.create_index('ix_download_count_folder_day', 'download_count', ['folder_id', 'day'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_download_count_folder_day', table_name='download_count')
+    op.drop_table('download_count')
+    op.drop_index(op.f('ix_event_date'), table_name='event')
+    op.drop_table('event')
@@ -0,0 +1,49 @@
+"""storage reservations
+
+Ledger of the space held by uploads in progress (see quota.py), the
+reserved_storage counter it adds up to, and 64-bit used storage (SQLite
+integers are 64-bit already).
+
+Revision ID: c41e7a9b2d58
+Revises: 0abd411b176e
+Create Date: 2026-10-17 21:14:37.502916
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e7a9b2d58'
+down_revision = '0abd411b176e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('storage_reservation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('bytes', sa.BigInteger(), nullable=True),
+    sa.Column('date', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_storage_reservation_date'), 'storage_reservation', ['date'], unique=False)
+    op.create_index(op.f('ix_storage_reservation_user_id'), 'storage_reservation', ['user_id'], unique=False)
+    op.add_column('user', sa.Column('reserved_storage', sa.BigInteger(), nullable=True))
+    user = sa.table('user', sa.column('reserved_storage'))
+    op.execute(user.update().values(reserved_storage=0))
+    if op.get_context().dialect.name != 'sqlite':
+        op.alter_column('user', 'used_storage', existing_type=sa.Integer(), type_=sa.BigInteger(),
+                        existing_nullable=True)
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'sqlite':
+        op.alter_column('user', 'used_storage', existing_type=sa.BigInteger(), type_=sa.Integer(),
+                        existing_nullable=True)
+    op.drop_column('user', 'reserved_storage')
+    op.drop_index(op.f('ix_storage_reservation_user_id'), table_name='storage_reservation')
+    op.drop_index(op.f('ix_storage_reservation_date'), table_name='storage_reservation')
+    op.drop_table('storage_reservation')
@@ -0,0 +1,50 @@
+"""content-addressed blobs
+
+Revision ID: e29f63a747ac
+Revises: 938823a49d41
+Create Date: 2026-10-17 20:21:47.309185
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e29f63a747ac'
+down_revision = '938823a49d41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blob',
+    sa.Column('md5', sa.String(length=32), nullable=False),
+    sa.Column('path', sa.String(), nullable=True),
+    sa.Column('thumb_path', sa.String(), nullable=True),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('refcount', sa.Integer(), nullable=True),
+    sa.Column('released_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('md5')
+    )
+    op.create_index(op.f('ix_blob_released_at'), 'blob', ['released_at'], unique=False)
+
+    # backfill: existing data stays where it is (unsharded), shared by every
+    # file with the same digest. Files without a digest are not tracked.
+    connection = op.get_bind()
+    files = connection.execute(sa.text('SELECT md5, full_name, thumb_path, type, size FROM file '
+                                       'WHERE md5 IS NOT NULL ORDER BY date'))
+    blobs = {}
+    for md5, full_name, thumb_path, type, size in files:
+        if md5 not in blobs:
+            blobs[md5] = dict(md5=md5, path=full_name, size=size, refcount=0, released_at=None,
+                              thumb_path=thumb_path if type == 'Image' else None)
+        blobs[md5]['refcount'] += 1
+    if blobs:
+        op.bulk_insert(sa.table('blob', sa.column('md5'), sa.column('path'), sa.column('thumb_path'),
+                                sa.column('size'), sa.column('refcount'), sa.column('released_at')),
+                       list(blobs.values()))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_blob_released_at'), table_name='blob')
+    op.drop_table('blob')
@@ -0,0 +1,39 @@
+"""archive members
+
+Member listings of archives (see archives.py). Existing archives are
+queued with `python models.py queue_archives`.
+
+Revision ID: f5a81c3e6b27
+Revises: 7d2f4c8e1a93
+Create Date: 2026-10-17 22:31:45.263190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5a81c3e6b27'
+down_revision = '7d2f4c8e1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('archive_member',
+    sa.Column('md5', sa.String(length=32), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('is_dir', sa.Boolean(), nullable=True),
+    sa.Column('offset', sa.BigInteger(), nullable=True),
+    sa.PrimaryKeyConstraint('md5', 'position')
+    )
+    op.add_column('blob', sa.Column('archive_status', sa.String(length=12), nullable=True))
+    op.create_index(op.f('ix_blob_archive_status'), 'blob', ['archive_status'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_blob_archive_status'), table_name='blob')
+    op.drop_column('blob', 'archive_status')
+    op.drop_table('archive_member')
@@ -6,18 +6,30 @@ Declaration of database models to be used in the software.
 -------------------------------------------------------------
 """
 
-from flask import Flask, session
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, session, has_request_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug import secure_filename
 import os
+import mimetypes
+import time
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
-from PIL import Image, ImageOps
-from datetime import datetime
+from datetime import datetime, timedelta
 from math import ceil
-from sqlalchemy import desc
+from sqlalchemy.dialects import postgresql
+from sqlalchemy import desc, and_, or_, not_, false, event, func, select, union_all, literal, tuple_
+from sqlalchemy.orm import aliased, joinedload, selectinload
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import FlushError
 import helper_functions
+import search_index
+import thumbnails
+import events
+import instrumentation
+import database
+import page_cache
+import quota
+import archives
 
 
 app = Flask(__name__, static_url_path='/resources')
@@ -27,14 +39,141 @@ THUMBNAIL_FOLDER = 'thumbs/'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['THUMBNAIL_FOLDER'] = THUMBNAIL_FOLDER
 app.config['MAX_FREE_STORAGE'] = 2000000000
+app.config['MAX_SEARCH_RESULTS'] = 1000
+# file serving (see serving.py): None, 'x-sendfile' or 'x-accel'
+app.config['SENDFILE_MODE'] = None
+app.config['X_ACCEL_PREFIX'] = '/protected/'
+app.config['FILE_CACHE_MAX_AGE'] = 365 * 24 * 3600
+app.config['THUMBNAIL_CACHE_MAX_AGE'] = 24 * 3600
+# files can turn private under the same URL: shared caches revalidate after this
+app.config['SHARED_CACHE_MAX_AGE'] = 300
+# event logging (see events.py): None, 'database' or 'file'
+app.config['EVENT_SINK'] = 'database'
+app.config['EVENT_LOG_PATH'] = 'events.log'
+app.config['EVENT_QUEUE_SIZE'] = 10000
+app.config['EVENT_QUEUE_TIMEOUT'] = 0.005
+app.config['EVENT_BATCH_SIZE'] = 500
+app.config['EVENT_FLUSH_INTERVAL'] = 1.0
+# request/SQL instrumentation (see instrumentation.py)
+app.config['INSTRUMENTATION'] = True
+app.config['SLOW_QUERY_THRESHOLD'] = 0.1
+# folder page cache (see page_cache.py): None, 'memory' (single process) or 'redis'
+app.config['PAGE_CACHE'] = None
+app.config['PAGE_CACHE_SIZE'] = 1000
+app.config['PAGE_CACHE_REDIS_URL'] = 'redis://localhost:6379/0'
+app.config['PAGE_CACHE_TTL'] = 3600
+# chunk size suggested to clients of the chunked upload API (see chunked_uploads.py)
+app.config['CHUNKED_UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024
+# folder zip downloads running at once in each process (see folder_zip.py)
+app.config['ZIP_MAX_JOBS'] = 4
 site_path = 'SITE PATH GOES HERE'
-db = SQLAlchemy(app)
+# database URI and pool settings from $GOFR_SETTINGS / the environment (see database.py)
+database.load_config(app)
+db = database.Database(app)
+instrumentation.init_app(app)
+# storage reservations for uploads (see quota.py)
+quota.init_app(app)
 
 # migration manager
 migrate = Migrate(app, db)
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+# full-text name index, created alongside the tables
+event.listen(db.metadata, 'after_create', 
+             lambda target, connection, **kwargs: search_index.create(connection))
+
+class LoadProfiles(object):
+
+    """
+        Named eager-loading strategies. LOAD_PROFILES maps a profile name to
+        the loader options of the relationships a view will touch, so that 
+        listing N rows costs a fixed number of queries instead of N + 1.
+        
+        example usage:
+        
+            Folder.with_profile("page").filter_by(id=id).first()
+    """
+    
+    LOAD_PROFILES = {}
+    
+    @classmethod
+    def with_profile(cls, name):
+        # name: str
+        # return: Query
+        return cls.query.options(*cls.LOAD_PROFILES[name])
+        
+
+class RandomIds(object):
+
+    """
+        Random, URL-safe string primary keys. IDs are not checked for 
+        collisions before use: the primary key constraint rejects a taken 
+        one, and the transaction is retried with new IDs (see 
+        retry_on_duplicate_id). allocate_ids draws the IDs of a batch of 
+        rows at once.
+    """
+    
+    ID_LENGTH = 9
+    
+    @classmethod
+    def allocate_ids(cls, count=1):
+        # count: int
+        # return: List of str
+        return helper_functions.generate_random_strings(count, cls.ID_LENGTH)
+        
+        
+def retry_on_duplicate_id(work, attempts=3):
+
+    """
+        work: function - adds rows with new random IDs and commits
+        attempts: int
+        
+        Calls work, and if the commit fails on a primary key (a duplicate 
+        ID), rolls back and calls it again, so that the rows get new IDs. 
+        work must be safe to run again from the start. Returns what work 
+        returns. Other constraint violations (a taken username) are raised 
+        at once.
+        
+        A duplicate of a row already loaded in the session is caught by the 
+        session itself (FlushError) before reaching the database.
+    """
+    
+    for attempt in range(attempts):
+        try:
+            return work()
+        except (IntegrityError, FlushError) as e:
+            db.session.rollback()
+            if attempt == attempts - 1 or (isinstance(e, IntegrityError) and not is_duplicate_id(e)):
+                raise
+        
+        
+def is_duplicate_id(error):
+
+    """
+        error: IntegrityError
+        
+        True if the statement violated the primary key of its table.
+    """
+    
+    # PostgreSQL names the constraint: "<table>_pkey" unless named otherwise
+    diag = getattr(error.orig, "diag", None)
+    if diag is not None and getattr(diag, "constraint_name", None):
+        return diag.constraint_name.endswith("_pkey")
+    
+    # SQLite: "UNIQUE constraint failed: folder.id" (older versions: 
+    # "PRIMARY KEY must be unique")
+    message = str(error.orig)
+    if "PRIMARY KEY" in message:
+        return True
+    if "UNIQUE constraint failed:" not in message:
+        return False
+    columns = [name.strip().split(".") for name in message.split(":", 1)[1].split(",")]
+    table = db.metadata.tables.get(columns[0][0])
+    return table is not None and set(column for _, column in columns) == \
+                                 set(column.name for column in table.primary_key.columns)
+        
+
 class User(db.Model):
  
     id = db.Column(db.Integer(), primary_key=True)
@@ -46,7 +185,14 @@ class User(db.Model):
                                backref='user', 
                                lazy='dynamic')
     is_admin = db.Column(db.Boolean())
-    used_storage = db.Column(db.Integer())
+    # changed with atomic updates only (see quota.py)
+    used_storage = db.Column(db.BigInteger())
+    reserved_storage = db.Column(db.BigInteger(), default=0)
+    
+    # usernames are looked up case-insensitively (see helper_functions.get_user)
+    __table_args__ = (
+        db.Index('ix_user_username_lower', func.lower(username)),
+    )
     
     def __init__(self, username, password, is_admin=False):
         
@@ -59,6 +205,7 @@ class User(db.Model):
         self.date = datetime.utcnow()
         self.is_admin = is_admin
         self.used_storage = 0
+        self.reserved_storage = 0
         
     def set_password(self, password):
         self.pw_hash = generate_password_hash(password)
@@ -78,7 +225,7 @@ class User(db.Model):
         return self.folders.count()
     
     def get_root_folders(self, page=1, results_per_page=25):
-        return Folder.query.filter_by(user=self).filter_by(parent=None).offset((page - 1) * results_per_page).limit(results_per_page).all()
+        return Folder.with_profile("listing").filter_by(user=self).filter_by(parent=None).offset((page - 1) * results_per_page).limit(results_per_page).all()
         
     def get_auth_token(self):
         if 'auth_token' in session and 'username' in session:
@@ -88,10 +235,35 @@ class User(db.Model):
         return helper_functions.format_bytes(self.used_storage)
         
     def space_available(self, size):
-        return self.is_admin or app.config['MAX_FREE_STORAGE'] - self.used_storage > size
+        # uploads reserve their space instead (see quota.Reservation)
+        return self.is_admin or app.config['MAX_FREE_STORAGE'] - self.used_storage - (self.reserved_storage or 0) >= size
+        
+
+class StorageReservation(db.Model):
+
+    # space held by an upload in progress (see quota.py)
+    
+    # ids are never reused: a request or an upload may still hold the id
+    # of a reservation that was expired meanwhile
+    __table_args__ = {'sqlite_autoincrement': True}
     
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    bytes = db.Column(db.BigInteger)
+    date = db.Column(db.DateTime, index=True)
+    
+
+class Folder(RandomIds, LoadProfiles, db.Model):
 
-class Folder(db.Model):
+    # listing row kind (see Folder.listing)
+    KIND = 0
+    
+    LOAD_PROFILES = {
+        # the folder a page is about
+        "page": [joinedload("user"), joinedload("parent"), selectinload("children")],
+        # subfolders listed on a page
+        "listing": [selectinload("children")],
+    }
 
     id = db.Column(db.String(32), primary_key=True)
     name = db.Column(db.String(128))
@@ -102,15 +274,30 @@ class Folder(db.Model):
     files = db.relationship('File', 
             backref='folder', lazy='dynamic')
     pw_hash = db.Column(db.String(300))        
-    parent_id = db.Column(db.Integer(), db.ForeignKey('folder.id'), index=True)     
+    parent_id = db.Column(db.String(32), db.ForeignKey('folder.id'), index=True)
     parent = db.relationship(lambda: Folder, remote_side=id, backref='children')
     extends_permissions = db.Column(db.Boolean)
     
+    # aggregates over the whole subtree (descendant folders, files and bytes
+    # including this folder's own files), kept up to date by update_counters
+    subtree_folders = db.Column(db.Integer(), default=0, server_default='0')
+    subtree_files = db.Column(db.Integer(), default=0, server_default='0')
+    subtree_bytes = db.Column(db.BigInteger(), default=0, server_default='0')
+    
+    # materialized path: "/<root id>/.../<parent id>/<id>/"
+    tree_path = db.Column(db.String(), index=True)
     
-    def __init__(self, name, user_id, private=True, password=None, password_protected=False, extends_permissions=None):
+    # root folders of a user: user_id = ? AND parent_id IS NULL
+    __table_args__ = (
+        db.Index('ix_folder_user_parent', user_id, parent_id),
+    )
+    
+    
+    def __init__(self, name, user_id, private=True, password=None, password_protected=False, extends_permissions=None, id=None):
         # name: str
         # user_id: int
-        self.id = self.generate_id()
+        # id: str (from Folder.allocate_ids, a new one if not given)
+        self.id = id or self.allocate_ids()[0]
         self.name = name
         self.user_id = user_id
         self.date = datetime.utcnow()
@@ -119,18 +306,12 @@ class Folder(db.Model):
         self.set_password(password)
         self.password_protected = password_protected
         self.extends_permissions = extends_permissions
+        self.subtree_folders = 0
+        self.subtree_files = 0
+        self.subtree_bytes = 0
+        self.tree_path = '/' + self.id + '/'
         
     
-    def generate_id(self):  
-        # return: str
-        id = helper_functions.generate_random_string(9)
-
-        # check if the ID already being used (to avoid collisions)
-        existing_folder = Folder.query.filter_by(id=id).first()        
-        if existing_folder:
-            return self.generate_id()  
-        return id
-        
     def set_password(self, password):
         if password:
             self.pw_hash = generate_password_hash(password)
@@ -140,78 +321,286 @@ class Folder(db.Model):
     def check_password(self, password):
         return check_password_hash(self.pw_hash, password)
         
-    def add_file(self, file):
+    def add_file(self, file, commit=True):
         # file: File
         self.files.append(file)
-        db.session.commit()
+        db.session.flush()
+        self.update_counters(files=1, bytes=file.size or 0)
+        if commit:
+            db.session.commit()
         
-    def delete(self):
-        for child in self.children:
-            child.delete()
-        for file in self.files:
-            file.delete()
-        db.session.delete(self)
-        db.session.commit()
+    def delete(self, update_counters=True, commit=True):
     
-    def set_parent(self, parent):
+        """
+            Deletes the folder, its subfolders and all of their files with
+            set-based statements in a single transaction (see File.delete_many).
+            The data on disk is removed later by Blob.collect_garbage.
+        """
+        
+        if update_counters and self.parent_id:
+            self.parent.update_counters(folders=-(1 + self.subtree_folders), 
+                                        files=-self.subtree_files, 
+                                        bytes=-self.subtree_bytes)
+        self.invalidate_pages(subtree=True)
+        subtree_ids = db.session.query(Folder.id).filter(self.subtree_filter())
+        File.delete_many(File.folder_id.in_(subtree_ids.subquery()), update_counters=False)
+        Folder.query.filter(self.subtree_filter()).delete(synchronize_session=False)
+        if commit:
+            db.session.commit()
+    
+    def set_parent(self, parent, commit=True):
+    
+        # parent: Folder
+        # return: bool (False if the folder can't be moved into parent)
+        
         if parent != self and not parent.is_child_of(self):
+            moved = dict(folders=1 + self.subtree_folders, files=self.subtree_files, bytes=self.subtree_bytes)
+            # the path shown on every page of the subtree changes
+            self.invalidate_pages(subtree=True)
             if self.parent:
-                self.parent.children.pop(self)
+                self.parent.update_counters(**dict((k, -v) for k, v in moved.items()))
+                self.parent.children.remove(self)
+            
+            # re-root the materialized path of the whole subtree
+            old_path = self.tree_path
+            new_path = parent.tree_path + self.id + '/'
+            Folder.query.filter(self.subtree_filter())\
+                        .update({Folder.tree_path: literal(new_path).concat(func.substr(Folder.tree_path, len(old_path) + 1))},
+                                synchronize_session='fetch')
             
             self.parent_id = parent.id
             self.parent = Folder.query.filter_by(id=self.parent_id).first()
             self.parent.children.append(self)
+            db.session.flush()
+            self.parent.update_counters(**moved)
+            if commit:
+                db.session.commit()
+            return True
+        return False
+            
+    def ancestor_ids(self):
+        # return: List of the ids of the root folder, ..., the parent and self
+        return self.tree_path.strip('/').split('/')
+        
+    def invalidate_pages(self, subtree=False):
+    
+        """
+            subtree: bool
+            
+            Marks the cached pages of this folder and its ancestors (and, if 
+            subtree is True, of all of its descendants) as changed, as of the 
+            next commit (see page_cache.py).
+        """
+        
+        page_cache.invalidate(self.ancestor_ids())
+        if subtree:
+            page_cache.invalidate(id for (id,) in db.session.query(Folder.id).filter(self.subtree_filter()))
+        
+    def subtree_filter(self):
+    
+        """
+            Returns a filter expression selecting this folder and all of its 
+            descendants: a range scan over the tree_path index.
+        """
+        
+        # every descendant path starts with "<tree_path>", and '0' sorts 
+        # right after '/' (IDs never contain '/')
+        return and_(Folder.tree_path >= self.tree_path, 
+                    Folder.tree_path < self.tree_path[:-1] + '0')
+        
+    def update_counters(self, folders=0, files=0, bytes=0):
+    
+        """
+            folders: int
+            files: int
+            bytes: int
+            
+            Atomically adds the given deltas to the subtree counters of this 
+            folder and all of its ancestors (does not commit).
+        """
+        
+        self.invalidate_pages()
+        if not (folders or files or bytes):
+            return
+        Folder.query.filter(Folder.id.in_(self.ancestor_ids()))\
+                    .update({Folder.subtree_folders: Folder.subtree_folders + folders,
+                             Folder.subtree_files: Folder.subtree_files + files,
+                             Folder.subtree_bytes: Folder.subtree_bytes + bytes}, 
+                            synchronize_session='fetch')
+                            
+    @staticmethod
+    def update_counters_many(deltas):
+    
+        """
+            deltas: Dict of folder id -> (folders, files, bytes)
+            
+            Adds per-folder deltas to the subtree counters, with one UPDATE 
+            per distinct delta (does not commit).
+        """
+        
+        page_cache.invalidate(deltas)
+        groups = {}
+        for id, delta in deltas.items():
+            groups.setdefault(tuple(delta), []).append(id)
+        for (folders, files, bytes), ids in groups.items():
+            if not (folders or files or bytes):
+                continue
+            Folder.query.filter(Folder.id.in_(ids))\
+                        .update({Folder.subtree_folders: Folder.subtree_folders + folders,
+                                 Folder.subtree_files: Folder.subtree_files + files,
+                                 Folder.subtree_bytes: Folder.subtree_bytes + bytes}, 
+                                synchronize_session='fetch')
+                            
+    @staticmethod
+    def rebuild_counters(verify=False):
+    
+        """
+            verify: bool
+            
+            Recomputes the subtree counters of every folder from scratch and
+            returns the list of folders whose stored counters had drifted. 
+            Nothing is written if verify is True.
+        """
+        
+        parents = dict(db.session.query(Folder.id, Folder.parent_id))
+        totals = dict((id, [0, 0, 0]) for id in parents)
+        file_totals = db.session.query(File.folder_id, func.count(File.id), func.coalesce(func.sum(File.size), 0))\
+                                .group_by(File.folder_id)
+        
+        # add each folder's own files and the folder itself to all of its ancestors
+        for folder_id, files, bytes in file_totals:
+            id = folder_id
+            while id in totals:
+                totals[id][1] += files
+                totals[id][2] += bytes
+                id = parents[id]
+        for folder_id in parents:
+            id = parents[folder_id]
+            while id in totals:
+                totals[id][0] += 1
+                id = parents[id]
+                
+        drifted = []
+        for folder in Folder.query.yield_per(1000):
+            if [folder.subtree_folders, folder.subtree_files, folder.subtree_bytes] != totals[folder.id]:
+                drifted.append(folder)
+        if not verify:
+            for folder in drifted:
+                folder.subtree_folders, folder.subtree_files, folder.subtree_bytes = totals[folder.id]
             db.session.commit()
+        return drifted
             
-
     def is_child_of(self, folder):
         """
             Returns true if self is a child of folder 
         """
-        parent_folder = self.parent
-        while parent_folder:
-            if parent_folder == folder:
-                return True
-            parent_folder = parent_folder.parent
-            
-        return False
+        return self != folder and self.tree_path.startswith(folder.tree_path)
         
 
-    def search(self, term, user=None, recursive=True):
+    def search(self, term, user=None, recursive=True, limit=None):
         
         """
             
             term: str
             user: User
             recursive: bool
+            limit: int - maximum number of results (defaults to MAX_SEARCH_RESULTS)
 
-            Performs a depth-first search for files and folders that match the given search term, 
-            returns a list of File results.
-        
-            TODO: Replace with a more efficient query (this is just a prototype feature 
-            and isn't super scalable as-is...)
+            Searches the folder (and, if recursive, every subfolder reachable 
+            through folders visible to the user) for files and folders whose 
+            names match the given search term. Returns a list of Folder and 
+            File results, folders first, each ranked by relevance.
+            
+            The subtree is collected in a single query (see Folder.subtree), so
+            the number of queries does not depend on the size of the tree.
+            Names are matched through the full-text index (see search_index.py)
+            when it is available.
             
         """
-        results = []
+        if not limit:
+            limit = app.config['MAX_SEARCH_RESULTS']
+            
+        if recursive:
+            folder_ids = db.session.query(self.subtree(user=user).c.id)
+        else:
+            folder_ids = [self.id]
+            
+        matched_folders = Folder.with_profile("listing").filter(Folder.parent_id.in_(folder_ids))
+        visible = Folder.visibility_filter(user)
+        if visible is not None:
+            matched_folders = matched_folders.filter(visible)
+        matched_files = File.with_profile("listing").filter(File.folder_id.in_(folder_ids))
         
-        def traverse(folder):
+        if search_index.usable(db.engine, term):
+            matched_folders = search_index.ranked(matched_folders, Folder, term)
+            matched_files = search_index.ranked(matched_files, File, term)
+        else:
+            matched_folders = matched_folders.filter(Folder.name.like('%'+term+'%'))\
+                                             .order_by(desc(Folder.name.like(term+'%')), Folder.name)
+            matched_files = matched_files.filter(File.name.like('%'+term+'%'))\
+                                         .order_by(desc(File.name.like(term+'%')), File.name)
         
-            matched_files = File.query.filter_by(folder_id=folder.id).filter(File.name.like('%'+term+'%')).all()
-            matched_folders = Folder.query.filter_by(parent_id=folder.id).filter(Folder.name.like('%'+term+'%')).all()
+        results = matched_folders.limit(limit).all()
+        return results + matched_files.limit(limit - len(results)).all()
+        
+    def subtree(self, user=None):
+    
+        """
+            user: User
             
-            for file in matched_files:
-                results.append(file)
-            for matched_folder in matched_folders:
-                if matched_folder.visible_to(user):
-                    results.append(matched_folder)
-                
-            for child in folder.children:
-                if child.visible_to(user):
-                    traverse(child)
+            Returns a selectable with a single "id" column holding the id of 
+            this folder and of every descendant reachable through folders 
+            that are visible to the user.
+            
+            The owner (and admins) can see every descendant, so the subtree is 
+            a tree_path range; for other users the range leaves out the 
+            folders whose tree_path starts with that of a hidden descendant 
+            (the hidden folder and everything under it).
+        """
+        
+        subtree = db.session.query(Folder.id.label("id")).filter(self.subtree_filter())
+        if user and (user.is_admin or user.id == self.user_id):
+            return subtree.subquery("subtree")
         
-        traverse(self)      
+        # a plain SELECT: statements starting with WITH lose their result 
+        # description when they return no rows on Python 2's sqlite3
+        hidden = aliased(Folder, name="hidden")
+        hidden_descendants = db.session.query(hidden.id)\
+            .filter(hidden.tree_path > self.tree_path, hidden.tree_path < self.tree_path[:-1] + '0')\
+            .filter(not_(func.coalesce(Folder.visibility_filter(user, hidden), false())))\
+            .filter(func.substr(Folder.tree_path, 1, func.length(hidden.tree_path)) == hidden.tree_path)
         
-        return results
+        return subtree.filter(~hidden_descendants.exists()).subquery("subtree")
+        
+    @staticmethod
+    def visibility_filter(user, folder=None):
+    
+        """
+            user: User
+            folder: Folder or an alias of it (the filtered entity)
+            
+            SQL counterpart of Folder.visible_to. Returns a filter expression 
+            selecting the folders visible to the user, or None if every 
+            folder is visible (admins).
+        """
+        
+        if user and user.is_admin:
+            return None
+            
+        folder = folder or Folder
+        criteria = [and_(folder.private.isnot(True), folder.password_protected.isnot(True))]
+        if user:
+            criteria.append(folder.user_id == user.id)
+            
+        # folders unlocked with a password during this session
+        if has_request_context():
+            for key, value in session.items():
+                # '_flashes' and other keys of Flask's own start with '_'
+                if key not in ('username', 'auth_token') and not key.startswith('_'):
+                    criteria.append(and_(folder.password_protected == True, 
+                                         folder.id == key, folder.pw_hash == value))
+                                         
+        return or_(*criteria)
         
    
     def number_of_files_folders(self, user=None):
@@ -220,21 +609,22 @@ class Folder(db.Model):
             Returns a list containing 2 integers: [folders, files]
             The first integer is the number of subfolders visible to the user.
             the second is the number of files visible to the user.
+            
+            The owner (and admins) can see the whole subtree, so the stored 
+            subtree counters are returned directly. Other users are counted 
+            with a single query over the subtree visible to them.
         """
-    
-        results = [0, 0]
-        results[1] += File.query.filter_by(folder_id=self.id).count()
         
-        def traverse(folder):
-            children = [c for c in folder.children if c.visible_to(user)]
-            for child in children:
-                results[0] += 1
-                results[1] += File.query.filter_by(folder_id=child.id).count()
-                traverse(child)
-                
-        traverse(self)
+        if user and (user.is_admin or user.id == self.user_id):
+            return [self.subtree_folders, self.subtree_files]
         
-        return results
+        subtree = self.subtree(user=user)
+        folders = db.session.query(func.count()).select_from(subtree).scalar() - 1
+        files = File.query.filter(File.folder_id.in_(db.session.query(subtree.c.id))).count()
+        return [folders, files]
+        
+    def get_subtree_size_str(self):
+        return helper_functions.format_bytes(self.subtree_bytes)
 
     
     def get_path(self):
@@ -243,17 +633,13 @@ class Folder(db.Model):
             return: List
         """
         
-        path = [self]
-        parent_folder = self.parent
-        
-        while parent_folder:
-            path.append(parent_folder)
-            parent_folder = parent_folder.parent
+        ids = self.ancestor_ids()
+        folders = dict((folder.id, folder) for folder in Folder.query.filter(Folder.id.in_(ids)))
         
-        return path[::-1]
+        return [folders[id] for id in ids if id in folders]
         
     
-    def get_contents(self, offset=None, limit=None, sort="date", recursive=False, search=None, user=None, selected_file=None):
+    def get_contents(self, offset=None, limit=None, sort="date", recursive=False, search=None, user=None, selected_file=None, after=None):
     
         """
         
@@ -274,10 +660,16 @@ class Folder(db.Model):
             
             limit: int        
             offset: int
-            sort: string ("date", "type" or "name")
+            sort: string ("date", "type", "name" or "relevance" - search results only)
             search: string - terms to be searched
             recursive: boolean - searches all subfolders recursively if set to True
             selected_file: File - if specified, will find the previous/next file objects in the list (for template purposes)
+            after: File or Folder - if specified, returns the page following this item (keyset pagination, offset is ignored)
+            
+            Folder listings are sorted and paginated by the database: only the
+            requested page is loaded, counts come from COUNT queries and the 
+            previous/next files are keyset lookups. Search results are already
+            capped by Folder.search and are sorted in memory.
             
             example usage:
             
@@ -287,21 +679,97 @@ class Folder(db.Model):
             
         """
         
+        if not offset:
+            offset = 0
+            
         if search:
-            search = search.lower()
-            all = self.search(search, user=user, recursive=recursive)
-
+            return self.get_search_contents(search.lower(), offset, limit, sort, recursive, user, selected_file)
+            
+        listing, order = self.listing(sort=sort, user=user)
+        
+        # keyset predicates: rows sorted after/before the given sort key
+        if sort == "date":
+            order_by = [desc(column) for column in order]
+            reverse_order_by = order
+            follows = lambda key: tuple_(*order) < tuple_(*key)
+            precedes = lambda key: tuple_(*order) > tuple_(*key)
         else:
-            all = []
-            subfolders = [child for child in self.children if child.visible_to(user)]
-            files = File.query.filter_by(folder=self).all()
-            all = subfolders + files 
+            order_by = order
+            reverse_order_by = [desc(column) for column in order]
+            follows = lambda key: tuple_(*order) > tuple_(*key)
+            precedes = lambda key: tuple_(*order) < tuple_(*key)
             
-        if not offset:
-            offset = 0
+        def key_of(kind, id):
+            # returns the sort key of a listing row (or None)
+            return db.session.execute(select(order).where(listing.c.kind == kind)
+                                                   .where(listing.c.id == id)).first()
+        
+        total_folders = self.children_query(user).count()
+        total_files = File.query.filter_by(folder_id=self.id).count()
+        total = total_folders + total_files
+        
+        if not limit:
+            limit = total or 1
+        if offset >= total:
+            offset = max(0, (total - 1) // limit * limit)
+            
+        page = select([listing.c.kind, listing.c.id]).order_by(*order_by).limit(limit)
+        after_key = key_of(Folder.KIND if after and after.get_type() == "Folder" else File.KIND, 
+                           after.id) if after else None
+        if after_key:
+            page = page.where(follows(after_key))
+        else:
+            page = page.offset(offset)
+        rows = db.session.execute(page).fetchall()
+        
+        # second stage: load the objects on this page
+        folder_ids = [row.id for row in rows if row.kind == Folder.KIND]
+        file_ids = [row.id for row in rows if row.kind == File.KIND]
+        objects = {}
+        if folder_ids:
+            objects.update(((Folder.KIND, f.id), f) for f in Folder.with_profile("listing")
+                                                                   .filter(Folder.id.in_(folder_ids)))
+        if file_ids:
+            objects.update(((File.KIND, f.id), f) for f in File.with_profile("listing")
+                                                               .filter(File.id.in_(file_ids)))
+        content = [objects[(row.kind, row.id)] for row in rows if (row.kind, row.id) in objects]
+        
+        # previous/next files are keyset lookups around the selected file
+        current_index, prev, next = 0, None, None
+        selected_key = key_of(File.KIND, selected_file.id) if selected_file else None
+        if selected_key:
+            files = select([listing.c.id]).where(listing.c.kind == File.KIND)
+            current_index = db.session.execute(select([func.count()]).select_from(listing)
+                                                                     .where(listing.c.kind == File.KIND)
+                                                                     .where(precedes(selected_key))).scalar() + 1
+            prev_id = db.session.execute(files.where(precedes(selected_key))
+                                              .order_by(*reverse_order_by).limit(1)).scalar()
+            next_id = db.session.execute(files.where(follows(selected_key))
+                                              .order_by(*order_by).limit(1)).scalar()
+            prev = File.with_profile("listing").get(prev_id) if prev_id else None
+            next = File.with_profile("listing").get(next_id) if next_id else None
+        
+        return {
+            "content": content,
+            "prev": prev,
+            "next": next,
+            "total_pages": int(ceil(total / float(limit))),
+            "total_files": total_files,
+            "current_index": current_index,
+            "next_on_same_page?": next in content,
+            "prev_on_same_page?": prev in content,
+        }
+        
+    def get_search_contents(self, search, offset, limit, sort, recursive, user, selected_file):
+    
+        """
+            Same as get_contents, for the (capped) results of Folder.search.
+        """
+        
+        all = self.search(search, user=user, recursive=recursive)
             
         if not limit:
-            limit = len(all)
+            limit = len(all) or 1
         
         if sort == "type":
             folders = [f for f in all if f.get_type() == "Folder"]
@@ -311,12 +779,16 @@ class Folder(db.Model):
 
         elif sort == "name":
             all = sorted(all, key=lambda x: x.name.lower())
+            
+        elif sort == "relevance":
+            # already ranked by Folder.search
+            pass
 
         else:
             all = sorted(all, key=lambda x: x.date, reverse=True)
         
         if offset > len(all):
-            offset = len(all) - limit
+            offset = max(0, len(all) - limit)
             
         content = all[offset:offset + limit]
         
@@ -353,47 +825,121 @@ class Folder(db.Model):
             "next_on_same_page?": next in content,
             "prev_on_same_page?": prev in content,
         }
+        
+    def listing(self, sort="date", user=None):
+    
+        """
+            sort: str ("date", "type" or "name")
+            user: User
+            
+            Returns a tuple (listing, order). listing is a UNION ALL of the 
+            subfolders visible to the user and the files of this folder, with
+            "kind" (Folder.KIND or File.KIND), "id" and "key" columns. order is 
+            the list of listing columns that sort it for the given sort.
+        """
+        
+        if sort == "name":
+            folder_key, file_key = func.lower(Folder.name), func.lower(File.name)
+        elif sort == "type":
+            folder_key, file_key = func.lower(Folder.name), File.extension
+        else:
+            folder_key, file_key = Folder.date, File.date
+            
+        folders = select([literal(Folder.KIND).label("kind"), Folder.id.label("id"), folder_key.label("key")])\
+                    .where(Folder.parent_id == self.id)
+        visible = Folder.visibility_filter(user)
+        if visible is not None:
+            folders = folders.where(visible)
+        files = select([literal(File.KIND).label("kind"), File.id.label("id"), file_key.label("key")])\
+                    .where(File.folder_id == self.id)
+        listing = union_all(folders, files).alias("listing")
+        
+        if sort == "type":
+            # folders first, then files by extension
+            return listing, [listing.c.kind, listing.c.key, listing.c.id]
+        return listing, [listing.c.key, listing.c.kind, listing.c.id]
+        
+    def children_query(self, user=None):
+        # return: Query of the subfolders visible to the user
+        children = Folder.query.filter_by(parent_id=self.id)
+        visible = Folder.visibility_filter(user)
+        if visible is not None:
+            children = children.filter(visible)
+        return children
 
     def get_type(self):
         return "Folder"
         
     def visible_to(self, user):
-	if user and user.is_admin:
+        # memoized for the duration of the request
+        visibility = helper_functions.request_cache('folder_visibility')
+        key = (self.id, user.id if user else None)
+        if key not in visibility:
+            visibility[key] = self.check_visibility(user)
+        return visibility[key]
+        
+    def check_visibility(self, user):
+        if user and user.is_admin:
             return True
         if self.password_protected and self.id in session and session[self.id] == self.pw_hash:
             return True
         
-        return self.user == user or (not self.private and not self.password_protected)
+        return self.user_id == (user.id if user else None) or (not self.private and not self.password_protected)
     
     def has_password(self):
         return self.pw_hash != None
         
-    def update(self):
+    def update(self, commit=True):
         for folder in self.get_path():
             folder.date = datetime.utcnow()
-        db.session.commit()
+        self.invalidate_pages()
+        if commit:
+            db.session.commit()
         
         
-class File(db.Model):
+class File(RandomIds, LoadProfiles, db.Model):
+
+    # listing row kind (see Folder.listing)
+    KIND = 1
+    
+    LOAD_PROFILES = {
+        # files listed on a page or in search results (File.visible_to)
+        "listing": [joinedload("folder")],
+        # a single file and its owner
+        "view": [joinedload("folder").joinedload("user")],
+    }
 
     id = db.Column(db.String(20), primary_key=True)
     name = db.Column(db.String(128))
-    folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'))
+    folder_id = db.Column(db.String(32), db.ForeignKey('folder.id'))
     extension = db.Column(db.String(10))
-    path = db.Column(db.String())
+    path = db.Column(db.String(), index=True)
     thumb_path = db.Column(db.String())
     date = db.Column(db.DateTime)
     type = db.Column(db.String)
     size = db.Column(db.Integer)
-    md5 = db.Column(db.String(32))
+    md5 = db.Column(db.String(32), index=True)
     full_name = db.Column(db.String)
+    # background thumbnail generation (see thumbnails.py)
+    thumb_status = db.Column(db.String(10), index=True)
+    thumb_attempts = db.Column(db.Integer, default=0)
     
-    def __init__(self, name, folder_id):
+    # folder listings sort in SQL (see Folder.listing)
+    __table_args__ = (
+        db.Index('ix_file_folder_date', folder_id, date),
+        db.Index('ix_file_folder_name', folder_id, func.lower(name)),
+        db.Index('ix_file_folder_extension', folder_id, extension),
+        # duplicate check on upload (see query_plans.py)
+        db.Index('ix_file_folder_md5', folder_id, md5),
+    )
+    
+    def __init__(self, name, folder_id, id=None):
     
         # name: str
         # folder_id: str
+        # id: str (from File.allocate_ids, a new one if not given)
     
-        self.id = self.generate_id()
+        self.id = id or self.allocate_ids()[0]
         self.name = secure_filename(name)
         self.extension = self.get_extension()
         self.folder_id = folder_id
@@ -401,6 +947,7 @@ class File(db.Model):
         self.path = os.path.join(app.config['UPLOAD_FOLDER'], self.full_name)
         self.date = datetime.utcnow()
         self.thumb_path = None
+        self.thumb_status = None
         self.md5 = None
         self.type = self.get_type()
         self.size = 0
@@ -418,13 +965,14 @@ class File(db.Model):
         }
     
         if self.get_type() == "Image":
-            # open the image and generate a 250x250 thumbnail
-            img = Image.open(site_path+self.path).convert('RGB')
-            thumb = ImageOps.fit(img, (250,250), Image.BICUBIC)
-            self.thumb_path = os.path.join(app.config['THUMBNAIL_FOLDER'], self.id + "_" + self.name)
-            thumb.save(site_path+self.thumb_path, quality=100)
+            # the thumbnails are generated in the background (see
+            # thumbnails.py), show a placeholder until they are ready
+            self.thumb_path = os.path.join(app.config['THUMBNAIL_FOLDER'], "pending.png")
+            self.thumb_status = thumbnails.PENDING
+            self.thumb_attempts = 0
         else:
             self.thumb_path = type_paths[self.get_type()]
+            self.thumb_status = thumbnails.READY
 
     
     def get_extension(self):
@@ -432,14 +980,6 @@ class File(db.Model):
         return self.name.split('.')[-1].lower()
     
     
-    def generate_id(self):
-        # return: str
-        id = helper_functions.generate_random_string(9)
-        existing_file = File.query.filter_by(id=id).first()
-        if existing_file:
-            return self.generate_id()
-        return id
-
     def get_type(self):
         extension = self.extension
         types = {
@@ -456,30 +996,109 @@ class File(db.Model):
                 return type
         return "Other"
         
-    def delete(self):
-        path = self.path
-        thumb_path = self.thumb_path
-        type = self.type
-        self.folder.user.used_storage -= self.size
+    def delete(self, update_counters=True, commit=True):
+        quota.charge(self.folder.user_id, -self.size)
+        if update_counters:
+            self.folder.update_counters(files=-1, bytes=-self.size)
+        # the data itself is removed by Blob.collect_garbage once unreferenced
+        if self.md5:
+            Blob.release(self.md5)
         db.session.delete(self)
-        db.session.commit()
-        # delete the data from the server if no other File points to it
-        if not File.query.filter_by(path=path).count() > 0:
-            try:
-                os.remove(path)
-                if type == "Image":
-                    os.remove(site_path+thumb_path)
-            except:
-                pass
+        if commit:
+            db.session.commit()
+            
+    @staticmethod
+    def totals_by_folder(criterion):
+    
+        # criterion: filter expression selecting files
+        # return: List of (folder id, user id, folder tree_path, files, bytes)
+        
+        # aliased, so that criterion can have its own subqueries over folder
+        folder = aliased(Folder)
+        return db.session.query(folder.id, folder.user_id, folder.tree_path, 
+                                func.count(File.id), func.coalesce(func.sum(File.size), 0))\
+                         .join(folder, File.folder_id == folder.id)\
+                         .filter(criterion)\
+                         .group_by(folder.id, folder.user_id, folder.tree_path).all()
+            
+    @staticmethod
+    def delete_many(criterion, update_counters=True):
+    
+        """
+            criterion: filter expression selecting the files
+            update_counters: bool - False if the caller takes care of the 
+                                    folder counters (e.g. a deleted subtree)
+            
+            Deletes the selected files with a few set-based statements (does 
+            not commit): the owners' used storage, the folder counters and 
+            the blob references are adjusted with aggregate updates, and the 
+            data is left for Blob.collect_garbage. Returns the number of 
+            files deleted.
+        """
+        
+        totals = File.totals_by_folder(criterion)
+        
+        used_storage = {}
+        counters = {}
+        for folder_id, user_id, tree_path, files, bytes in totals:
+            used_storage[user_id] = used_storage.get(user_id, 0) + bytes
+            for id in tree_path.strip('/').split('/'):
+                delta = counters.get(id, (0, 0, 0))
+                counters[id] = (0, delta[1] - files, delta[2] - bytes)
+        for user_id, bytes in used_storage.items():
+            quota.charge(user_id, -bytes)
+        if update_counters:
+            Folder.update_counters_many(counters)
+        
+        # one reference less per deleted file
+        references = select([func.count(File.id)]).where(File.md5 == Blob.md5).where(criterion).as_scalar()
+        Blob.query.filter(Blob.md5.in_(select([File.md5]).where(criterion)))\
+                  .update({Blob.refcount: Blob.refcount - references, 
+                           Blob.released_at: datetime.utcnow()}, synchronize_session=False)
+                  
+        return File.query.filter(criterion).delete(synchronize_session=False)
+        
+    @staticmethod
+    def move_many(criterion, folder):
+    
+        """
+            criterion: filter expression selecting the files
+            folder: Folder
+            
+            Moves the selected files into folder with one UPDATE, adjusting 
+            the counters of the source and destination folders (does not 
+            commit). Returns the number of files moved.
+        """
+        
+        criterion = and_(criterion, File.folder_id != folder.id)
+        counters = {}
+        moved_files, moved_bytes = 0, 0
+        for folder_id, user_id, tree_path, files, bytes in File.totals_by_folder(criterion):
+            for id in tree_path.strip('/').split('/'):
+                delta = counters.get(id, (0, 0, 0))
+                counters[id] = (0, delta[1] - files, delta[2] - bytes)
+            moved_files += files
+            moved_bytes += bytes
+        for id in folder.ancestor_ids():
+            delta = counters.get(id, (0, 0, 0))
+            counters[id] = (0, delta[1] + moved_files, delta[2] + moved_bytes)
+        Folder.update_counters_many(counters)
+        
+        return File.query.filter(criterion).update({File.folder_id: folder.id}, synchronize_session='fetch')
 
     def get_size_str(self):
         return helper_functions.format_bytes(self.size)
         
-    def set_size(self):
+    def set_size(self, size=None, commit=True):
+    
+        # size: int - if not given, the size of the file on disk
         
-        self.size = os.path.getsize(site_path+self.path)
-        self.folder.user.used_storage += self.size
-        db.session.commit()
+        old_size = self.size or 0
+        self.size = os.path.getsize(site_path+self.path) if size is None else size
+        quota.charge(self.folder.user_id, self.size - old_size)
+        self.folder.update_counters(bytes=self.size - old_size)
+        if commit:
+            db.session.commit()
         
     def visible_to(self, user):
         # return: bool
@@ -496,23 +1115,390 @@ class File(db.Model):
         self.md5 = md5_gen.hexdigest()
         db.session.commit()
         
-    def check_duplicates(self):
+    def set_blob(self, blob):
+    
+        """
+            blob: Blob
+            
+            Points the file to the stored data (and thumbnail) of the blob. 
+            The blob's data must already be on disk.
+        """
+        
+        self.md5 = blob.md5
+        self.full_name = blob.path
+        self.path = os.path.join(app.config['UPLOAD_FOLDER'], blob.path)
+        if self.get_type() == "Image" and blob.thumb_path:
+            self.thumb_path = blob.thumb_path
+            self.thumb_status = thumbnails.READY
+        else:
+            self.set_thumbnail()
+        if archives.is_archive(self.name) and blob.archive_status is None:
+            blob.archive_status = archives.PENDING
+                
+    def get_thumb_path(self, size=None):
+        # size: int (one of thumbnails.SIZES, None for the default size)
+        # return: str
+        return thumbnails.sized_path(self.thumb_path, size or thumbnails.DEFAULT_SIZE)
+        
+    def get_mimetype(self):
+        # return: str
+        return mimetypes.guess_type(self.name)[0] or 'application/octet-stream'
+        
+        
+class Blob(db.Model):
+
+    """
+        Stored file data, addressed by its MD5 digest. Files with the same 
+        contents share one Blob, which counts its references; unreferenced 
+        blobs are removed from disk by a deferred garbage collection sweep.
+    """
+    
+    md5 = db.Column(db.String(32), primary_key=True)
+    path = db.Column(db.String())   # relative to UPLOAD_FOLDER
+    thumb_path = db.Column(db.String())
+    size = db.Column(db.BigInteger)
+    refcount = db.Column(db.Integer)
+    released_at = db.Column(db.DateTime, index=True)
+    # member listing of an archive (see archives.py)
+    archive_status = db.Column(db.String(12), index=True)
+    
+    def get_disk_path(self):
+        # return: str
+        return site_path + os.path.join(app.config['UPLOAD_FOLDER'], self.path)
+        
+    def get_thumb_paths(self):
+        # return: List of str (every size of the thumbnail)
+        return thumbnails.all_paths(self.thumb_path) if self.thumb_path else []
+        
+    @staticmethod
+    def acquire(md5):
+    
+        """
+            md5: str
+            
+            Adds a reference to the blob with the given digest and returns it,
+            or returns None if no such blob is stored.
+        """
+        
+        if Blob.query.filter_by(md5=md5).update({Blob.refcount: Blob.refcount + 1, Blob.released_at: None}, 
+                                                synchronize_session=False):
+            return Blob.query.get(md5)
+        return None
+        
+    @staticmethod
+    def store(md5, size, upload):
+    
+        """
+            md5: str
+            size: int
+            upload: IngestFile
+            
+            Returns the blob with the given digest (with a new reference), 
+            moving the uploaded data into the store if it isn't there yet.
+            Otherwise the upload is discarded without being written.
+        """
+        
+        blob = Blob.acquire(md5)
+        if blob:
+            upload.discard()
+            return blob
+            
+        # insert-if-absent, so that concurrent uploads of the same data agree
+        # on a single blob (the new row starts unreferenced, within the 
+        # garbage collection grace period)
+        values = dict(md5=md5, size=size, refcount=0, released_at=datetime.utcnow(),
+                      path=os.path.join(md5[0:2], md5[2:4], md5))   # sharded: ab/cd/abcd...
+        if db.engine.dialect.name == 'postgresql':
+            insert = postgresql.insert(Blob.__table__).values(**values).on_conflict_do_nothing()
+        else:
+            insert = Blob.__table__.insert().values(**values)\
+                                   .prefix_with('OR IGNORE', dialect='sqlite')\
+                                   .prefix_with('IGNORE', dialect='mysql')
+        created = db.session.execute(insert).rowcount == 1
+        blob = Blob.acquire(md5)
+        
+        if created:
+            directory = os.path.dirname(blob.get_disk_path())
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # created concurrently
+                    pass
+            upload.move_to(blob.get_disk_path())
+        else:
+            upload.discard()
+        return blob
         
+    @staticmethod
+    def release(md5):
+        # removes a reference to the blob with the given digest (does not commit)
+        Blob.query.filter_by(md5=md5).update({Blob.refcount: Blob.refcount - 1, 
+                                              Blob.released_at: datetime.utcnow()}, 
+                                             synchronize_session=False)
+                                             
+    @staticmethod
+    def collect_garbage(grace_period=3600):
+    
         """
-            Checks if the file already exists on the server. If it does,
-            simply have the file point to the old path, and delete the duplicate 
-            (to save server space).
+            grace_period: int - seconds a blob must have been unreferenced for
+            
+            Deletes the unreferenced blobs and their data from the server. 
+            Returns the number of blobs removed.
         """
-        existing_file = File.query.filter_by(md5=self.md5).order_by(File.date).first()
-        if existing_file and existing_file != self:
-            os.remove(site_path+self.path)
-            if self.get_type() == "Image":
-                os.remove(site_path+self.thumb_path)
-            self.path = existing_file.path
-            self.full_name = existing_file.full_name
-            self.thumb_path = existing_file.thumb_path
+        
+        released_before = datetime.utcnow() - timedelta(seconds=grace_period)
+        candidates = Blob.query.filter(Blob.refcount <= 0).filter(Blob.released_at < released_before)
+        candidates = [(blob.md5, [blob.get_disk_path()] + 
+                                 [site_path + path for path in blob.get_thumb_paths()])
+                      for blob in candidates]
+        removed = 0
+        for md5, paths in candidates:
+            # only delete if it wasn't referenced again in the meantime
+            deleted = Blob.query.filter_by(md5=md5).filter(Blob.refcount <= 0)\
+                                .delete(synchronize_session=False)
+            if deleted:
+                ArchiveMember.query.filter_by(md5=md5).delete(synchronize_session=False)
             db.session.commit()
+            if deleted and not Blob.query.get(md5):
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                removed += 1
+        return removed
+        
+        
+class ArchiveMember(db.Model):
+
+    # a file or directory inside an archive, in archive order (see archives.py)
+    
+    md5 = db.Column(db.String(32), primary_key=True)     # the archive's blob
+    position = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String())
+    size = db.Column(db.BigInteger)
+    is_dir = db.Column(db.Boolean)
+    offset = db.Column(db.BigInteger)   # of the data, in uncompressed tars
+        
+        
+class ChunkedUpload(RandomIds, db.Model):
 
+    """
+        A file uploaded in chunks (see chunked_uploads.py). The data received
+        so far is in a part file under UPLOAD_FOLDER; `offset` is the number
+        of bytes acknowledged to the client, where an interrupted upload 
+        resumes.
+    """
+    
+    # the id is the client's handle on the upload
+    ID_LENGTH = 24
+    
+    id = db.Column(db.String(24), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    folder_id = db.Column(db.String(32), db.ForeignKey('folder.id'))
+    filename = db.Column(db.String(128))
+    size = db.Column(db.BigInteger)
+    offset = db.Column(db.BigInteger)
+    reservation_id = db.Column(db.Integer)
+    date = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, index=True)
+    
+    def __init__(self, user_id, folder_id, filename, size, reservation_id, id=None):
+    
+        # user_id: int
+        # folder_id: str
+        # filename: str
+        # size: int
+        # reservation_id: int (StorageReservation holding size bytes)
+        
+        self.id = id or self.allocate_ids()[0]
+        self.user_id = user_id
+        self.folder_id = folder_id
+        self.filename = filename
+        self.size = size
+        self.offset = 0
+        self.reservation_id = reservation_id
+        self.date = self.updated_at = datetime.utcnow()
+        
+    def get_part_path(self):
+        # return: str
+        return site_path + os.path.join(app.config['UPLOAD_FOLDER'], 'chunks', self.id)
+        
+        
+class Event(db.Model):
+
+    """
+        Raw logged event (see events.py). Download events are rolled up 
+        into DownloadCount rows by the aggregation job.
+    """
+    
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.Integer)
+    user_id = db.Column(db.Integer)
+    ip = db.Column(db.String(45))
+    folder_id = db.Column(db.String(32))
+    file_id = db.Column(db.String(20))
+    date = db.Column(db.DateTime, index=True)
+    
+    
+class DownloadCount(db.Model):
+
+    # number of downloads of a file on a day (UTC)
+    
+    __table_args__ = (db.Index('ix_download_count_folder_day', 'folder_id', 'day'),)
+    
+    day = db.Column(db.Date, primary_key=True)
+    file_id = db.Column(db.String(20), primary_key=True)
+    folder_id = db.Column(db.String(32))
+    downloads = db.Column(db.Integer)
+    
+    def __init__(self, day, file_id, folder_id, downloads=0):
+        self.day = day
+        self.file_id = file_id
+        self.folder_id = folder_id
+        self.downloads = downloads
+        
+    @staticmethod
+    def for_folder(folder_id, since):
+    
+        # folder_id: str
+        # since: date
+        # return: List of (date, int)
+        
+        """Returns the daily downloads of the files in a folder."""
+        return db.session.query(DownloadCount.day, func.sum(DownloadCount.downloads))\
+                         .filter(DownloadCount.folder_id == folder_id)\
+                         .filter(DownloadCount.day >= since)\
+                         .group_by(DownloadCount.day).order_by(DownloadCount.day).all()
+        
+        
+class FolderDownloadCount(db.Model):
+
+    # number of zip downloads of a folder on a day (UTC)
+    
+    folder_id = db.Column(db.String(32), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    downloads = db.Column(db.Integer)
+    
+    def __init__(self, day, folder_id, downloads=0):
+        self.day = day
+        self.folder_id = folder_id
+        self.downloads = downloads
+        
+        
+@manager.command
+def rebuild_counters(verify=False):
+    """Recomputes the folder subtree counters (--verify only reports drift)"""
+    drifted = Folder.rebuild_counters(verify=verify)
+    for folder in drifted:
+        print("%s %s: %d folders, %d files, %d bytes" % ("drifted" if verify else "repaired", folder.id, 
+              folder.subtree_folders, folder.subtree_files, folder.subtree_bytes))
+    print("%d folder(s) %s" % (len(drifted), "drifted" if verify else "repaired"))
+    
+    
+@manager.command
+def reconcile_quota(verify=False):
+    """Expires stale upload reservations and recomputes used storage (--verify only reports drift)"""
+    if not verify:
+        print("%d stale reservation(s) expired" % quota.expire_reservations())
+    drifted = quota.reconcile(verify=verify)
+    for user, used, reserved in drifted:
+        print("%s %s: %d bytes used, %d bytes reserved" % ("drifted" if verify else "repaired", 
+              user.username, used, reserved))
+    print("%d user(s) %s" % (len(drifted), "drifted" if verify else "repaired"))
+    
+    
+@manager.command
+def expire_uploads():
+    """Removes the chunked uploads that stopped receiving chunks"""
+    import chunked_uploads
+    print("%d upload(s) expired" % chunked_uploads.expire())
+    
+    
+@manager.option('-g', '--grace-period', dest='grace_period', type=int, default=3600,
+                help='Seconds a blob must have been unreferenced for')
+@manager.option('-i', '--interval', dest='interval', type=int, default=None,
+                help='Keep sweeping every INTERVAL seconds')
+def collect_garbage(grace_period, interval):
+    """Removes unreferenced file data from the server"""
+    while True:
+        print("%d blob(s) removed" % Blob.collect_garbage(grace_period=grace_period))
+        if not interval:
+            break
+        time.sleep(interval)
+    
+    
+@manager.option('-p', '--processes', dest='processes', type=int, default=None,
+                help='Size of the process pool (defaults to the number of CPUs)')
+@manager.option('-o', '--once', dest='once', action='store_true', default=False,
+                help='Exit once the queue is empty')
+def thumbnail_worker(processes, once):
+    """Generates queued thumbnails until interrupted"""
+    thumbnails.run_worker(processes=processes, once=once)
+    
+    
+@manager.option('-a', '--all', dest='all', action='store_true', default=False,
+                help='Also regenerate thumbnails that are up to date')
+def regenerate_thumbnails(all):
+    """Queues the thumbnails of existing images for the thumbnail worker"""
+    print("%d file(s) queued" % thumbnails.regenerate(all=all))
+    
+    
+@manager.option('-o', '--once', dest='once', action='store_true', default=False,
+                help='Exit once the queue is empty')
+def archive_indexer(once):
+    """Indexes the members of queued archives until interrupted"""
+    archives.run_indexer(once=once)
+    
+    
+@manager.option('-a', '--all', dest='all', action='store_true', default=False,
+                help='Also index archives that were indexed already')
+def queue_archives(all):
+    """Queues existing archives for the archive indexer"""
+    print("%d archive(s) queued" % archives.queue(all=all))
+    
+    
+@manager.command
+def aggregate_events():
+    """Rolls the download events of past days into daily file and folder download counts"""
+    print("%d download(s) aggregated" % events.aggregate())
+    
+    
+@manager.command
+def check_query_budgets():
+    """Checks the number of SQL statements of the main routes"""
+    import query_counter
+    failed = 0
+    for route, statements, budget, status in query_counter.check_route_budgets():
+        problem = "OVER BUDGET" if statements > budget else "STATUS %d" % status if not 200 <= status < 400 else ""
+        print("%-25s %4d / %4d %s" % (route, statements, budget, problem))
+        failed += bool(problem)
+    if failed:
+        raise SystemExit(1)
+    
+    
+@manager.option('-d', '--database', dest='database', action='store_true', default=False,
+                help='check the configured database instead of a fresh one')
+def check_query_plans(database=False):
+    """Checks that the hot lookups are answered through indexes"""
+    import query_plans
+    scanning = 0
+    for name, plan, scans in query_plans.check_query_plans(database=database):
+        print("%-25s %s" % (name, "FULL SCAN" if scans else "ok"))
+        if scans:
+            print("\n".join("    " + line for line in plan))
+            scanning += 1
+    if scanning:
+        raise SystemExit(1)
+    
+    
+@manager.command
+def rebuild_search_index():
+    """Creates and repopulates the full-text name index"""
+    with db.engine.begin() as connection:
+        search_index.rebuild(connection)
+    
     
 if __name__ == '__main__':
     manager.run()
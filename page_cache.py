@@ -0,0 +1,202 @@
+"""
+-------------------------------------------------------------
+                      PAGE CACHE
+  Rendered folder pages for anonymous visitors, keyed by the
+ folder, the viewer's permission class and the page options,
+   kept in an in-process LRU or in a Redis-compatible server.
+-------------------------------------------------------------
+
+PAGE_CACHE selects the backend:
+
+    None      nothing is cached
+    'memory'  LRU of PAGE_CACHE_SIZE pages in each process. Invalidations
+              only reach the process making the write, so use it with a
+              single web process and no background writers.
+    'redis'   shared by every process, at PAGE_CACHE_REDIS_URL (requires
+              the redis package)
+
+Every folder has a version number, part of the key of its cached pages.
+Writes record the folders whose pages they change (see invalidate); the
+versions are bumped when the transaction commits, so the old pages are
+never served again. A page rendered from data read before the bump is
+stored under the old version, where no request looks for it.
+
+A folder page shows the folder's contents, the counts of its subtree and
+its path, so a write invalidates the folder it touches and all of its
+ancestors, plus the whole subtree when the path or visibility of the
+folders below changes (moves, renames, privacy settings, deletions).
+
+Only anonymous visitors without session state share pages: other pages
+show the viewer's name, their forms, their flashed messages or folders
+unlocked with a password.
+"""
+
+import threading
+from collections import OrderedDict
+from flask import session
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import models
+
+
+# permission classes whose pages are cached
+CACHED_CLASSES = ("anonymous",)
+
+_backend = None
+_lock = threading.Lock()
+
+
+class MemoryBackend(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.pages = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def version(self, folder_id):
+        return self.versions.get(folder_id, 0)
+
+    def get(self, key):
+        with self.lock:
+            html = self.pages.pop(key, None)
+            if html is not None:
+                # most recently used last
+                self.pages[key] = html
+            return html
+
+    def set(self, key, html):
+        with self.lock:
+            self.pages.pop(key, None)
+            self.pages[key] = html
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+    def invalidate(self, folder_ids):
+        with self.lock:
+            for id in folder_ids:
+                self.versions[id] = self.versions.get(id, 0) + 1
+
+
+class RedisBackend(object):
+
+    def __init__(self, url, ttl):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+
+    def version(self, folder_id):
+        return int(self.client.get("gofr:folder-version:" + folder_id) or 0)
+
+    def get(self, key):
+        html = self.client.get(self.page_key(key))
+        return html.decode("utf-8") if html is not None else None
+
+    def set(self, key, html):
+        self.client.setex(self.page_key(key), self.ttl, html.encode("utf-8"))
+
+    @staticmethod
+    def page_key(key):
+        # the parts are length-prefixed: no two keys can join into the same string
+        return "gofr:page:" + "".join("%d:%s" % (len(part), part) for part in key)
+
+    def invalidate(self, folder_ids):
+        pipeline = self.client.pipeline(transaction=False)
+        for id in folder_ids:
+            pipeline.incr("gofr:folder-version:" + id)
+        pipeline.execute()
+
+
+def backend():
+
+    # return: MemoryBackend, RedisBackend or None
+
+    global _backend
+    config = models.app.config
+    if not config['PAGE_CACHE']:
+        return None
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                if config['PAGE_CACHE'] == 'redis':
+                    _backend = RedisBackend(config['PAGE_CACHE_REDIS_URL'], config['PAGE_CACHE_TTL'])
+                else:
+                    _backend = MemoryBackend(config['PAGE_CACHE_SIZE'])
+    return _backend
+
+
+def permission_class(folder, user):
+
+    # folder: Folder
+    # user: User
+    # return: str
+
+    if user:
+        return "owner" if user.is_admin or user.id == folder.user_id else "user"
+    if session:
+        # unlocked folders, pending flashed messages...
+        return "session"
+    return "anonymous"
+
+
+def key(folder, user, *options):
+
+    # folder: Folder
+    # user: User
+    # options: the page options, as the view has normalized them (str or None)
+    # return: tuple, or None if the page can't be cached
+
+    """Returns the cache key of the page, which includes the folder's
+       current version. Options that can take any value (ids of the
+       request) are only part of the keys of pages that were stored, and
+       the view only stores pages of items that exist.
+    """
+    cache = backend()
+    viewer = permission_class(folder, user)
+    if cache is None or viewer not in CACHED_CLASSES:
+        return None
+    version = cache.version(folder.id)
+    return (folder.id, str(version), viewer) + tuple(option or "" for option in options)
+
+
+def lookup(key):
+
+    # key: tuple
+    # return: str or None
+
+    return backend().get(key)
+
+
+def store(key, html):
+
+    # key: tuple
+    # html: str
+
+    # pages that flashed a message or changed the session are not shared
+    if not session.modified:
+        backend().set(key, html)
+
+
+def invalidate(folder_ids):
+
+    # folder_ids: iterable of str
+
+    """Marks the pages of the given folders as changed. The cached pages
+       are dropped when the current transaction commits (and the marks
+       discarded if it's rolled back).
+    """
+    if not models.app.config['PAGE_CACHE']:
+        return
+    models.db.session().info.setdefault("page_cache", set()).update(folder_ids)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    folder_ids = session.info.pop("page_cache", None)
+    if folder_ids and backend():
+        backend().invalidate(sorted(folder_ids))
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    session.info.pop("page_cache", None)
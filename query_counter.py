@@ -0,0 +1,199 @@
+"""
+-------------------------------------------------------------
+                     QUERY COUNTER
+  Counts the SQL statements issued while a block of code or a
+ request runs, and checks the main routes against an upper
+   bound (ROUTE_BUDGETS) on a generated folder tree.
+-------------------------------------------------------------
+
+usage: python models.py check_query_budgets
+
+The budgets do not depend on the number of rows on a page: a route that
+goes over budget has grown an N+1 pattern (see the LOAD_PROFILES of the
+models). The count covers the view and the model calls it makes; the
+templates are rendered too where the site's templates are installed, and
+replaced by empty ones otherwise, so the check runs on a bare checkout.
+Each request runs in an app context of its own, as it would in production
+(nothing is memoized on `g` across requests), and the fixture's files and
+thumbnails are written to disk, so every route answers for real: one that
+doesn't answer with a success or a redirect fails the check as well.
+
+example usage:
+
+    with max_queries(5):
+        folder.get_contents(0, 25)
+"""
+
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from jinja2 import ChoiceLoader, FunctionLoader
+from sqlalchemy import event
+import models
+
+
+# route name -> maximum number of SQL statements per request
+ROUTE_BUDGETS = {
+    "folder (owner)": 12,
+    "folder (anonymous)": 12,
+    "folder (selected file)": 18,
+    "folder (search)": 12,
+    "folder (anonymous search)": 12,
+    "folder zip (anonymous)": 6,
+    "user": 6,
+    "file": 4,
+    "thumbnail": 4,
+}
+
+
+class QueryCounter(object):
+
+    """Context manager recording the statements executed on an engine."""
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        if self.engine is None:
+            self.engine = models.db.engine
+        event.listen(self.engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._record)
+
+    def _record(self, connection, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def max_queries(limit, engine=None):
+
+    # limit: int
+
+    """Raises AssertionError (listing the statements) if the block issues
+       more than `limit` SQL statements.
+    """
+    with QueryCounter(engine) as counter:
+        yield counter
+    if counter.count > limit:
+        raise AssertionError("%d statements issued, at most %d expected:\n%s"
+                             % (counter.count, limit, "\n\n".join(counter.statements)))
+
+
+def build_fixture(folders=30, files=60):
+
+    # return: dict of ids used by the routes
+
+    """Creates an owner with a public root folder holding `folders`
+       subfolders (each with a subfolder and a file) and `files` files, so
+       that every listing page is full. The data and thumbnail of every
+       file are written to the UPLOAD_FOLDER and THUMBNAIL_FOLDER.
+    """
+    db, User, Folder, File = models.db, models.User, models.Folder, models.File
+    owner = User("budgetowner", "password")
+    db.session.add(owner)
+    db.session.commit()
+    root = Folder("root", owner.id, private=False)
+    db.session.add(root)
+    db.session.commit()
+
+    for i in range(folders):
+        child = Folder("folder %d" % i, owner.id, private=False)
+        grandchild = Folder("subfolder %d" % i, owner.id, private=False)
+        db.session.add_all([child, grandchild])
+        db.session.flush()
+        child.set_parent(root, commit=False)
+        grandchild.set_parent(child, commit=False)
+        nested = File("nested file %d.txt" % i, child.id)
+        nested.set_thumbnail()
+        child.add_file(nested, commit=False)
+    for i in range(files):
+        file = File("file %d.txt" % i, root.id)
+        file.set_thumbnail()
+        root.add_file(file, commit=False)
+    db.session.commit()
+
+    for file in File.query:
+        for path in (file.path, file.thumb_path):
+            path = os.path.join(models.app.root_path, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as data:
+                data.write(b"budget")
+
+    file = root.files.first()
+    return {"owner": owner.username, "root": root.id, "file": file.id, "empty": grandchild.id}
+
+
+def check_route_budgets(budgets=ROUTE_BUDGETS):
+
+    # return: List of (route: str, statements: int, budget: int, status: int)
+
+    """Requests each route on a throwaway SQLite database and upload
+       directory, and returns the number of statements each one issued and
+       its status code.
+    """
+    import main   # declares the routes
+    app, db = models.app, models.db
+    directory = tempfile.mkdtemp()
+    config = dict((key, app.config[key]) for key in ('SQLALCHEMY_DATABASE_URI', 'EVENT_SINK',
+                                                     'UPLOAD_FOLDER', 'THUMBNAIL_FOLDER'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'budget.db')
+    # absolute paths: served as they are, whatever the app's root path
+    app.config['UPLOAD_FOLDER'] = os.path.join(directory, 'files/')
+    app.config['THUMBNAIL_FOLDER'] = os.path.join(directory, 'thumbs/')
+    # the event writer thread would add its statements to the counts
+    app.config['EVENT_SINK'] = None
+    # templates missing from this checkout render as empty pages
+    loader = app.jinja_env.loader
+    app.jinja_env.loader = ChoiceLoader([loader, FunctionLoader(lambda name: u"")])
+    try:
+        with app.app_context():
+            db.create_all()
+            ids = build_fixture()
+            db.session.remove()
+            engine = db.engine
+
+        owner, anonymous = app.test_client(), app.test_client()
+        with owner.session_transaction() as session:
+            session['username'] = ids["owner"]
+        requests = {
+            "folder (owner)": (owner, "/f/%s" % ids["root"]),
+            "folder (anonymous)": (anonymous, "/f/%s" % ids["root"]),
+            "folder (selected file)": (owner, "/f/%s?file_id=%s" % (ids["root"], ids["file"])),
+            "folder (search)": (owner, "/f/%s?search=file" % ids["root"]),
+            # other users search the visible subtree; nothing matches
+            "folder (anonymous search)": (anonymous, "/f/%s?search=nothing" % ids["root"]),
+            # an empty archive, not an error
+            "folder zip (anonymous)": (anonymous, "/f/%s/zip" % ids["empty"]),
+            "user": (owner, "/user"),
+            "file": (anonymous, "/i/%s" % ids["file"]),
+            "thumbnail": (anonymous, "/t/%s" % ids["file"]),
+        }
+
+        results = []
+        for route in sorted(budgets):
+            client, url = requests[route]
+            with QueryCounter(engine) as counter:
+                # a context of its own, also under the one manager commands
+                # run in, so that nothing on g is shared between requests
+                with app.app_context():
+                    response = client.get(url)
+                response.get_data()
+            response.close()
+            results.append((route, counter.count, budgets[route], response.status_code))
+
+        with app.app_context():
+            db.drop_all()
+        return results
+    finally:
+        app.config.update(config)
+        app.jinja_env.loader = loader
+        shutil.rmtree(directory)
@@ -0,0 +1,133 @@
+"""
+-------------------------------------------------------------
+                      QUERY PLANS
+  Runs EXPLAIN QUERY PLAN on the hot lookups and reports the
+     ones SQLite would answer with a full table scan.
+-------------------------------------------------------------
+
+usage: python models.py check_query_plans [--database]
+
+By default the plans are taken on a throwaway SQLite database created
+from the models; with --database, on the configured one (which must be
+SQLite, e.g. to check a database brought up to date with `db upgrade`).
+Without ANALYZE statistics SQLite uses any index that applies, so the
+plans don't depend on the amount of data.
+
+A lookup that scans a table is missing an index (or can't use one, e.g.
+because the compared columns have different types); the command exits
+with status 1.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+import models
+
+
+# "SCAN file", "SCAN file USING INDEX ...", "SCAN TABLE file" (SQLite < 3.36)
+SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+ALIAS = re.compile(r"_\d+$")
+
+
+def hot_queries():
+
+    # return: List of (name: str, query: Query)
+
+    """The lookups made on (nearly) every request, and the joins of the
+       listing, search and counting queries, with placeholder values.
+    """
+    db, User, Folder, File = models.db, models.User, models.Folder, models.File
+    folder_id, md5 = "f" * 32, "0" * 32
+    folder, admin = Folder("plans", 1), User("plans", "", is_admin=True)
+    folder.id = folder_id
+    listing, order = folder.listing()
+    subtrees = [("owner", folder.subtree(user=admin)), ("visitor", folder.subtree())]
+    totals = aliased(Folder)
+    return [
+        ("user by name", User.query.filter(func.lower(User.username) == "username")),
+        ("root folders", Folder.query.filter_by(user_id=1).filter_by(parent=None)),
+        ("subfolders", Folder.query.filter_by(parent_id=folder_id)),
+        ("folder by id", Folder.query.filter_by(id=folder_id)),
+        ("files of a folder", File.query.filter_by(folder_id=folder_id)),
+        ("duplicate check", File.query.filter_by(folder_id=folder_id).filter_by(md5=md5)),
+        ("files by md5", File.query.filter_by(md5=md5)),
+        ("file by path", File.query.filter_by(path="files/abc.txt")),
+        ("file by id", File.query.filter_by(id="a" * 20)),
+        ("archive members", models.ArchiveMember.query.filter_by(md5=md5).order_by(models.ArchiveMember.position)),
+        ("archives queued", models.Blob.query.filter_by(archive_status="pending")),
+        ("listing page", select([listing.c.kind, listing.c.id]).order_by(*order).limit(25)),
+        ("folder totals", db.session.query(totals.id, func.count(File.id))
+                            .join(totals, File.folder_id == totals.id)
+                            .filter(File.md5 == md5).group_by(totals.id)),
+    ] + [
+        ("subtree files (%s)" % who, File.query.filter(File.folder_id.in_(db.session.query(subtree.c.id))))
+        for who, subtree in subtrees
+    ] + [
+        ("subtree folders (%s)" % who, Folder.query.filter(Folder.parent_id.in_(db.session.query(subtree.c.id))))
+        for who, subtree in subtrees
+    ]
+
+
+def explain(connection, query):
+
+    # connection: Connection
+    # query: Query or select
+    # return: List of str
+
+    """Returns the detail lines of the SQLite query plan of query."""
+    statement = getattr(query, "statement", query)
+    sql = statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+    return [row[-1] for row in connection.execute("EXPLAIN QUERY PLAN " + str(sql))]
+
+
+def full_scans(plan, tables):
+
+    # plan: List of str
+    # tables: Set of str
+    # return: List of str
+
+    """Returns the lines of plan that scan one of tables (as opposed to
+       searching it through an index).
+    """
+    scans = []
+    for line in plan:
+        match = SCAN.match(line)
+        # aliased tables are named like "folder_1"
+        if match and (match.group(1) in tables or ALIAS.sub("", match.group(1)) in tables):
+            scans.append(line)
+    return scans
+
+
+def check_query_plans(queries=None, database=False):
+
+    # queries: List of (name: str, query: Query)
+    # database: bool (use the configured database)
+    # return: List of (name: str, plan: List of str, scans: List of str)
+
+    app, db = models.app, models.db
+    directory = None
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if not database:
+        directory = tempfile.mkdtemp()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'plans.db')
+    try:
+        with app.app_context():
+            if db.engine.dialect.name != 'sqlite':
+                raise ValueError("query plans can only be checked on SQLite")
+            if directory:
+                db.create_all()
+            tables = set(db.metadata.tables)
+            results = []
+            with db.engine.connect() as connection:
+                for name, query in queries or hot_queries():
+                    plan = explain(connection, query)
+                    results.append((name, plan, full_scans(plan, tables)))
+            db.session.remove()
+        return results
+    finally:
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+        if directory:
+            shutil.rmtree(directory)
@@ -0,0 +1,307 @@
+"""
+-------------------------------------------------------------
+                         QUOTA
+  Storage quota accounting with atomic SQL updates: space is
+ reserved before upload data is written, charged when files
+ are stored, and reconciled against the stored blob sizes.
+-------------------------------------------------------------
+
+A user's storage is described by two counters on the user row, only ever
+changed by relative UPDATEs (never read, modified and written back):
+
+    used_storage      bytes of the user's files
+    reserved_storage  bytes held by uploads in progress
+
+Uploads reserve space in the ledger (StorageReservation rows) before the
+data is written: for each part of a multipart request, its Content-Length
+if the client sent one, otherwise what's left of the request's
+Content-Length (an upper bound of the files in it). A reservation only
+succeeds if used + reserved storage stays within the quota, checked in the
+same statement, so concurrent uploads from any number of workers can't
+overcommit the quota between them. Data beyond what could be reserved is
+dropped while it is received (the file is rejected as over quota).
+
+The reservation is settled in the transaction that stores the files
+(used_storage grows by their actual sizes, see File.set_size) and released
+at the end of the request otherwise. Reservations of crashed workers are
+expired by `python models.py reconcile_quota`, which also recomputes the
+counters from the blob sizes of the files.
+"""
+
+from datetime import datetime, timedelta
+from flask import g, current_app, has_request_context
+from sqlalchemy import event, func, select
+import models
+
+
+def init_app(app):
+
+    # app: Flask
+
+    app.config.setdefault('QUOTA_RESERVATION_STEP', 8 * 1024 * 1024)
+    app.config.setdefault('QUOTA_RESERVATION_TIMEOUT', 6 * 3600)
+    app.teardown_request(_release_reservation)
+
+
+def limit(user):
+
+    # user: User
+    # return: int (None for no limit)
+
+    if user is None:
+        return 0
+    if user.is_admin:
+        return None
+    return current_app.config['MAX_FREE_STORAGE']
+
+
+def charge(user_id, bytes):
+
+    # user_id: int
+    # bytes: int (negative to free space)
+
+    """Adds bytes to the used storage of a user (does not commit)."""
+    if bytes:
+        User = models.User
+        User.query.filter_by(id=user_id)\
+                  .update({User.used_storage: User.used_storage + bytes}, synchronize_session='evaluate')
+
+
+class Reservation(object):
+
+    """
+        Space reserved for the uploads of one request. Uploads take() the
+        bytes they write from it; it grows (in steps of at least
+        QUOTA_RESERVATION_STEP) when they need more than was reserved.
+
+        example usage:
+
+            reservation = Reservation(user)
+            reservation.reserve(content_length)
+            if not reservation.take(len(data)):
+                # over quota
+    """
+
+    def __init__(self, user):
+
+        # user: User (None for anonymous requests, which can't reserve)
+
+        self.user_id = user.id if user else None
+        self.limit = limit(user)
+        self.id = None
+        self.bytes = 0      # reserved
+        self.used = 0       # taken by uploads
+
+    @property
+    def available(self):
+        # return: int (None for no limit)
+        return None if self.limit is None else self.bytes - self.used
+
+    def reserve(self, bytes):
+
+        # bytes: int
+        # return: bool
+
+        """Makes sure at least bytes more can be taken, reserving as much
+           as the quota allows. Returns False if it fell short.
+        """
+        if self.limit is None:
+            return True
+        missing = bytes - self.available
+        if missing <= 0:
+            return True
+        self._grow(missing)
+        return self.available >= bytes
+
+    def take(self, bytes):
+
+        # bytes: int
+        # return: bool
+
+        """Takes bytes from the reservation, growing it if needed. Returns
+           False (taking nothing) if the quota is exhausted.
+        """
+        if self.limit is not None and bytes > self.available:
+            self._grow(max(bytes - self.available, current_app.config['QUOTA_RESERVATION_STEP']))
+            if bytes > self.available:
+                return False
+        self.used += bytes
+        return True
+
+    def give_back(self, bytes):
+        # bytes: int - taken by an upload that was dropped
+        self.used -= bytes
+
+    def _grow(self, bytes):
+        if self.user_id is None:
+            return
+        # all or nothing, then whatever is left of the quota
+        if not self._try_reserve(bytes):
+            User = models.User
+            with models.db.engine.connect() as connection:
+                used, reserved = connection.execute(select([User.used_storage, User.reserved_storage])
+                                                    .where(User.id == self.user_id)).first()
+            left = self.limit - used - reserved
+            if 0 < left < bytes:
+                self._try_reserve(left)
+
+    def _try_reserve(self, bytes):
+
+        # bytes: int
+        # return: bool
+
+        # its own transaction, committed at once: the space is held while the
+        # data is received, for every other worker to see
+        User, StorageReservation = models.User, models.StorageReservation
+        with models.db.engine.connect() as connection:
+            with connection.begin() as transaction:
+                reserved = connection.execute(User.__table__.update()
+                                              .where(User.id == self.user_id)
+                                              .where(User.used_storage + User.reserved_storage + bytes <= self.limit)
+                                              .values(reserved_storage=User.reserved_storage + bytes)).rowcount
+                if not reserved:
+                    return False
+                if self.id is None:
+                    self.id = connection.execute(StorageReservation.__table__.insert()
+                                                 .values(user_id=self.user_id, bytes=bytes,
+                                                         date=datetime.utcnow()))\
+                                        .inserted_primary_key[0]
+                elif not connection.execute(StorageReservation.__table__.update()
+                                            .where(StorageReservation.id == self.id)
+                                            .where(StorageReservation.user_id == self.user_id)
+                                            .values(bytes=StorageReservation.bytes + bytes)).rowcount:
+                    # expired meanwhile (its space was given back): it can't grow
+                    transaction.rollback()
+                    return False
+        self.bytes += bytes
+        return True
+
+    def settle(self):
+        """Drops the reservation in the current transaction, the one that
+           charges the stored files (does not commit). Once that commits,
+           release() does nothing.
+        """
+        if self.id is None:
+            return
+        session = models.db.session()
+        release(session, self.id)
+        # the first of the two ends the transaction
+        ended = []
+
+        def committed(session):
+            if not ended:
+                ended.append(True)
+                self.id = None
+
+        def rolled_back(session, previous_transaction):
+            ended.append(False)
+
+        event.listen(session, 'after_commit', committed, once=True)
+        event.listen(session, 'after_soft_rollback', rolled_back, once=True)
+
+    def release(self):
+        """Drops the reservation in a transaction of its own. Does nothing
+           if it was settled.
+        """
+        if self.id is not None:
+            with models.db.engine.begin() as connection:
+                release(connection, self.id)
+            self.id = None
+
+
+def release(connection, id, user_id=None):
+
+    # connection: Connection or Session
+    # id: int (StorageReservation)
+    # user_id: int - only if it's a reservation of this user
+    # return: bool
+
+    """Deletes a reservation and gives its space back, unless it was
+       deleted already (settled, released or expired).
+    """
+    StorageReservation, User = models.StorageReservation, models.User
+    query = select([StorageReservation.user_id, StorageReservation.bytes]).where(StorageReservation.id == id)
+    if user_id is not None:
+        query = query.where(StorageReservation.user_id == user_id)
+    row = connection.execute(query).first()
+    if row is None:
+        return False
+    user_id, bytes = row
+    # whoever deletes the row gives the space back
+    if not connection.execute(StorageReservation.__table__.delete()
+                              .where(StorageReservation.id == id)
+                              .where(StorageReservation.bytes == bytes)).rowcount:
+        return False
+    connection.execute(User.__table__.update().where(User.id == user_id)
+                       .values(reserved_storage=User.reserved_storage - bytes))
+    return True
+
+
+def reservation():
+
+    # return: Reservation
+
+    """Returns the reservation of the current request."""
+    if 'quota_reservation' not in g:
+        import helper_functions
+        g.quota_reservation = Reservation(helper_functions.get_user())
+    return g.quota_reservation
+
+
+def _release_reservation(exception):
+    reservation = g.get('quota_reservation') if has_request_context() else None
+    if reservation is not None:
+        reservation.release()
+
+
+def expire_reservations(timeout=None):
+
+    # timeout: int - seconds (defaults to QUOTA_RESERVATION_TIMEOUT)
+    # return: int
+
+    """Releases the reservations older than timeout, left behind by
+       workers that died during an upload. Returns their number.
+    """
+    if timeout is None:
+        timeout = current_app.config['QUOTA_RESERVATION_TIMEOUT']
+    StorageReservation = models.StorageReservation
+    before = datetime.utcnow() - timedelta(seconds=timeout)
+    expired = 0
+    for (id,) in models.db.session.query(StorageReservation.id).filter(StorageReservation.date < before).all():
+        with models.db.engine.begin() as connection:
+            expired += release(connection, id)
+    return expired
+
+
+def reconcile(verify=False):
+
+    """
+        verify: bool
+
+        Recomputes the used and reserved storage of every user from the
+        sizes of the blobs of their files and the open reservations, and
+        returns the drifted users as (user, used storage, reserved storage)
+        with the recomputed values. Nothing is written if verify is True.
+
+        Each user is repaired by a single UPDATE computing the totals
+        itself, so uploads committed meanwhile are not overwritten.
+    """
+
+    db, User, Folder, File, Blob = models.db, models.User, models.Folder, models.File, models.Blob
+    StorageReservation = models.StorageReservation
+    used = select([func.coalesce(func.sum(func.coalesce(Blob.size, File.size)), 0)])\
+           .select_from(File.__table__.join(Folder.__table__, File.folder_id == Folder.id)
+                                      .outerjoin(Blob.__table__, File.md5 == Blob.md5))\
+           .where(Folder.user_id == User.id).as_scalar()
+    reserved = select([func.coalesce(func.sum(StorageReservation.bytes), 0)])\
+               .where(StorageReservation.user_id == User.id).as_scalar()
+
+    drifted = [(user, actual_used, actual_reserved) for user, actual_used, actual_reserved
+               in db.session.query(User, used, reserved)
+               if (user.used_storage, user.reserved_storage) != (actual_used, actual_reserved)]
+    if not verify:
+        for user, actual_used, actual_reserved in drifted:
+            db.session.execute(User.__table__.update().where(User.id == user.id)
+                               .values(used_storage=used, reserved_storage=reserved))
+        db.session.commit()
+    return drifted
@@ -0,0 +1,128 @@
+"""
+-------------------------------------------------------------
+                      SEARCH INDEX
+  Full-text name index for files and folders, backed by
+    SQLite FTS5 tables using the trigram tokenizer.
+-------------------------------------------------------------
+
+The index tables are external-content FTS5 tables over the "file" and
+"folder" tables, kept up to date by triggers, so every code path that
+adds, renames or deletes a row (Folder.add_file, File.delete, the upload
+path in show_folder, folder settings...) updates the index in the same
+transaction without any extra Python-side work.
+
+The trigram tokenizer answers both prefix and substring lookups from the
+index. Terms shorter than 3 characters cannot be matched by trigrams and,
+like databases without FTS5, fall back to a LIKE scan.
+
+External-content tables reference rows by rowid, which VACUUM is allowed
+to renumber; run `python models.py rebuild_search_index` after a VACUUM.
+"""
+
+from sqlalchemy import text, literal_column, desc
+from sqlalchemy.sql import table, column
+from sqlalchemy.exc import DBAPIError
+
+
+# indexed table -> index table
+INDEXES = {
+    "file": "file_name_index",
+    "folder": "folder_name_index",
+}
+
+MIN_TERM_LENGTH = 3
+
+TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO {index}(rowid, name) VALUES (new.rowid, new.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table} BEGIN
+        INSERT INTO {index}({index}, rowid, name) VALUES ('delete', old.rowid, old.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {index}_rename AFTER UPDATE OF name ON {table} BEGIN
+        INSERT INTO {index}({index}, rowid, name) VALUES ('delete', old.rowid, old.name);
+        INSERT INTO {index}(rowid, name) VALUES (new.rowid, new.name);
+    END""",
+]
+
+# engine url -> bool
+_available = {}
+
+
+def create(connection):
+
+    """Creates the index tables and their triggers (if they don't exist yet).
+       Does nothing on databases other than SQLite.
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    for table_name, index in INDEXES.items():
+        connection.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5("
+                                "name, content='{table}', content_rowid='rowid', "
+                                "tokenize='trigram')".format(index=index, table=table_name)))
+        for trigger in TRIGGERS:
+            connection.execute(text(trigger.format(index=index, table=table_name)))
+    _available.pop(str(connection.engine.url), None)
+
+
+def rebuild(connection):
+
+    """Creates the index if needed and repopulates it from the indexed tables.
+    """
+    create(connection)
+    if connection.dialect.name != "sqlite":
+        return
+    for index in INDEXES.values():
+        connection.execute(text("INSERT INTO {index}({index}) VALUES ('rebuild')".format(index=index)))
+
+
+def available(engine):
+
+    # engine: Engine
+    # return: bool
+
+    key = str(engine.url)
+    if key not in _available:
+        try:
+            _available[key] = engine.dialect.name == "sqlite" and all(
+                engine.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                               name=index).scalar() for index in INDEXES.values())
+        except DBAPIError:
+            _available[key] = False
+    return _available[key]
+
+
+def usable(engine, term):
+
+    # term: str
+    # return: bool
+
+    """Returns True if the term can be looked up in the index.
+    """
+    return len(term) >= MIN_TERM_LENGTH and available(engine)
+
+
+def ranked(query, model, term):
+
+    """
+        query: Query
+        model: File or Folder
+        term: str
+
+        Restricts the query to rows of model whose name contains term, using
+        the index, and orders them by relevance: names starting with the term
+        first, then by FTS5 rank (bm25).
+    """
+
+    table_name = model.__table__.name
+    index = table(INDEXES[table_name], column("rowid"), column("rank"))
+    match = literal_column(INDEXES[table_name]).match(_quote(term))
+
+    return query.join(index, index.c.rowid == literal_column(table_name + ".rowid"))\
+                .filter(match)\
+                .order_by(desc(model.name.like(term + '%')), index.c.rank)
+
+
+def _quote(term):
+    # FTS5 string literal: matches the term as a substring
+    return '"' + term.replace('"', '""') + '"'
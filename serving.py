@@ -0,0 +1,169 @@
+"""
+-------------------------------------------------------------
+                        SERVING
+  Sends stored file data and thumbnails with strong ETags,
+ cache headers and byte range support, or hands the transfer
+  over to the front-end server (X-Sendfile / X-Accel-Redirect).
+-------------------------------------------------------------
+
+The data of a file never changes once uploaded, so file responses carry
+the file's MD5 as a strong ETag and can be cached for FILE_CACHE_MAX_AGE.
+A matching If-None-Match is answered with 304 before the file is opened.
+Shared caches keep the files of public folders for SHARED_CACHE_MAX_AGE
+only (s-maxage): a file can be moved to a private folder later under the
+same URL, and revalidation goes through the permission check again.
+
+SENDFILE_MODE selects who transfers the bytes:
+
+    None          the Python worker streams the file itself
+    'x-sendfile'  Apache (mod_xsendfile) / lighttpd, given the absolute path
+    'x-accel'     nginx, given X_ACCEL_PREFIX + the path relative to the
+                  application root. The prefix must map to an internal
+                  location, e.g.
+
+                      location /protected/ {
+                          internal;
+                          alias /path/to/gofr/;
+                      }
+
+In both offloading modes the front-end server handles byte ranges.
+"""
+
+import os
+import mimetypes
+from flask import current_app, request, safe_join
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
+import archives
+import thumbnails
+
+
+def send(directory, filename, mimetype, etag=None, max_age=0, public=False, immutable=False):
+
+    """
+        directory: str - relative to the application root
+        filename: str - relative to directory
+        mimetype: str
+        etag: str - strong validator for the content (None for no ETag)
+        max_age: int - seconds the response may be cached for
+        public: bool - True if shared caches may store the response
+        immutable: bool - True if the content at this URL never changes
+
+        Returns the response sending the file. Ranges are supported when
+        the worker streams the file itself.
+    """
+
+    path = safe_join(directory, filename)
+    response = current_app.response_class(mimetype=mimetype, direct_passthrough=True)
+    if etag:
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control(max_age, public, immutable)
+
+    # conditional GET: answered without touching the file
+    if etag and request.method in ("GET", "HEAD") and request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+
+    mode = current_app.config.get('SENDFILE_MODE')
+    if mode:
+        # the front-end server sets the length of what it sends
+        response.headers.pop('Content-Length', None)
+    if mode == 'x-accel':
+        response.headers['X-Accel-Redirect'] = current_app.config['X_ACCEL_PREFIX'] + path.replace(os.sep, '/')
+        return response
+
+    path = os.path.join(current_app.root_path, path)
+    if not os.path.isfile(path):
+        raise NotFound()
+    if mode == 'x-sendfile':
+        response.headers['X-Sendfile'] = path
+        return response
+
+    file = open(path, 'rb')
+    size = os.fstat(file.fileno()).st_size
+    response.response = wrap_file(request.environ, file)
+    response.content_length = size
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+def send_file_data(file):
+
+    # file: File
+    # return: Response
+
+    """Sends the data of an uploaded file."""
+    return send(current_app.config['UPLOAD_FOLDER'], file.full_name, file.get_mimetype(),
+                etag=file.md5, max_age=current_app.config['FILE_CACHE_MAX_AGE'],
+                public=is_public(file), immutable=True)
+
+
+def send_archive_member(file, blob, member):
+
+    # file: File (the archive)
+    # blob: Blob (its data)
+    # member: ArchiveMember
+    # return: Response
+
+    """Streams a member of an archive as a download. Its data can't be
+       seeked into without decompressing, so ranges aren't supported.
+    """
+    response = current_app.response_class(mimetype='application/octet-stream', direct_passthrough=True)
+    response.set_etag("%s-%d" % (blob.md5, member.position))
+    response.headers['Cache-Control'] = cache_control(current_app.config['FILE_CACHE_MAX_AGE'],
+                                                      is_public(file), immutable=True)
+    if request.if_none_match.contains("%s-%d" % (blob.md5, member.position)):
+        response.status_code = 304
+        return response
+
+    name = os.path.basename(member.name.rstrip('/'))
+    response.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    # never rendered by the browser: the contents are anyone's
+    response.headers.add('Content-Disposition', 'attachment', filename=secure_filename(name) or "member")
+    response.response = wrap_file(request.environ, archives.open_member(blob, member), archives.CHUNK_SIZE)
+    response.content_length = member.size
+    return response
+
+
+def send_thumbnail(file, size=None):
+
+    # file: File
+    # size: int (one of thumbnails.SIZES, None for the default size)
+    # return: Response
+
+    """Sends the thumbnail of a file. Its path changes whenever it is
+       rendered again, so the file name is a strong validator; the
+       placeholder shown while it is queued is not cached.
+    """
+    thumb_path = file.get_thumb_path(size)
+    filename = os.path.basename(thumb_path)
+    max_age = 0 if file.thumb_status in (thumbnails.PENDING, thumbnails.WORKING) \
+                else current_app.config['THUMBNAIL_CACHE_MAX_AGE']
+    mimetype = mimetypes.guess_type(filename)[0] or "image/" + filename.split('.')[-1].lower()
+    return send(os.path.dirname(thumb_path), filename, mimetype, etag=filename, max_age=max_age,
+                public=is_public(file))
+
+
+def cache_control(max_age, public=False, immutable=False):
+
+    # max_age: int
+    # public: bool
+    # immutable: bool
+    # return: str (the Cache-Control header)
+
+    # shared caches hold public responses for SHARED_CACHE_MAX_AGE at most
+    if public:
+        visibility = "public, s-maxage=%d" % min(max_age, current_app.config['SHARED_CACHE_MAX_AGE'])
+    else:
+        visibility = "private"
+    return "%s, max-age=%d%s" % (visibility, max_age, ", immutable" if immutable else "")
+
+
+def is_public(file):
+
+    # file: File
+    # return: bool
+
+    """True if anyone can see the file, so shared caches may keep it."""
+    folder = file.folder
+    return not folder.extends_permissions or (not folder.private and not folder.password_protected)
@@ -0,0 +1,299 @@
+"""
+-------------------------------------------------------------
+                      THUMBNAILS
+  Background thumbnail generation. Uploaded images are given
+ a placeholder thumbnail and queued (thumb_status "pending");
+  a worker process claims queued files from the database and
+     renders their thumbnails in a pool of processes.
+-------------------------------------------------------------
+
+usage: python models.py thumbnail_worker [--processes N]
+       python models.py regenerate_thumbnails [--all]
+
+Every image is decoded once and rendered in all of SIZES. JPEGs are
+decoded at a reduced scale (PIL draft mode) just large enough for the
+biggest size, so the full-resolution bitmap is never built. File.thumb_path
+points to the DEFAULT_SIZE rendering, the other sizes sit next to it
+(see sized_path). Renderings that no file or blob points to anymore are
+deleted once the transaction that replaced them is committed.
+"""
+
+import os
+import time
+from multiprocessing import Pool
+from PIL import Image, ImageOps, features
+import models
+import page_cache
+
+
+PENDING = "pending"
+WORKING = "working"
+READY = "ready"
+FAILED = "failed"
+
+MAX_ATTEMPTS = 3
+JOB_TIMEOUT = 120
+# files queued per transaction by regenerate()
+BATCH_SIZE = 500
+
+SIZES = (64, 250, 500)
+DEFAULT_SIZE = 250
+
+# output format -> (extension, save options)
+PROFILES = {
+    "WEBP": ("webp", {"quality": 80, "method": 4}),
+    "JPEG": ("jpg", {"quality": 85, "optimize": True, "progressive": True}),
+}
+FORMAT = "WEBP" if features.check("webp") else "JPEG"
+EXTENSION = PROFILES[FORMAT][0]
+
+
+def sized_path(thumb_path, size):
+
+    # thumb_path: str
+    # size: int
+    # return: str
+
+    """Returns the path of the `size` rendering of the thumbnail at
+       thumb_path. Generic icons and thumbnails made before multi-size
+       output only exist in one size, their own path is returned.
+    """
+    root, extension = os.path.splitext(thumb_path)
+    suffix = "_%d" % DEFAULT_SIZE
+    if size not in SIZES or not root.endswith(suffix):
+        return thumb_path
+    return root[:-len(suffix)] + "_%d" % size + extension
+
+
+def all_paths(thumb_path):
+
+    # return: List of str
+
+    return sorted(set(sized_path(thumb_path, size) for size in SIZES))
+
+
+def is_current(thumb_path):
+
+    # return: bool
+
+    """True if thumb_path was rendered with the current sizes and format."""
+    return thumb_path.endswith("_%d.%s" % (DEFAULT_SIZE, EXTENSION))
+
+
+def is_rendering(thumb_path):
+
+    # return: bool
+
+    # renderings are named after the file they were made for ("<id>_..."),
+    # unlike the icons and placeholders shared by every file of a type
+    return "_" in os.path.basename(thumb_path)
+
+
+def remove_unused(thumb_paths):
+
+    # thumb_paths: iterable of str (thumb_path values)
+    # return: int (number of files deleted)
+
+    """Deletes the renderings (every size) among thumb_paths that no file
+       or blob points to anymore. Call it once the transaction that replaced
+       them is committed.
+    """
+    File, Blob, db = models.File, models.Blob, models.db
+    removed = 0
+    for thumb_path in set(thumb_paths):
+        if not thumb_path or not is_rendering(thumb_path):
+            continue
+        if db.session.query(File.id).filter_by(thumb_path=thumb_path).first() or \
+                db.session.query(Blob.md5).filter_by(thumb_path=thumb_path).first():
+            continue
+        for path in all_paths(thumb_path):
+            try:
+                os.remove(models.site_path + path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def open_reduced(source, size):
+
+    # source: str
+    # size: int
+    # return: Image
+
+    """Opens the image at source, decoded at the smallest scale that still
+       covers a size x size square.
+    """
+    img = Image.open(source)
+    if img.format == "JPEG":
+        # DCT scaling: the decoder only produces 1/2, 1/4 or 1/8 of the pixels
+        img.draft("RGB", (size, size))
+    elif hasattr(img, "reduce"):
+        factor = min(img.size) // size
+        if factor >= 2:
+            # reduce() refuses palette, 1-bit and 16-bit images (GIF, PNG)
+            if img.mode not in ("L", "LA", "RGB", "RGBA"):
+                img = img.convert("RGB")
+            img = img.reduce(factor)
+    return img.convert("RGB")
+
+
+def make_thumbnail(source, destinations):
+
+    # source: str
+    # destinations: Dict of int -> str (size -> path)
+
+    """Renders the thumbnails of the image at source, one per size, from a
+       single decode. Runs in the worker pool, so it must not touch the
+       database.
+    """
+    sizes = sorted(destinations, reverse=True)
+    thumb = ImageOps.fit(open_reduced(source, sizes[0]), (sizes[0], sizes[0]), Image.LANCZOS)
+    options = PROFILES[FORMAT][1]
+    for size in sizes:
+        # each size is downscaled from the previous (larger) one
+        if thumb.size != (size, size):
+            thumb = thumb.resize((size, size), Image.LANCZOS)
+        thumb.save(destinations[size], FORMAT, **options)
+
+
+def claim_jobs(limit):
+
+    # limit: int
+    # return: List of File
+
+    """Marks up to `limit` pending files as being worked on and returns them.
+       The status update is conditional, so concurrent workers never claim
+       the same file.
+    """
+    File = models.File
+    claimed = []
+    for file in File.query.filter_by(thumb_status=PENDING).order_by(File.date).limit(limit):
+        if File.query.filter_by(id=file.id, thumb_status=PENDING)\
+                     .update({File.thumb_status: WORKING}, synchronize_session=False):
+            claimed.append(file)
+    models.db.session.commit()
+    return claimed
+
+
+def finish_job(file, thumb_path, result):
+
+    # file: File
+    # thumb_path: str
+    # result: AsyncResult
+    # return: List of str (the thumb_paths it replaced, see remove_unused)
+
+    # the page shows the new thumbnail (or icon) once this is committed
+    page_cache.invalidate([file.folder_id])
+    replaced = [file.thumb_path]
+    try:
+        result.get(JOB_TIMEOUT)
+    except Exception:
+        file.thumb_attempts = (file.thumb_attempts or 0) + 1
+        if file.thumb_attempts < MAX_ATTEMPTS:
+            file.thumb_status = PENDING
+            return []
+        # give up and show the generic icon instead of the placeholder
+        file.thumb_status = FAILED
+        file.thumb_path = os.path.join(models.app.config['THUMBNAIL_FOLDER'], "other.png")
+        return replaced
+
+    file.thumb_path = thumb_path
+    file.thumb_status = READY
+    blob = models.Blob.query.get(file.md5) if file.md5 else None
+    if blob and not (blob.thumb_path and is_current(blob.thumb_path)):
+        replaced.append(blob.thumb_path)
+        blob.thumb_path = file.thumb_path
+    return [path for path in replaced if path != thumb_path]
+
+
+def run_worker(processes=None, batch_size=20, poll_interval=2.0, once=False):
+
+    """Processes the thumbnail queue until interrupted (or, if once is
+       True, until the queue is empty).
+    """
+    File = models.File
+
+    # files claimed by a worker that died are queued again
+    File.query.filter_by(thumb_status=WORKING).update({File.thumb_status: PENDING},
+                                                      synchronize_session=False)
+    models.db.session.commit()
+
+    pool = Pool(processes)
+    try:
+        while True:
+            jobs = claim_jobs(batch_size)
+            if not jobs:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            # files with the same data share one rendering
+            renderings = {}
+            results = []
+            replaced = []
+            for file in jobs:
+                blob = models.Blob.query.get(file.md5) if file.md5 else None
+                if blob and blob.thumb_path and is_current(blob.thumb_path):
+                    replaced.append(file.thumb_path)
+                    file.thumb_path = blob.thumb_path
+                    file.thumb_status = READY
+                    continue
+                key = file.md5 or file.id
+                if key not in renderings:
+                    thumb_path = os.path.join(models.app.config['THUMBNAIL_FOLDER'],
+                                              "%s_%d.%s" % (file.id, DEFAULT_SIZE, EXTENSION))
+                    destinations = dict((size, models.site_path + sized_path(thumb_path, size))
+                                        for size in SIZES)
+                    result = pool.apply_async(make_thumbnail, (models.site_path + file.path, destinations))
+                    renderings[key] = (thumb_path, result)
+                results.append((file,) + renderings[key])
+            for file, thumb_path, result in results:
+                replaced += finish_job(file, thumb_path, result)
+            models.db.session.commit()
+            remove_unused(replaced)
+    finally:
+        pool.terminate()
+
+
+def regenerate(all=False):
+
+    # all: bool
+    # return: int
+
+    """Queues existing images for the worker again. Unless `all` is True,
+       only thumbnails that predate the current sizes and format are
+       regenerated. Returns the number of files queued.
+
+       The images are read and queued BATCH_SIZE at a time, in id order,
+       one transaction per batch. A file keeps showing its old thumbnail
+       until the worker replaces it; the old rendering is deleted then.
+    """
+    File, Blob, db = models.File, models.Blob, models.db
+    images = db.session.query(File, Blob).outerjoin(Blob, File.md5 == Blob.md5)\
+                       .filter(File.type == "Image")\
+                       .filter(models.or_(File.thumb_status == None, File.thumb_status != WORKING))\
+                       .order_by(File.id)
+    queued = 0
+    last_id = None
+    while True:
+        batch = (images.filter(File.id > last_id) if last_id else images).limit(BATCH_SIZE).all()
+        if not batch:
+            break
+        replaced = []
+        for file, blob in batch:
+            if not all and file.thumb_status == READY and is_current(file.thumb_path):
+                continue
+            file.thumb_status = PENDING
+            file.thumb_attempts = 0
+            queued += 1
+            # don't let the worker reuse the blob's outdated thumbnail
+            if blob and blob.thumb_path and (all or not is_current(blob.thumb_path)):
+                replaced.append(blob.thumb_path)
+                blob.thumb_path = None
+        last_id = batch[-1][0].id
+        db.session.commit()
+        # renderings of the blobs that none of their files show
+        remove_unused(replaced)
+    return queued
@@ -0,0 +1,119 @@
+"""
+-------------------------------------------------------------
+                        UPLOADS
+   Streaming ingest of uploaded files: each file is hashed,
+ sized and checked against the uploader's quota in a single
+     pass while the request stream is written to disk.
+-------------------------------------------------------------
+"""
+
+import os
+import tempfile
+from hashlib import md5
+from flask import Request, current_app
+import quota
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class IngestFile(object):
+
+    """Writable temporary file in the upload folder that computes the MD5
+       and byte count of everything written to it. The bytes are taken
+       from a quota reservation as they arrive; once it can't provide any
+       more, the data is dropped and `over_quota` is set, so an over-quota
+       upload never reaches the disk in full.
+
+       The file is deleted when closed unless it was moved into place with
+       move_to().
+    """
+
+    def __init__(self, directory, reservation=None):
+
+        # directory: str
+        # reservation: quota.Reservation (None for no limit)
+
+        fd, self.temp_path = tempfile.mkstemp(prefix='.upload-', dir=directory)
+        self.file = os.fdopen(fd, 'w+b')
+        self.reservation = reservation
+        self.size = 0
+        self.over_quota = False
+        self.moved = False
+        self.md5_gen = md5()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.over_quota:
+            return
+        if self.reservation is not None and not self.reservation.take(len(data)):
+            self.over_quota = True
+            self.file.truncate(0)
+            # what this file took is left for the next ones
+            self.reservation.give_back(self.size - len(data))
+            return
+        self.md5_gen.update(data)
+        self.file.write(data)
+
+    @property
+    def md5(self):
+        return self.md5_gen.hexdigest()
+
+    def move_to(self, path):
+        """Moves the data to its final location (a rename, no copy). Does
+           nothing if it was moved already (a retried transaction).
+        """
+        if self.moved:
+            return
+        self.file.close()
+        os.rename(self.temp_path, path)
+        self.moved = True
+
+    def close(self):
+        self.file.close()
+        if not self.moved:
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+
+    # discard the data without moving it into place
+    discard = close
+
+    def __getattr__(self, name):
+        # read(), seek(), etc. are those of the underlying file
+        return getattr(self.file, name)
+
+
+class UploadRequest(Request):
+
+    """Request class that streams uploaded files into IngestFiles instead
+       of Werkzeug's default spooled temporary files, reserving quota for
+       each of them before its data is received.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        reservation = quota.reservation()
+        # the part's own length if the client sent it (0 if not), otherwise
+        # the rest of the request, which is at least as long as the part
+        reservation.reserve(content_length or max(0, (total_content_length or 0) - reservation.used))
+        return IngestFile(current_app.config['UPLOAD_FOLDER'], reservation=reservation)
+
+
+def ingest(file):
+
+    # file: FileStorage
+    # return: IngestFile
+
+    """Returns the IngestFile holding an uploaded file. Files that were not
+       parsed by UploadRequest are streamed into one here (still a single
+       pass over the data).
+    """
+    if isinstance(file.stream, IngestFile):
+        return file.stream
+
+    upload = IngestFile(current_app.config['UPLOAD_FOLDER'], reservation=quota.reservation())
+    for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b""):
+        upload.write(chunk)
+    return upload